@@ -11,11 +11,14 @@
 
 import argparse
 import inspect
+import json
 import sys
 import logging
+import time
 import pkg_resources
 import datetime
 from pyfaros.discover.discover import Discover
+from pyfaros.discover.cache import TopologyCache
 
 __discover_description = """\
 Discover Skylark Wireless network topologies
@@ -122,6 +125,22 @@ advanced_options.add_argument(
     help="Don't display the tree graphics.",
     action='store_true',
 )
+advanced_options.add_argument(
+    '--cache',
+    action='store_true',
+    help='Start from the topology cached by a recent run and only re-check devices that changed.',
+)
+advanced_options.add_argument(
+    '--watch',
+    action='store_true',
+    help='Keep discovering and print topology changes as JSON lines until interrupted.',
+)
+advanced_options.add_argument(
+    '--interval',
+    type=float,
+    default=5.0,
+    help='Seconds between discoveries in --watch mode.',
+)
 advanced_options.add_argument(
     '--prefer-ipv6',
     action='store_true',
@@ -135,7 +154,8 @@ if parsed.debug:
 else:
     logging.basicConfig(level=logging.INFO)
 
-top = Discover(soapy_enumerate_iterations=1, output=parsed.output, ipv6=parsed.prefer_ipv6, json_filename=parsed.json_filename)
+top = Discover(soapy_enumerate_iterations=1, output=parsed.output, ipv6=parsed.prefer_ipv6, json_filename=parsed.json_filename,
+               cache=TopologyCache() if parsed.cache else None)
 top.set_options(yaml=parsed.yaml, json_out=parsed.json_out)
 if parsed.debug_trace:
     filename = DEFAULT_DEBUG_TRACE.format(str(datetime.datetime.now()).replace(" ", "_")) \
@@ -143,6 +163,22 @@ if parsed.debug_trace:
     logging.info("Logging debug trace to {}".format(filename))
     top.dump_for_test(filename)
 
+if parsed.watch:
+    def emit(events):
+        now = datetime.datetime.now().isoformat()
+        for event in events:
+            event["time"] = now
+            print(json.dumps(event), flush=True)
+
+    emit(Discover.diff({}, top.snapshot()))
+    try:
+        while True:
+            time.sleep(parsed.interval)
+            emit(top.refresh())
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
 if parsed.flat:
     iteration = sorted(
         top, key=Discover.Sortings.POWER_DEPENDENCY
@@ -0,0 +1,144 @@
+#
+#	THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#	INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#	PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+#	FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#	OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#	DEALINGS IN THE SOFTWARE.
+#
+# Copyright (c) 2020, 2021 Skylark Wireless.
+import json
+import logging
+import os
+import tempfile
+import time
+
+log = logging.getLogger(__name__)
+
+
+def default_cache_dir():
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser(os.path.join("~", ".cache"))),
+        "pyfaros")
+
+
+class TopologyCache:
+    """
+      Persists the result of a discovery so the next one can start from it.
+
+      The cache holds the SoapySDR enumeration and, keyed by serial, the
+      trimmed status of every device along with the enumeration record it was
+      fetched for. A cached enumeration younger than `enumerate_ttl_s` is used
+      instead of scanning the network. A cached status is reused as long as it
+      is younger than `status_ttl_s` and the device still enumerates with the
+      same firmware, fpga and address; anything else is fetched again.
+      """
+    VERSION = 1
+    # Changes to any of these in the enumeration invalidate the cached status.
+    RECORD_KEYS = ("firmware", "fpga", "remote")
+
+    def __init__(self, path=None, enumerate_ttl_s=60, status_ttl_s=3600):
+        self.path = path if path is not None else os.path.join(default_cache_dir(), "topology.json")
+        self.enumerate_ttl_s = enumerate_ttl_s
+        self.status_ttl_s = status_ttl_s
+        self.ipv6 = False
+        self.enumerated_at = None
+        self.enumeration = []
+        self.devices = {}
+
+    def load(self, ipv6=False):
+        self.ipv6 = ipv6
+        try:
+            with open(self.path, "r") as fptr:
+                content = json.load(fptr)
+        except (IOError, OSError, ValueError) as e:
+            log.debug("Not using topology cache {}: {}".format(self.path, e))
+            return self
+        if content.get("version") != self.VERSION or content.get("ipv6") != ipv6:
+            log.debug("Ignoring incompatible topology cache {}".format(self.path))
+            return self
+        self.enumerated_at = content.get("enumerated_at")
+        self.enumeration = content.get("enumeration", [])
+        self.devices = content.get("devices", {})
+        return self
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        content = {
+            "version": self.VERSION,
+            "ipv6": self.ipv6,
+            "enumerated_at": self.enumerated_at,
+            "enumeration": self.enumeration,
+            "devices": self.devices,
+        }
+        # Write then rename so a concurrent reader never sees half a file.
+        fd, tmp_path = tempfile.mkstemp(dir=directory or None, prefix=".topology-")
+        try:
+            with os.fdopen(fd, "w") as fptr:
+                json.dump(content, fptr, indent=4)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    @staticmethod
+    def _expired(timestamp, ttl_s, now):
+        return timestamp is None or ttl_s is None or now - timestamp > ttl_s
+
+    def enumeration_fresh(self, now=None):
+        now = time.time() if now is None else now
+        return bool(self.enumeration) and not self._expired(self.enumerated_at, self.enumerate_ttl_s, now)
+
+    def status_for(self, record, now=None):
+        """
+            Returns the cached status for an enumeration record, or None if it
+            has to be fetched from the device again.
+            """
+        now = time.time() if now is None else now
+        entry = self.devices.get(record.get("serial"))
+        if entry is None or self._expired(entry.get("time"), self.status_ttl_s, now):
+            return None
+        cached_record = entry.get("record", {})
+        if any(cached_record.get(key) != record.get(key) for key in self.RECORD_KEYS):
+            return None
+        return entry.get("status")
+
+    def update(self, enumeration, statuses, enumerated_at=None, now=None):
+        """
+            Replaces the cached enumeration and stores the freshly fetched
+            statuses, a mapping of serial to trimmed status. Serials missing
+            from statuses keep their cached entry if they were enumerated.
+            """
+        now = time.time() if now is None else now
+        self.enumeration = list(enumeration)
+        self.enumerated_at = now if enumerated_at is None else enumerated_at
+        records = dict((record["serial"], record) for record in self.enumeration if "serial" in record)
+        devices = {}
+        for serial, record in records.items():
+            if serial in statuses:
+                devices[serial] = {"time": now, "record": record, "status": statuses[serial]}
+            elif serial in self.devices:
+                devices[serial] = self.devices[serial]
+        self.devices = devices
+        return self
+
+    def merge(self, enumeration, statuses, now=None):
+        """
+            Stores what a targeted discovery found without touching the
+            cached enumeration, which still describes the whole network:
+            the enumeration records and freshly fetched statuses of the
+            targets replace their entries, every other device keeps its own.
+            """
+        now = time.time() if now is None else now
+        for record in enumeration:
+            serial = record.get("serial")
+            if serial is None:
+                continue
+            if serial in statuses:
+                self.devices[serial] = {"time": now, "record": record, "status": statuses[serial]}
+            elif serial in self.devices and self.devices[serial].get("record") != record:
+                # Enumerates differently now, the cached status is stale.
+                del self.devices[serial]
+        return self
@@ -11,21 +11,23 @@
 import asyncio
 import datetime
 import logging
-import time
 import urllib
 from collections import OrderedDict
 from enum import Enum
-from functools import reduce, partial
+from functools import reduce
 from types import MethodType
 import json
 import ipaddress
 import os
+import shlex
 
 import aiohttp
 import asyncssh
 
 import SoapySDR
-from pyfaros.ssh import EasySsh
+from pyfaros.discover.cache import TopologyCache
+from pyfaros.ssh import AsyncSshShell
+from pyfaros.ssh_pool import SshConnectionPool
 
 log = logging.getLogger(__name__)
 logging.getLogger("paramiko.transport").setLevel(level=logging.WARNING)
@@ -54,6 +56,20 @@ def is_ipv4(address: str) -> bool:
         return False
 
 
+def trim_status(status, values_to_save):
+    """
+        Recursively keep only the keys of status that appear in values_to_save,
+        a value of None keeps the whole subtree.
+        """
+    if (values_to_save is None or not hasattr(status, 'items')):
+        return status
+    retval = {}
+    for key, value in values_to_save.items():
+        if key in status:
+            retval[key] = trim_status(status[key], value)
+    return retval
+
+
 class _RemoteEnum(Enum):
 
     @staticmethod
@@ -91,16 +107,18 @@ class Remote:
         """
             Async context manager handling an ssh connection for a given device.
             Consider using sshify instead.
+
+            The connection is borrowed from the process wide
+            SshConnectionPool, so it outlives the context for a while and
+            nesting contexts for the same device shares it.
             """
+        if self._ssh_lock is None:
+            self._ssh_lock = asyncio.Lock()
+        pool = SshConnectionPool.default()
         async with self._ssh_lock:
-            try:
-                self.ssh_connection = await asyncssh.connect(
-                    self.address if "[" not in self.address else self.address[1:-1],
-                    username=self.username,
-                    password=self.password,
-                    known_hosts=None,
-                    client_keys=[],
-                )
+            if self._ssh_users == 0:
+                self.ssh_connection = await pool.acquire(
+                    self.ip_address, username=self.username, password=self.password)
 
                 @asynccontextmanager
                 async def _ssh_session_has_connection(self):
@@ -109,10 +127,16 @@ class Remote:
                     yield None
 
                 self.ssh_session = MethodType(_ssh_session_has_connection, self)
-                yield self.ssh_connection
-            finally:
-                self.ssh_connection = None
+            self._ssh_users += 1
+        try:
+            yield self.ssh_connection
+        finally:
+            self._ssh_users -= 1
+            if self._ssh_users == 0:
+                self._close_shell()
+                connection, self.ssh_connection = self.ssh_connection, None
                 self.ssh_session = MethodType(Remote._ssh_session_no_connection, self)
+                pool.release(connection)
 
     @staticmethod
     @asynccontextmanager
@@ -127,7 +151,7 @@ class Remote:
             ])
             yield list(connections)
 
-    def __init__(self, soapy_dict, loop=None):
+    def __init__(self, soapy_dict, loop=None, session=None):
         self.error = False
         self.soapy_dict = soapy_dict
         self.driver = soapy_dict["driver"] if "driver" in soapy_dict else None
@@ -146,15 +170,54 @@ class Remote:
         self.username = None
         self.password = None
         self._json = None  # default no json
-        self._aioloop = loop if loop is not None else asyncio.get_event_loop()
-        # ensure only one connection exists at a time.
-        self._ssh_lock = asyncio.Lock(loop=self._aioloop)
+        self.fetch_error = None  # why the last afetch failed, if it did
+        self.cached = False  # status came from a TopologyCache, not the device
+        # aiohttp session shared with other remotes, owned by whoever created us.
+        self._http_session = session
+        # ensure only one connection exists at a time.  Created on first use
+        # so that it belongs to whichever loop actually runs the connection,
+        # `loop` is only accepted for compatibility.
+        self._ssh_lock = None
+        # Number of ssh_connect contexts currently held.
+        self._ssh_users = 0
         self.ssh_connection = None
         self.ssh_session = MethodType(Remote._ssh_session_no_connection, self)
+        # Future of the AsyncSshShell of the current ssh context.
+        self._shell = None
 
-    def set_variant(self):
+    async def shell(self):
+        """
+            The AsyncSshShell of the current ssh context, started on first
+            use and closed with the context.  Requires an ssh context.
+            """
+        if self._shell is None:
+            self._shell = asyncio.ensure_future(
+                AsyncSshShell.open(self.ssh_connection, self.password))
+        return await self._shell
+
+    def _close_shell(self):
+        shell, self._shell = self._shell, None
+        if shell is None:
+            return
+        if not shell.done():
+            shell.cancel()
+        elif not shell.cancelled() and shell.exception() is None:
+            shell.result().close()
+
+    async def run_many(self, commands, sudo=False, check=True):
+        """
+            Runs commands one after the other in this device's shell, which
+            authenticates sudo once, see AsyncSshShell.run_many.  Requires
+            an ssh context.
+            """
+        return await (await self.shell()).run_many(commands, sudo=sudo, check=check)
+
+    async def async_set_variant(self):
         pass
 
+    def set_variant(self):
+        return asyncio.get_event_loop().run_until_complete(self.async_set_variant())
+
     def set_credentials(self, username, password):
         self.username = username
         self.password = password
@@ -164,36 +227,69 @@ class Remote:
         """
             Asynchronous method to fetch additional information from the device.
             """
+        self.cached = False
         if self._json_url is not None:
             log.debug("coro remote called not none")
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self._json_url) as response:
-                    self._json = await response.json()
-                    logging.debug("json successfully set for url {}".format(
-                        self._json_url))
+            if self._http_session is not None:
+                await self._fetch_json(self._http_session)
+            else:
+                async with aiohttp.ClientSession() as session:
+                    await self._fetch_json(session)
         else:
             log.debug("url was none")
         return self
 
+    def _parse_status(self):
+        """
+            Derive topology information from self._json, raises if the status
+            is not usable.
+            """
+        pass
+
+    def load_status(self, status):
+        """
+            Use a previously fetched status instead of asking the device.
+            Returns self on success and None otherwise, like afetch.
+            """
+        self._json = status
+        try:
+            self._parse_status()
+            self.cached = True
+            return self
+        except Exception as e:
+            log.debug(e)
+            self.fetch_error = e
+            return None
+
+    async def _fetch_json(self, session):
+        async with session.get(self._json_url) as response:
+            self._json = await response.json()
+            logging.debug("json successfully set for url {}".format(
+                self._json_url))
+
     async def _update_sudo_async(self):
         print("{}: updating sudo".format(self.serial))
         return self
 
-    def enable_sudo(self):
-        # While this could be made asynchronous, it is support upgrading old firmware
+    async def async_enable_sudo(self):
+        # Only needed to upgrade old firmware.
         log.debug("{}: Enabling sudo using {}".format(self.serial, self.address))
-        connection = EasySsh(self.serial, self.ip_address, self.username, self.password)
         results = []
         filename = os.path.join(_pyfaros_path, 'enable_sudo.sh')
         tmp_filename = "/tmp/{0}".format(os.path.basename(filename))
-        results.extend((connection.copyFile(filename, tmp_filename) or
-                       "Copied {0} to {1}".format(filename, tmp_filename)).split("\n"))
-        results.extend(connection.runCommand("chmod a+x {}".format(tmp_filename), sudo=True).split("\n" ))
-        results.extend(connection.runCommand(tmp_filename, sudo=True).split("\n"))
+        async with Remote.sshify([self, ]):
+            await asyncssh.scp(filename, (self.ssh_connection, tmp_filename))
+            results.append("Copied {0} to {1}".format(filename, tmp_filename))
+            for _, output, _ in await self.run_many(
+                    ["chmod a+x {}".format(tmp_filename), tmp_filename], sudo=True):
+                results.extend(output.split("\n"))
         for line in results:
             if line:
                 log.debug("{}: {}".format(self.serial, line))
 
+    def enable_sudo(self):
+        return asyncio.get_event_loop().run_until_complete(self.async_enable_sudo())
+
     def __str__(self):
         return self.serial
 
@@ -226,8 +322,8 @@ class CPERemote(Remote):
     class Variant(_RemoteEnum):
         STANDARD = "cpe"
 
-    def __init__(self, soapy_dict, loop=None):
-        super().__init__(soapy_dict, loop=loop)
+    def __init__(self, soapy_dict, loop=None, session=None):
+        super().__init__(soapy_dict, loop=loop, session=session)
         self.rrh_head = None
         # About us, set by us
         self.last_mac = None
@@ -250,19 +346,23 @@ class CPERemote(Remote):
     async def afetch(self):
         try:
             await super().afetch()
-            self.last_mac = int(self._json["extra"]["gateway_addr"], 16)
-            self.uaa_id = self.mac_to_uaa_id(self.last_mac)
-            self.rrh_head = (
-                reduce(
-                    lambda x, y: x[y] if x is not None and y in x else None,
-                    ["sfp", "config", "rrh", "serial"],
-                    self._json,
-                ) is not None)
+            self._parse_status()
             return self
         except Exception as e:
             log.debug(e)
+            self.fetch_error = e
             return None
 
+    def _parse_status(self):
+        self.last_mac = int(self._json["extra"]["gateway_addr"], 16)
+        self.uaa_id = self.mac_to_uaa_id(self.last_mac)
+        self.rrh_head = (
+            reduce(
+                lambda x, y: x[y] if x is not None and y in x else None,
+                ["sfp", "config", "rrh", "serial"],
+                self._json,
+            ) is not None)
+
     def __str__(self):
         return "{: <10} - {: <29} - FW: {} FPGA: {}".format(self.serial, self.address,
                                                    self.firmware, self.fpga)
@@ -273,8 +373,8 @@ class VgerRemote(Remote):
     class Variant(_RemoteEnum):
         VGER = "vger"
 
-    def __init__(self, soapy_dict, loop=None):
-        super().__init__(soapy_dict, loop=loop)
+    def __init__(self, soapy_dict, loop=None, session=None):
+        super().__init__(soapy_dict, loop=loop, session=session)
         self.rrh_head = None
         # About us, set by us
         self.last_mac = None
@@ -296,19 +396,23 @@ class VgerRemote(Remote):
     async def afetch(self):
         try:
             await super().afetch()
-            self.last_mac = int(self._json["extra"]["gateway_addr"], 16)
-            self.uaa_id = self.mac_to_uaa_id(self.last_mac)
-            self.rrh_head = (
-                reduce(
-                    lambda x, y: x[y] if x is not None and y in x else None,
-                    ["sfp", "config", "rrh", "serial"],
-                    self._json,
-                ) is not None)
+            self._parse_status()
             return self
         except Exception as e:
             log.debug(e)
+            self.fetch_error = e
             return None
 
+    def _parse_status(self):
+        self.last_mac = int(self._json["extra"]["gateway_addr"], 16)
+        self.uaa_id = self.mac_to_uaa_id(self.last_mac)
+        self.rrh_head = (
+            reduce(
+                lambda x, y: x[y] if x is not None and y in x else None,
+                ["sfp", "config", "rrh", "serial"],
+                self._json,
+            ) is not None)
+
     def __str__(self):
         return "{: <10} - {: <29} - FPGA: {}".format(self.serial, self.address,
                                                      self.fpga)
@@ -323,8 +427,8 @@ class IrisRemote(Remote):
     #Variant.UE.support_to = [Variant.STANDARD, Variant.RRH]
     NAME = "Iris"
 
-    def __init__(self, soapy_dict, loop=None):
-        super().__init__(soapy_dict, loop=loop)
+    def __init__(self, soapy_dict, loop=None, session=None):
+        super().__init__(soapy_dict, loop=loop, session=session)
         # Unique soapy keys
         self.sfp_serial = soapy_dict.get("sfpSerial", None)
         self.sfp_version = soapy_dict.get("sfpVersion", None)
@@ -360,33 +464,36 @@ class IrisRemote(Remote):
     async def afetch(self):
         try:
             await super().afetch()
-            self.last_mac = int(self._try_get_json('sklk_pl_eth', 'extra')["gateway_addr"], 16)
-            self.uaa_id = self.mac_to_uaa_id(self.last_mac)
-            self.rrh_index = int(self._json["global"]["message_index"]) - 1
-            self.chain_index = int(self._json["global"]["chain_index"])
-            self.rrh_head = (
-                reduce(
-                    lambda x, y: x[y] if x is not None and y in x else None,
-                    ["sfp", "config", "rrh", "serial"],
-                    self._json,
-                ) is not None)
+            self._parse_status()
             return self
         except Exception as e:
             log.debug(e)
+            self.fetch_error = e
             return None
 
-    def _map_to_hub(self, hubs):
+    def _parse_status(self):
+        self.last_mac = int(self._try_get_json('sklk_pl_eth', 'extra')["gateway_addr"], 16)
+        self.uaa_id = self.mac_to_uaa_id(self.last_mac)
+        self.rrh_index = int(self._json["global"]["message_index"]) - 1
+        self.chain_index = int(self._json["global"]["chain_index"])
+        self.rrh_head = (
+            reduce(
+                lambda x, y: x[y] if x is not None and y in x else None,
+                ["sfp", "config", "rrh", "serial"],
+                self._json,
+            ) is not None)
+
+    def _map_to_hub(self, hub):
         """
-            Called in Discover constructor with all discovered hubs, so that a
-            bidirectional mapping can occur, hopefully independently and without
-            error.
+            Called in Discover constructor with the hub our MAC belongs to (see
+            TopologyIndex.hub_for), so that a bidirectional mapping can occur,
+            hopefully independently and without error.
             """
-        for hub in hubs:
-            if self.last_mac in hub.macmatches:
-                if self.hub is not None:
-                    raise AssertionError("Remapping iris from {} to {}".format(
-                        self.hub, hub))
-                self.hub = hub
+        if hub is not None:
+            if self.hub is not None and self.hub is not hub:
+                raise AssertionError("Remapping iris from {} to {}".format(
+                    self.hub, hub))
+            self.hub = hub
         if self.rrh_member is None:
             self.rrh_member = False
 
@@ -402,10 +509,57 @@ class IrisRemote(Remote):
                               self.details())
 
 
+class TopologyIndex:
+    """
+      Hash indexes built once over the discovered hubs, so that irises can be
+      assigned to hubs and chains in a linear pass instead of scanning every
+      hub for every iris.
+      """
+
+    def __init__(self, hubs):
+        self.hubs = list(hubs)
+        self.hub_by_mac = {}
+        self._shared_macs = {}
+        for hub in self.hubs:
+            for mac in hub.macmatches:
+                other = self.hub_by_mac.setdefault(mac, hub)
+                if other is not hub:
+                    self._shared_macs.setdefault(mac, [other, ]).append(hub)
+
+    def hub_for(self, iris):
+        hub = self.hub_by_mac.get(iris.last_mac)
+        if iris.last_mac in self._shared_macs:
+            hubs = self._shared_macs[iris.last_mac]
+            raise AssertionError("Remapping iris from {} to {}".format(hubs[0], hubs[1]))
+        return hub
+
+    def irises_by_hub(self, irises):
+        """ Every hub mapped to the irises directly connected to it, in order. """
+        retval = OrderedDict((hub, []) for hub in self.hubs)
+        for iris in irises:
+            hub = self.hub_by_mac.get(iris.last_mac)
+            if hub is not None:
+                retval[hub].append(iris)
+        return retval
+
+    @staticmethod
+    def group_chains(irises):
+        """ Chain index mapped to the irises on it sorted by rrh_index, in chain order. """
+        chains = {}
+        for iris in irises:
+            chains.setdefault(iris.chain_index, []).append(iris)
+        return OrderedDict(
+            (chain, sorted(chains[chain], key=lambda x: x.rrh_index)) for chain in sorted(chains))
+
+
 class NotAnRRH(Exception):
     pass
 
 
+class ChainPowerError(Exception):
+    pass
+
+
 class RRH:
 
     def __delitem__(self, key):
@@ -504,13 +658,11 @@ class RRH:
 
     async def async_do_reboot(self, recursive=False, force=False):
         # Ignore recursive and use the hub to do a chain reboot
-        cmd = "sudo -n chain_power reboot {}".format(self.chain+1)
-        if self.hub.ssh_connection:
-            await self.hub.ssh_connection.run(cmd, check=True, term_type='xterm')
-        else:
-            async with Remote.sshify([self.hub, ]):
-                await self.hub.ssh_connection.run(cmd, check=True, term_type='xterm')
-
+        results = await self.hub.async_chain_power("reboot", [self.chain, ])
+        status, output = results[self.chain]
+        if status != 0:
+            raise ChainPowerError("chain_power reboot {} on {} exited {}: {}".format(
+                self.chain+1, self.hub.serial, status, output))
         return True
 
 class Chain(OrderedDict):
@@ -518,14 +670,15 @@ class Chain(OrderedDict):
         for device in self.values():
             yield device
 
-    def async_do_reboot(self, recursive, force=False):
-        for device in self.values():
-            device.async_do_reboot()
+    async def async_do_reboot(self, recursive=False, force=False):
+        from pyfaros.reboot.reboot import RebootEngine
+        return await RebootEngine([self, ], recursive, force).run(check=True)
 
     def set_credentials(self, username, password):
         pass
 
 class HubRemote(Remote):
+    NAME = "Hub"
     LAST_POSSIBLE_CHAIN = 7
     REFERENCE_NODE_CHAIN = [6, ]
 
@@ -562,8 +715,8 @@ class HubRemote(Remote):
                         return chain
             return None
 
-    def __init__(self, soapy_dict, loop=None):
-        super().__init__(soapy_dict, loop=loop)
+    def __init__(self, soapy_dict, loop=None, session=None):
+        super().__init__(soapy_dict, loop=loop, session=session)
         self.error = False
         self.cpld = soapy_dict["cpld"] if "cpld" in soapy_dict else None
         url = urllib.parse.urlparse(self.remote)
@@ -586,46 +739,68 @@ class HubRemote(Remote):
         }.get(soapy_dict.get("som", None), HubRemote.Variant.HUB)
         self.chains = OrderedDict()
 
-    def _detect_som_version(self):
-        connection = EasySsh(self.serial, self.address, self.username, self.password)
+    async def _detect_som_version(self):
         codes = {
             "0x24739093": self.Variant.SOM6,
             "0x24738093": self.Variant.SOM9,
         }
-        results = []
-        results.append(connection.runCommand(
-            'su -c "echo 0xffca0040 > /sys/firmware/zynqmp/config_reg"', sudo=True))
-        code = connection.runCommand("cat /sys/firmware/zynqmp/config_reg", sudo=True)
-        connection.runCommand("echo /tmp/version", sudo=True)
-        return codes.get(code, HubRemote.Variant.HUB)
+        async with Remote.sshify([self, ]):
+            _, (_, code, _) = await self.run_many([
+                'su -c "echo 0xffca0040 > /sys/firmware/zynqmp/config_reg"',
+                "cat /sys/firmware/zynqmp/config_reg",
+            ], sudo=True)
+        return codes.get(code.strip(), HubRemote.Variant.HUB)
 
-    def set_variant(self):
+    async def async_set_variant(self):
         if self.variant == HubRemote.Variant.HUB:
-            self.variant = self._detect_som_version()
+            self.variant = await self._detect_som_version()
             log.debug("{}: setting hub variant to {}".format(self.serial, self.variant))
 
+    async def async_chain_power(self, action, chains):
+        """
+            Runs chain_power action (on, off, reboot...) for each of the
+            chain indexes in chains, all in one batch in the hub's shell.
+            Returns an OrderedDict of chain index to (exit status, output),
+            the status is None for chains the shell never got to.
+            """
+        chains = list(OrderedDict.fromkeys(chains))
+        if not chains:
+            return OrderedDict()
+        commands = ["chain_power {} {} 2>&1".format(shlex.quote(action), chain_idx+1)
+                    for chain_idx in chains]
+        # Shares the hub's connection and shell if they're already held.
+        async with Remote.sshify([self, ]):
+            outputs = await self.run_many(commands, sudo=True, check=False)
+        results = OrderedDict(
+            (chain_idx, (status, output)) for chain_idx, (status, output, _) in zip(chains, outputs))
+        for chain_idx, (status, output) in results.items():
+            log.debug("{} - chain_power {} {} exited {}{}".format(
+                self.serial, action, chain_idx+1, status, ":\n" + output if output else ""))
+        return results
+
+    def chain_power(self, action, chains):
+        return asyncio.get_event_loop().run_until_complete(self.async_chain_power(action, chains))
+
     def _update_irises(self):
+        """
+            Blocking, has the hub refresh what its irises report. Run it in an
+            executor and re-fetch the irises afterwards.
+            """
         hub = SoapySDR.Device(self.soapy_dict)
         hub.writeRegister("FAROS_TOP", 0xa0, (0xff << 24))
-        asyncio.get_event_loop().run_until_complete(asyncio.gather(*[iris.afetch() for iris in self._irises]))
 
-    def _map_irises(self, irises):
+    def _needs_update(self):
+        # Cached statuses were stored after this update already happened.
+        return not (self.cached and all(iris.cached for iris in self._irises))
+
+    def _map_irises(self):
         """
-            Given all possible irises, figure out which ones are connected directly
-            to this hub.
+            Organize the irises TopologyIndex.irises_by_hub assigned to this
+            hub into chains.
             """
-        self._irises = list(
-            filter(lambda x: x.last_mac in self.macmatches, irises))
-        self._update_irises()
-
         self._irises_by_serial = dict((iris.serial, iris) for iris in self._irises)
         self._unpaired_nodes = {}
-        for chain in sorted(list({x.chain_index for x in self._irises})):
-            this_chain = list(
-                sorted(
-                    filter(lambda x: x.chain_index == chain, self._irises),
-                    key=lambda x: x.rrh_index,
-                ))
+        for chain, this_chain in TopologyIndex.group_chains(self._irises).items():
             rrhs, error = self.filter_chain_for_bad_indexes(chain, this_chain)
             if error:
                 self.error = True
@@ -685,19 +860,28 @@ class HubRemote(Remote):
             return [this_chain, ], False
 
         error = False
+        remaining = OrderedDict()
+        negative = 0
+        for node in this_chain:
+            remaining.setdefault(node.serial, []).append(node)
+            if node.rrh_index < 0:
+                negative += 1
         heads = RRH.get_heads(this_chain)
         rrhs = []
         for head in heads:
             nodes = []
             for serial in RRH.get_config_from_head(head).get("chain", []):
-                new_chain = []
-                for node in this_chain:
+                # Any bad index among the nodes not claimed yet flags the chain.
+                if negative:
+                    error = True
+                for node in remaining.pop(serial, []):
+                    nodes.append(node)
                     if node.rrh_index < 0:
-                        error = True
-                    (nodes if node.serial == serial else new_chain ).append(node)
-                this_chain = new_chain
+                        negative -= 1
             rrhs.append(nodes)
 
+        claimed = set(id(node) for nodes in rrhs for node in nodes)
+        this_chain = [node for node in this_chain if id(node) not in claimed]
         if this_chain:
             rrhs.append(this_chain)
 
@@ -707,17 +891,21 @@ class HubRemote(Remote):
     async def afetch(self):
         try:
             await super().afetch()
-            # Get last-3's of macaddress
-            self.macmatches = [
-                int("".join(reversed(k[3::])), 16)
-                for k in map(lambda x: x.split(":"), self._try_get_json('jtagblob', 'config')
-                             ["network"].values())
-            ]
+            self._parse_status()
             return self
         except Exception as e:
             log.debug(e)
+            self.fetch_error = e
             return None
 
+    def _parse_status(self):
+        # Get last-3's of macaddress
+        self.macmatches = [
+            int("".join(reversed(k[3::])), 16)
+            for k in map(lambda x: x.split(":"), self._try_get_json('jtagblob', 'config')
+                         ["network"].values())
+        ]
+
     def __iter__(self):
         try:
             yield self
@@ -746,23 +934,222 @@ class HubRemote(Remote):
         yield self
 
     async def async_do_reboot(self, recursive=False, force=False):
-        async with Remote.sshify([self, ]):
-            from pyfaros.updater.updater import do_reboot
-            if force:
-                for chain_idx in range(self.LAST_POSSIBLE_CHAIN):
-                    if chain_idx in self.REFERENCE_NODE_CHAIN:
-                        device = self.chains[chain_idx]
-                        await device.async_do_reboot(recursive, force)
-                    else:
-                        cmd = "sudo -n chain_power reboot {}".format(chain_idx+1)
-                        await self.ssh_connection.run(cmd, check=True, term_type='xterm')
-            else:
-                for device in self.walk(depth=1 if recursive else 0):
-                    if device != self:
-                        await device.async_do_reboot(recursive, force)
+        # Chains first, then the hub, see RebootEngine.
+        from pyfaros.reboot.reboot import RebootEngine
+        return await RebootEngine([self, ], recursive, force).run(check=True)
+
+class SoapyEnumerator:
+    """
+      Runs SoapySDR.Device.enumerate() passes in an executor and streams every
+      newly seen serial as soon as the pass that found it returns.
+
+      Avahi broadcasts occasionally don't respond in time, so more than one
+      pass is needed to get a good picture. Passes run back-to-back (or
+      `concurrency` at a time) until one of the following happens:
+        - `passes` enumerations have completed,
+        - a pass found nothing new and the serial set has been stable for
+          `quiet_ms`, if given (0 stops at the first pass adding nothing),
+        - `deadline_ms` has elapsed since the first pass was started.
+      """
+
+    def __init__(self, args, passes=3, quiet_ms=None, deadline_ms=None, concurrency=1):
+        self.args = args
+        self.passes = passes
+        self.quiet_ms = quiet_ms
+        self.deadline_ms = deadline_ms
+        self.concurrency = max(1, concurrency)
+        self.found = OrderedDict()
+
+    def _remaining(self, loop, start):
+        if self.deadline_ms is None:
+            return None
+        return max(0.0, self.deadline_ms / 1000.0 - (loop.time() - start))
+
+    async def stream(self):
+        """
+            Async generator yielding the soapy dict of each serial the first
+            time it is enumerated.
+            """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        last_change = start
+        launched = 0
+        pending = set()
+        while True:
+            while launched < self.passes and len(pending) < self.concurrency:
+                pending.add(loop.run_in_executor(None, SoapySDR.Device.enumerate, self.args))
+                launched += 1
+            if not pending:
+                break
+            remaining = self._remaining(loop, start)
+            if remaining is not None and remaining <= 0:
+                log.debug("enumeration deadline reached after {} passes".format(launched))
+                break
+            done, pending = await asyncio.wait(
+                pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            changed = False
+            for future in done:
+                try:
+                    results = future.result()
+                except Exception as e:
+                    log.debug("enumeration pass failed: {}".format(e))
+                    continue
+                for found in map(dict, results):
+                    if "serial" in found and found["serial"] not in self.found:
+                        self.found[found["serial"]] = found
+                        changed = True
+                        yield found
+            if changed:
+                last_change = loop.time()
+            elif (done and self.quiet_ms is not None
+                  and (loop.time() - last_change) * 1000 >= self.quiet_ms):
+                log.debug("enumeration stable after {} passes".format(launched))
+                break
+        # Passes already running in the executor can't be interrupted, their
+        # results are simply dropped.
+        for future in pending:
+            future.cancel()
+
+    async def run(self):
+        async for _ in self.stream():
+            pass
+        return list(self.found.values())
+
+
+class TargetedEnumerator(SoapyEnumerator):
+    """
+      Enumerates only the devices matching `queries`, SoapySDR kwargs holding
+      a "serial" filter or a "remote" address, with every query running at
+      once in the executor.  A "remote" query contacts that server directly
+      instead of searching the whole network.
+
+      Queries which matched nothing are retried for up to `passes` rounds,
+      those which never matched are left in `unmatched`.
+      """
+
+    def __init__(self, queries, passes=3, deadline_ms=None):
+        super().__init__(None, passes=passes, deadline_ms=deadline_ms)
+        self.queries = list(queries)
+        self.unmatched = list(self.queries)
+
+    async def stream(self):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        for _ in range(self.passes):
+            if not self.unmatched:
+                break
+            pending = dict(
+                (loop.run_in_executor(None, SoapySDR.Device.enumerate, query), query)
+                for query in self.unmatched)
+            unmatched = []
+            while pending:
+                remaining = self._remaining(loop, start)
+                if remaining is not None and remaining <= 0:
+                    break
+                done, _ = await asyncio.wait(
+                    list(pending), timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    query = pending.pop(future)
+                    try:
+                        results = list(map(dict, future.result()))
+                    except Exception as e:
+                        log.debug("enumeration of {} failed: {}".format(dict(query), e))
+                        results = []
+                    if not results:
+                        unmatched.append(query)
+                    for found in results:
+                        if "serial" in found and found["serial"] not in self.found:
+                            self.found[found["serial"]] = found
+                            yield found
+            for future, query in pending.items():
+                future.cancel()
+                unmatched.append(query)
+            self.unmatched = unmatched
+            if pending:
+                log.debug("targeted enumeration deadline reached")
+                break
+
+
+class ReplayEnumerator:
+    """
+      Streams previously enumerated soapy dicts (for instance from a
+      TopologyCache) through the same interface as SoapyEnumerator.
+      """
+
+    def __init__(self, records):
+        self.found = OrderedDict(
+            (record["serial"], record) for record in records if "serial" in record)
+
+    async def stream(self):
+        for found in list(self.found.values()):
+            yield found
+
+    async def run(self):
+        return list(self.found.values())
+
+
+class FetchScheduler:
+    """
+      Runs Remote.afetch() calls with at most `concurrency` of them in flight,
+      a `timeout_ms` limit on every attempt and up to `retries` retries with
+      exponential backoff starting at `backoff_ms`.  Only timeouts and
+      connection errors are retried, a status which can't be used (an
+      incompatible or unparsable status.json) won't get any better.
+
+      A device that never answers is not dropped silently: the reason is left
+      in its `fetch_error` and the device is appended to `failed`, so callers
+      can report a partial result.
+      """
+
+    def __init__(self, concurrency=32, timeout_ms=2000, retries=2, backoff_ms=250):
+        self.concurrency = concurrency
+        self.timeout_ms = timeout_ms
+        self.retries = retries
+        self.backoff_ms = backoff_ms
+        self.failed = []
+        self._semaphore = None
+
+    async def _attempt(self, remote):
+        async with self._semaphore:
+            try:
+                return await asyncio.wait_for(remote.afetch(), self.timeout_ms / 1000.0)
+            except asyncio.TimeoutError:
+                remote.fetch_error = asyncio.TimeoutError(
+                    "no status after {} ms".format(self.timeout_ms))
+            except Exception as e:
+                remote.fetch_error = e
+            return None
+
+    @staticmethod
+    def _transient(error):
+        return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, OSError))
+
+    async def fetch(self, remote):
+        # Created here so that it belongs to the loop running the fetches.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        delay = self.backoff_ms / 1000.0
+        for attempt in range(self.retries + 1):
+            if attempt:
+                log.debug("{}: retrying status fetch in {} s ({})".format(
+                    remote.serial, delay, remote.fetch_error))
+                await asyncio.sleep(delay)
+                delay *= 2
+            remote.fetch_error = None
+            result = await self._attempt(remote)
+            if result is not None:
+                return result
+            if not self._transient(remote.fetch_error):
+                break
+        log.warning("{}: unable to fetch status after {} attempts: {}".format(
+            remote.serial, attempt + 1, remote.fetch_error))
+        if remote not in self.failed:
+            self.failed.append(remote)
+        return None
+
+    async def gather(self, remotes):
+        return await asyncio.gather(*[self.fetch(remote) for remote in remotes])
 
-            print("Rebooting {}".format(self.serial))
-            await do_reboot(self)
 
 class Discover:
     """
@@ -771,127 +1158,252 @@ class Discover:
       results such that one can query for devices on a hub channel, by chain
       order, etc. Warning: in case you missed that, this constructor will block
       on IO.
+
+      Enumeration runs `soapy_enumerate_iterations` passes, stopping early
+      once the set of serials has been stable for `enumerate_quiet_ms` if
+      given, or once `enumerate_deadline_ms` has elapsed, see SoapyEnumerator.
+
+      All status fetches share a single aiohttp session whose connector allows
+      at most `http_limit` connections in total and `http_limit_per_host` to
+      any one device. Fetches go through a FetchScheduler, devices which never
+      answered are listed in `failed`.
+
+      Given a TopologyCache, a recent cached enumeration replaces the network
+      scan and cached statuses replace the fetches of devices that did not
+      change. The cache is updated with the result afterwards.
+
+      refresh() repeats the discovery on the same object and reports what
+      changed since the previous one, see snapshot and diff.
+
+      From a coroutine use `await Discover.create(...)` and arefresh()
+      instead, these run on the caller's loop rather than blocking it.
+
+      Given `serials` and/or `addresses` only those devices are enumerated
+      and fetched (see TargetedEnumerator), along with the hub and chain
+      they belong to when a TopologyCache knows them.  If a target can't be
+      found that way the whole network is scanned after all.
       """
 
-    def __init__(self, soapy_enumerate_iterations=3, output=None, timeout_ms=800, ipv6=False, json_filename=None):
-        self.time = datetime.datetime.now()
-        # Grab an event loop so that we can get all of the json additional
-        # information at once.
-        self._loop = asyncio.new_event_loop()
+    def __init__(self, *args, **kwargs):
+        # The arguments and their defaults are those of _setup.
+        self._run_blocking(self._start(self._setup(*args, **kwargs)))
+
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        """
+            Coroutine alternative to the constructor, taking the same
+            arguments.  Enumeration runs in the default executor and the
+            fetches on the calling loop, so discovery can overlap with other
+            work on that loop instead of blocking it.
+            """
+        self = cls.__new__(cls)
+        await self._start(self._setup(*args, **kwargs))
+        return self
+
+    @staticmethod
+    def _run_blocking(coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def _setup(self, soapy_enumerate_iterations=3, output=None, timeout_ms=800, ipv6=False, json_filename=None,
+               enumerate_quiet_ms=None, enumerate_deadline_ms=None, enumerate_concurrency=1,
+               http_limit=64, http_limit_per_host=2,
+               fetch_concurrency=32, fetch_timeout_ms=2000, fetch_retries=2, cache=None,
+               serials=None, addresses=None):
+        """
+            Stores the options shared by every run and returns the enumerator
+            for the first one.  Takes the arguments of the constructor and
+            create.
+            """
         self._yaml = False
         self._json_out = False
         self._json_filename = json_filename
-        # Avahi broadcasts occasionally don't respond in time. Do it with a
-        # long timeout, and do it a lot, to try to get a good picture.
-        soapy_enumerations = {}
-        for _ in range(0, soapy_enumerate_iterations):
-            args = SoapySDR.SoapySDRKwargs()
-            args['remote:timeout'] = str(timeout_ms * 1000)
-
-            if ipv6:
-                args['remote:ipver'] = '6'
-
-            for found in map(dict, SoapySDR.Device.enumerate(args)):
-                if "serial" in found and found["serial"] not in soapy_enumerations:
-                    soapy_enumerations[found["serial"]] = found
-            time.sleep(1)
-        self._soapy_enumerate = list(soapy_enumerations.values())
-
-        # Filter for hubs and irises
-        # FIXME: Hacks here until all cpes have a sane fpga string.
-        self._irises = list(
-            map(
-                partial(IrisRemote, loop=self._loop),
-                filter(
-                    lambda x: "remote:type" in
-                    x.keys() and "iris" in x["remote:type"] and "serial" in x.keys()
-                    and "CP" not in x["serial"],
-                    self._soapy_enumerate,
-                ),
-            ))
+        self._cache = cache
+        self._ipv6 = ipv6
+        self._serials = list(serials or [])
+        self._addresses = list(addresses or [])
+        self._enumerate_options = {
+            "timeout_ms": timeout_ms,
+            "passes": soapy_enumerate_iterations,
+            "quiet_ms": enumerate_quiet_ms,
+            "deadline_ms": enumerate_deadline_ms,
+            "concurrency": enumerate_concurrency,
+        }
+        self._http_limits = (http_limit, http_limit_per_host)
+        self._fetch_options = {
+            "concurrency": fetch_concurrency,
+            "timeout_ms": fetch_timeout_ms,
+            "retries": fetch_retries,
+        }
+        # Statuses from previous runs so that refresh() only fetches devices
+        # which appeared or changed.  Kept in memory, never saved.
+        self._memory = TopologyCache()
+        enumerator = None
+        records = None
+        if self._cache is not None:
+            self._cache.load(ipv6=ipv6)
+            records = self._cache.enumeration
+            if self._targeted:
+                records = self._context_records()
+            if records is not None and self._cache.enumeration_fresh():
+                log.debug("Using enumeration cached in {}".format(self._cache.path))
+                enumerator = ReplayEnumerator(records)
+        if enumerator is None and self._targeted:
+            enumerator = self._targeted_enumerator(records)
 
-        # FIXME: change this when fpga strings are sane
-        self._cpes = list(
-            map(
-                partial(CPERemote, loop=self._loop),
-                filter(
-                    lambda x: "remote:type" in x.keys() and "cpe" in x["remote:type"] and
-                     "serial" in x.keys() and "CP" in x["serial"],
-                    self._soapy_enumerate,
-                ),
-            ))
+        # Display options
+        if output:
+            self.single_field = output
+        else:
+            self.single_field = ""
+        self.delim = " "
+        return enumerator if enumerator is not None else self._soapy_enumerator()
 
-        # FIXME: confirm correct strings for this
-        self._vgers = list(
-            map(
-                partial(VgerRemote, loop=self._loop),
-                filter(
-                    lambda x: "remote:type" in x.keys() and "cpe" in x["remote:type"] and
-                     "serial" in x.keys() and "VG" in x["serial"],
-                    self._soapy_enumerate,
-                ),
-            ))
-
-        self._hubs = list(
-            map(
-                partial(HubRemote, loop=self._loop),
-                filter(
-                    lambda x: "remote:type" in x.keys() and "faros" in x[
-                        "remote:type"],
-                    self._soapy_enumerate,
-                ),
-            ))
-        # Stage up the fetches
-        iris_fetch_tasks = asyncio.gather(
-            *map(
-                lambda x: asyncio.ensure_future(x.afetch(), loop=self._loop),
-                self._irises,
-            ),
-            loop=self._loop)
-        cpe_fetch_tasks = asyncio.gather(
-            *map(
-                lambda x: asyncio.ensure_future(x.afetch(), loop=self._loop),
-                self._cpes,
-            ),
-            loop=self._loop)
-        vger_fetch_tasks = asyncio.gather(
-            *map(
-                lambda x: asyncio.ensure_future(x.afetch(), loop=self._loop),
-                self._vgers,
-            ),
-            loop=self._loop)
-        hub_fetch_tasks = asyncio.gather(
-            *map(
-                lambda x: asyncio.ensure_future(x.afetch(), loop=self._loop),
-                self._hubs,
-            ),
-            loop=self._loop)
-        # Go, go, go!
-        fetchall = asyncio.ensure_future(
-            asyncio.gather(
-                iris_fetch_tasks, hub_fetch_tasks, cpe_fetch_tasks, vger_fetch_tasks,
-                loop=self._loop),
-            loop=self._loop,
-        )
-        self._all = self._loop.run_until_complete(fetchall)
-        self._loop.close()
-        # Doing this bidirectionally so that neither class modifies the other,
-        # it can be more efficient than this, but looping over each provides
-        # the opportunity to catch inconsistencies and detect strange
-        # scenarios.
-        for hub in self._hubs:
-            hub._map_irises(self._irises)
-        for iris in self._irises:
-            iris._map_to_hub(self._hubs)
-        self._rrhs = list(
-            filter(
-                Discover.Filters.RRH,
-                reduce(
-                    lambda x, y: x + y,
-                    [list(hub.chains.values()) for hub in self._hubs],
-                    [],
-                ),
-            ))
+    @property
+    def _targeted(self):
+        return bool(self._serials or self._addresses)
+
+    def _soapy_args(self, **kwargs):
+        args = SoapySDR.SoapySDRKwargs()
+        args['remote:timeout'] = str(self._enumerate_options["timeout_ms"] * 1000)
+
+        if self._ipv6:
+            args['remote:ipver'] = '6'
+        for key, value in kwargs.items():
+            args[key] = value
+        return args
+
+    def _soapy_enumerator(self):
+        if self._targeted:
+            return self._targeted_enumerator(
+                self._context_records() if self._cache is not None else None)
+        return SoapyEnumerator(
+            self._soapy_args(),
+            passes=self._enumerate_options["passes"],
+            quiet_ms=self._enumerate_options["quiet_ms"],
+            deadline_ms=self._enumerate_options["deadline_ms"],
+            concurrency=self._enumerate_options["concurrency"])
+
+    def _targeted_enumerator(self, records=None):
+        """
+            Enumerates the targets only: the known addresses of `records` when
+            they were resolved from the cache, a serial filter otherwise.
+            """
+        if records is not None:
+            queries = [
+                self._soapy_args(remote=record["remote"]) if "remote" in record else
+                self._soapy_args(serial=record["serial"]) for record in records
+            ]
+        else:
+            queries = [self._soapy_args(serial=serial) for serial in self._serials]
+            queries.extend(self._soapy_args(remote=address) for address in self._addresses)
+        return TargetedEnumerator(
+            queries,
+            passes=self._enumerate_options["passes"],
+            deadline_ms=self._enumerate_options["deadline_ms"])
+
+    def _context_records(self):
+        """
+            Uses the cache to expand the targets to what is needed to place
+            them in the topology: an Iris (or RRH) brings its hub and the
+            other nodes on its chain, a hub brings every node connected to it.
+            Returns the cached enumeration records of all of those, or None
+            if a target is not in the cache.
+            """
+        remotes = OrderedDict()
+        for serial, entry in self._cache.devices.items():
+            for _, remote_type, matches in self.REMOTE_TYPES:
+                if matches(entry.get("record", {})):
+                    remote = remote_type(entry["record"])
+                    if remote.load_status(entry.get("status")) is not None:
+                        remotes[serial] = remote
+                    break
+        irises = [remote for remote in remotes.values() if isinstance(remote, IrisRemote)]
+        index = TopologyIndex(remote for remote in remotes.values() if isinstance(remote, HubRemote))
+        rrh_heads = dict(
+            (RRH.get_config_from_head(iris).get("serial"), iris)
+            for iris in irises if iris.rrh_head)
+        by_address = dict((remote.ip_address, remote) for remote in remotes.values() if remote.address)
+
+        selected = OrderedDict()
+        for target in self._serials + self._addresses:
+            remote = remotes.get(target, rrh_heads.get(target, by_address.get(target)))
+            if remote is None:
+                log.debug("{} is not in the topology cache".format(target))
+                return None
+            selected[remote.serial] = remote
+            if isinstance(remote, IrisRemote):
+                hub = index.hub_by_mac.get(remote.last_mac)
+                if hub is not None:
+                    selected[hub.serial] = hub
+                for iris in irises:
+                    if iris.last_mac == remote.last_mac and iris.chain_index == remote.chain_index:
+                        selected[iris.serial] = iris
+            elif isinstance(remote, HubRemote):
+                for iris in index.irises_by_hub(irises).get(remote, []):
+                    selected[iris.serial] = iris
+        return [remote.soapy_dict for remote in selected.values()]
+
+    def _unresolved_targets(self, enumerator):
+        known = set()
+        for device in self:
+            known.add(getattr(device, "serial", None))
+        for device in self._irises + self._cpes + self._vgers + self._hubs:
+            known.add(device.serial)
+        unresolved = [serial for serial in self._serials if serial not in known]
+        unresolved.extend(dict(query) for query in getattr(enumerator, "unmatched", []))
+        return unresolved
+
+    async def _start(self, enumerator):
+        await self._run(enumerator)
+        if self._targeted:
+            unresolved = self._unresolved_targets(enumerator)
+            if unresolved:
+                log.info("Unable to find {} directly, scanning the whole network".format(unresolved))
+                self._serials = []
+                self._addresses = []
+                await self._run(self._soapy_enumerator())
+
+    async def _run(self, enumerator):
+        """
+            Enumerates, fetches and builds the topology, replacing the result
+            of any previous run.
+            """
+        self.time = datetime.datetime.now()
+        self._irises = []
+        self._cpes = []
+        self._vgers = []
+        self._hubs = []
+        self._scheduler = FetchScheduler(**self._fetch_options)
+        # One pooled session is shared by every fetch, it stays open until the
+        # hubs have re-fetched their irises so those requests reuse the
+        # keep-alive connections.
+        self._http_session = self._open_http_session(*self._http_limits)
+        try:
+            # Go, go, go!
+            self._all = await self._discover(enumerator)
+            # Doing this bidirectionally so that neither class modifies the other,
+            # looping over each provides the opportunity to catch
+            # inconsistencies and detect strange scenarios.
+            for hub in self._hubs:
+                hub._map_irises()
+            for iris in self._irises:
+                iris._map_to_hub(self._index.hub_for(iris))
+            self._memory.update(self._soapy_enumerate, self._fetched_statuses())
+            if self._cache is not None:
+                self._update_cache(replayed=isinstance(enumerator, ReplayEnumerator))
+        finally:
+            await self._http_session.close()
+            self._http_session = None
+            for dev in self._irises + self._cpes + self._vgers + self._hubs:
+                dev._http_session = None
+        self._rrhs = [
+            chain for hub in self._hubs for chain in hub.chains.values()
+            if Discover.Filters.RRH(chain)
+        ]
         self._standalone_irises = list(
             filter(Discover.Filters.IRIS_STANDALONE, self._irises))
         self._partial_chain_irises = list(
@@ -899,12 +1411,178 @@ class Discover:
         self._rrh_member_irises = list(
             filter(Discover.Filters.IRIS_RRHMEMBER, self._irises))
 
-        # Display options
-        if output:
-            self.single_field = output
+    def refresh(self, status_ttl_s=300):
+        """
+            Enumerates the network again and rebuilds the topology in place.
+            Only devices which appeared, enumerate differently than before, or
+            whose status is older than `status_ttl_s` are fetched again.
+            Returns the changes as a list of events, see Discover.diff.
+            """
+        return self._run_blocking(self.arefresh(status_ttl_s=status_ttl_s))
+
+    async def arefresh(self, status_ttl_s=300):
+        """ Coroutine version of refresh, runs on the calling loop. """
+        before = self.snapshot()
+        self._memory.status_ttl_s = status_ttl_s
+        await self._run(self._soapy_enumerator())
+        return self.diff(before, self.snapshot())
+
+    # Maps an enumerated soapy dict to the list it belongs in and the Remote
+    # class representing it.
+    REMOTE_TYPES = [
+        # FIXME: Hacks here until all cpes have a sane fpga string.
+        ("_irises", IrisRemote,
+         lambda x: "remote:type" in x.keys() and "iris" in x["remote:type"] and
+         "serial" in x.keys() and "CP" not in x["serial"]),
+        # FIXME: change this when fpga strings are sane
+        ("_cpes", CPERemote,
+         lambda x: "remote:type" in x.keys() and "cpe" in x["remote:type"] and
+         "serial" in x.keys() and "CP" in x["serial"]),
+        # FIXME: confirm correct strings for this
+        ("_vgers", VgerRemote,
+         lambda x: "remote:type" in x.keys() and "cpe" in x["remote:type"] and
+         "serial" in x.keys() and "VG" in x["serial"]),
+        ("_hubs", HubRemote,
+         lambda x: "remote:type" in x.keys() and "faros" in x["remote:type"]),
+    ]
+
+    @staticmethod
+    def _open_http_session(limit, limit_per_host):
+        connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host)
+        return aiohttp.ClientSession(connector=connector)
+
+    async def _discover(self, enumerator):
+        """
+            Turns each newly enumerated device into a Remote and schedules its
+            status fetch immediately, so that HTTP I/O overlaps with the
+            remaining enumeration passes.
+            """
+        self._irises = []
+        self._cpes = []
+        self._vgers = []
+        self._hubs = []
+        fetches = []
+        async for found in enumerator.stream():
+            for attr, remote_type, matches in self.REMOTE_TYPES:
+                if matches(found):
+                    remote = remote_type(found, session=self._http_session)
+                    getattr(self, attr).append(remote)
+                    status = self._known_status(found)
+                    if status is not None and remote.load_status(status) is not None:
+                        continue
+                    fetches.append(asyncio.ensure_future(self._scheduler.fetch(remote)))
+        self._soapy_enumerate = list(enumerator.found.values())
+        fetched = await asyncio.gather(*fetches)
+        await self._update_hubs()
+        return fetched
+
+    async def _update_hubs(self):
+        """
+            Has every hub refresh what its irises report and re-fetches them.
+            The blocking register writes run concurrently in the executor and
+            the re-fetches of all hubs go out as one batch, so this takes as
+            long as the slowest hub.
+            """
+        loop = asyncio.get_event_loop()
+        self._index = TopologyIndex(self._hubs)
+        for hub, irises in self._index.irises_by_hub(self._irises).items():
+            hub._irises = irises
+        hubs = [hub for hub in self._hubs if hub._irises and hub._needs_update()]
+        results = await asyncio.gather(
+            *[loop.run_in_executor(None, hub._update_irises) for hub in hubs],
+            return_exceptions=True)
+        irises = []
+        for hub, result in zip(hubs, results):
+            if isinstance(result, Exception):
+                log.warning("{}: unable to update irises: {}".format(hub.serial, result))
+            irises.extend(hub._irises)
+        await self._scheduler.gather(irises)
+
+    def _known_status(self, found):
+        for cache in (self._cache, self._memory):
+            status = cache.status_for(found) if cache is not None else None
+            if status is not None:
+                return status
+        return None
+
+    def _fetched_statuses(self):
+        """ Trimmed statuses of the devices fetched during the last run. """
+        statuses = {}
+        for dev in self._irises + self._cpes + self._vgers + self._hubs:
+            if dev._json is not None and not dev.cached and dev not in self._scheduler.failed:
+                statuses[dev.serial] = trim_status(dev._json, self.TEST_CONFIG_FORMAT)
+        return statuses
+
+    def _update_cache(self, replayed=False):
+        if self._targeted:
+            # Only a subset of the network was enumerated.
+            self._cache.merge(self._soapy_enumerate, self._fetched_statuses())
         else:
-            self.single_field = ""
-        self.delim = " "
+            self._cache.update(
+                self._soapy_enumerate, self._fetched_statuses(),
+                enumerated_at=self._cache.enumerated_at if replayed else None)
+        try:
+            self._cache.save()
+        except (IOError, OSError) as e:
+            log.warning("Unable to write topology cache {}: {}".format(self._cache.path, e))
+
+    @property
+    def failed(self):
+        """ Devices that were enumerated but whose status could not be fetched. """
+        return list(self._scheduler.failed)
+
+    def snapshot(self):
+        """
+            Summarizes the topology as a dict keyed by (kind, id) where kind is
+            one of "hub", "rrh", "chain" or "client".  Values are plain JSON
+            serializable dicts so two snapshots can be compared with diff.
+            """
+        def device(dev):
+            return {"type": dev.NAME, "address": dev.address, "firmware": dev.firmware, "fpga": dev.fpga}
+
+        retval = OrderedDict()
+        for hub in self._hubs:
+            retval[("hub", hub.serial)] = device(hub)
+            for chidx in sorted(hub.chains.keys()):
+                chains = hub.chains[chidx]
+                for chain in chains if type(chains) is list else [chains, ]:
+                    if isinstance(chain, RRH) and chain.serial:
+                        irises = list(chain)
+                        key = ("rrh", chain.serial)
+                    elif isinstance(chain, Chain) and len(chain) > 0:
+                        irises = [chain[k] for k in sorted(chain.keys())]
+                        key = ("chain", "{}:{}".format(hub.serial, chidx+1))
+                    else:
+                        continue
+                    retval[key] = {
+                        "hub": hub.serial,
+                        "chain": chidx+1 if chidx < hub.LAST_POSSIBLE_CHAIN else None,
+                        "nodes": [iris.serial for iris in irises],
+                        "firmware": self.get_common(irises, 'firmware'),
+                        "fpga": self.get_common(irises, 'fpga'),
+                    }
+        for dev in self._standalone_irises + self._cpes + self._vgers:
+            retval[("client", dev.serial)] = device(dev)
+        return retval
+
+    @staticmethod
+    def diff(before, after):
+        """
+            Compares two snapshots and returns a list of events, dicts with
+            "event" ("added", "removed" or "changed"), "kind", "id" and the
+            new "value" (the old one for removals).
+            """
+        events = []
+        for (kind, ident), value in after.items():
+            if (kind, ident) not in before:
+                events.append({"event": "added", "kind": kind, "id": ident, "value": value})
+            elif before[(kind, ident)] != value:
+                events.append({"event": "changed", "kind": kind, "id": ident, "value": value,
+                               "previous": before[(kind, ident)]})
+        for (kind, ident), value in before.items():
+            if (kind, ident) not in after:
+                events.append({"event": "removed", "kind": kind, "id": ident, "value": value})
+        return events
 
     def set_options(self, yaml=None, json_out=None):
         if yaml is not None:
@@ -1030,6 +1708,13 @@ class Discover:
             self._display_stand_alone(t, clients, c, self._cpes)
             self._display_stand_alone(t, clients, c, self._vgers)
 
+        if self.failed:
+            unavailable = c()
+            t.create_node("Status Unavailable", unavailable, parent=first_node)
+            for device in self.failed:
+                t.create_node("{} {}: {}".format(device.NAME, device.serial, device.fetch_error),
+                              c(), parent=unavailable)
+
         return str(t)
 
     def _as_yaml(self):
@@ -1108,6 +1793,7 @@ class Discover:
         return json.dumps(config, indent = 4)
 
     # To save more fields on the test dump, add the values to this dictionary.
+    # The topology cache keeps the same fields.
     TEST_CONFIG_FORMAT = {
         "sfp": {
             "config": None
@@ -1126,16 +1812,7 @@ class Discover:
         # Get the json data for each device.  Cannot use iter because some bugs will cause the
         # data to not be mapped correctly.
         for dev in self._irises + self._cpes + self._vgers + self._hubs:
-            status[dev.serial] = {}
-            def save_config(config, values_to_save : dict):
-                if (values_to_save is None or not hasattr(config, 'items')):
-                    return config
-                retval = {}
-                for key, value in values_to_save.items():
-                    if key in config:
-                        retval[key] = save_config(config[key], values_to_save[key])
-                return retval
-            status[dev.serial] = save_config(dev._json, self.TEST_CONFIG_FORMAT)
+            status[dev.serial] = trim_status(dev._json, self.TEST_CONFIG_FORMAT)
 
         with open(filename, "w+") as fptr:
             json.dump({
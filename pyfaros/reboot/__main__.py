@@ -16,6 +16,7 @@ import logging
 import pkg_resources
 import datetime
 from pyfaros.discover.discover import Discover
+from pyfaros.discover.cache import TopologyCache
 from pyfaros.reboot.reboot import do_reboot
 
 __discover_description = """\
@@ -62,6 +63,30 @@ general_options.add_argument(
 )
 
 advanced_options = parser.add_argument_group("Advanced Options")
+advanced_options.add_argument(
+    '--cache',
+    action='store_true',
+    help='Start from the topology cached by a recent run and only re-check devices that changed.',
+)
+advanced_options.add_argument(
+    '--max-parallel',
+    type=int,
+    default=16,
+    help='Maximum number of reboots issued at once, 0 for no limit.',
+)
+advanced_options.add_argument(
+    '-w', '--wait',
+    type=int,
+    default=0,
+    metavar='TIMEOUT',
+    help='Wait up to this many seconds for the rebooted devices to come back.',
+)
+advanced_options.add_argument(
+    '--poll-interval',
+    type=float,
+    default=15,
+    help='The longest interval (in seconds) between checks of a device that is not back yet.',
+)
 advanced_options.add_argument(
     '--prefer-ipv6',
     action='store_true',
@@ -76,11 +101,17 @@ else:
     logging.basicConfig(level=logging.INFO)
     logging.getLogger("asyncssh").setLevel(level=logging.WARN)
 
-top = Discover(soapy_enumerate_iterations=1, ipv6=parsed.prefer_ipv6)
+# Recursive and forced reboots need everything connected to the targets,
+# including the chains of a hub, which only a full scan finds.
+top = Discover(soapy_enumerate_iterations=1, ipv6=parsed.prefer_ipv6,
+               cache=TopologyCache() if parsed.cache else None,
+               serials=None if (parsed.recursive or parsed.force) else parsed.serial)
 for device in top:
     device.set_credentials(parsed.user, parsed.password)
 
 devices = [device for device in top if device.serial in parsed.serial]
-do_reboot(devices, recursive=parsed.recursive, force=parsed.force)
+success = do_reboot(devices, recursive=parsed.recursive, force=parsed.force,
+                    concurrency=parsed.max_parallel or None, timeout=parsed.wait,
+                    interval=parsed.poll_interval)
 
-sys.exit(0)
+sys.exit(0 if success else 1)
@@ -8,13 +8,174 @@
 #
 # Copyright (c) 2020, 2021 Skylark Wireless.
 import asyncio
-from pyfaros.discover.discover import Remote
+import logging
+from collections import OrderedDict
 
-async def async_do_reboot(devices, recursive=False, force=False):
-    for device in devices:
-        await device.async_do_reboot(recursive=recursive)
+from pyfaros.discover.discover import Remote, HubRemote, RRH, Chain, ChainPowerError
+from pyfaros.ssh_pool import SshConnectionPool
+from pyfaros.updater.updater import do_reboot as _systemctl_reboot, RebootTracker
 
-def do_reboot(devices, recursive=False, force=False):
+log = logging.getLogger(__name__)
+
+
+class RebootEngine:
+    """
+    Reboots devices level by level so that nothing loses power or its
+    network path while it is still being told to reboot: first the nodes,
+    then the chains power cycled by their hub, all of a hub's chains in one
+    batch in its shell, then the hubs.  Within a level every reboot is issued at
+    once, at most `concurrency` at a time (None for no limit), so a whole
+    site takes about one round-trip per level.
+
+    A hub reboots the chains under it when `recursive`, and every chain
+    whether detected or not when `force`.  A node on a chain which gets
+    power cycled anyway is not rebooted on its own.  A failed reboot is
+    logged and recorded in `failures` without stopping the others.
+    """
+
+    def __init__(self, devices, recursive=False, force=False, concurrency=16):
+        self.recursive = recursive
+        self.force = force
+        self.concurrency = concurrency
+        self.nodes = OrderedDict()
+        # hub serial -> (hub, chain indexes to power cycle)
+        self.chains = OrderedDict()
+        self.hubs = OrderedDict()
+        self.failures = OrderedDict()
+        for device in devices:
+            self._add(device)
+        self._drop_power_cycled_nodes()
+
+    def _add(self, device):
+        if isinstance(device, list):
+            for item in device:
+                self._add(item)
+        elif isinstance(device, Chain):
+            for node in device.values():
+                self._add(node)
+        elif isinstance(device, RRH):
+            self._add_chain(device.hub, device.chain)
+        elif isinstance(device, HubRemote):
+            self.hubs[device.serial] = device
+            if self.force:
+                for chain_idx in range(device.LAST_POSSIBLE_CHAIN):
+                    if chain_idx in device.REFERENCE_NODE_CHAIN:
+                        self._add(device.chains.get(chain_idx, []))
+                    else:
+                        self._add_chain(device, chain_idx)
+            elif self.recursive:
+                for item in device.walk(depth=1):
+                    if item is not device:
+                        self._add(item)
+        else:
+            self.nodes[device.serial] = device
+
+    def _add_chain(self, hub, chain_idx):
+        _, chains = self.chains.setdefault(hub.serial, (hub, []))
+        if chain_idx not in chains:
+            chains.append(chain_idx)
+
+    def power_cycled_nodes(self):
+        """ The discovered nodes on the chains this engine power cycles. """
+        for hub, chains in self.chains.values():
+            for chain_idx in chains:
+                entry = hub.chains.get(chain_idx, [])
+                for chain in (entry if isinstance(entry, list) else [entry, ]):
+                    yield from (chain.nodes if isinstance(chain, RRH) else chain.values())
+
+    def _drop_power_cycled_nodes(self):
+        for node in self.power_cycled_nodes():
+            if self.nodes.pop(node.serial, None) is not None:
+                log.debug("{} - rebooted by its chain power cycle".format(node.serial))
+
+    @property
+    def levels(self):
+        """ Lists of (name, coroutine function), in the order to run them. """
+        return [
+            [(serial, self._reboot_device(node)) for serial, node in self.nodes.items()],
+            [(serial, self._power_cycle(hub, chains)) for serial, (hub, chains) in self.chains.items()],
+            [(serial, self._reboot_device(hub)) for serial, hub in self.hubs.items()],
+        ]
+
+    def rebooted(self):
+        """ The discovered devices this engine reboots, to wait for. """
+        devices = list(self.nodes.values())
+        devices.extend(self.power_cycled_nodes())
+        devices.extend(self.hubs.values())
+        return devices
+
+    def _reboot_device(self, device):
+        async def reboot():
+            async with Remote.sshify([device, ]):
+                log.info("Rebooting {}".format(device.serial))
+                await _systemctl_reboot(device)
+        return reboot
+
+    def _power_cycle(self, hub, chains):
+        async def power_cycle():
+            log.info("Power cycling chains {} of {}".format(
+                ", ".join(str(chain_idx+1) for chain_idx in chains), hub.serial))
+            results = await hub.async_chain_power("reboot", chains)
+            for chain_idx, (status, output) in results.items():
+                if status != 0:
+                    self._failed("{} chain {}".format(hub.serial, chain_idx+1), ChainPowerError(
+                        "chain_power reboot exited {}: {}".format(status, output)))
+        return power_cycle
+
+    def _failed(self, name, error):
+        log.error("{} - reboot failed: {}".format(name, error))
+        self.failures[name] = error
+
+    async def _run_level(self, actions, semaphore):
+        async def run(name, action):
+            try:
+                if semaphore is None:
+                    await action()
+                else:
+                    async with semaphore:
+                        await action()
+            except Exception as e:
+                self._failed(name, e)
+        await asyncio.gather(*[run(name, action) for name, action in actions])
+
+    async def run(self, check=False):
+        """
+        Reboots everything, returns True if every reboot was issued.  With
+        `check` the first failure is raised instead.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency) if self.concurrency else None
+        for actions in self.levels:
+            if actions:
+                await self._run_level(actions, semaphore)
+        if check and self.failures:
+            raise next(iter(self.failures.values()))
+        return not self.failures
+
+    async def wait(self, timeout, interval=15):
+        """ Waits up to `timeout` seconds for the rebooted devices to come back. """
+        failed = set(self.failures)
+        devices = [device for device in self.rebooted() if device.serial not in failed]
+        return await RebootTracker(devices, max_interval=interval).wait(timeout)
+
+
+async def async_do_reboot(devices, recursive=False, force=False, concurrency=16, timeout=None,
+                          interval=15):
+    """
+    Reboots devices with a RebootEngine and, given a `timeout`, waits that
+    long for them to come back.  Returns True if all of it went well.
+    """
+    engine = RebootEngine(devices, recursive=recursive, force=force, concurrency=concurrency)
+    success = await engine.run()
+    if timeout:
+        success = await engine.wait(timeout, interval=interval) and success
+    return success
+
+
+def do_reboot(devices, recursive=False, force=False, concurrency=16, timeout=None, interval=15):
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(async_do_reboot(devices, recursive=recursive, force=force))
+    success = loop.run_until_complete(async_do_reboot(
+        devices, recursive=recursive, force=force, concurrency=concurrency, timeout=timeout,
+        interval=interval))
+    loop.run_until_complete(SshConnectionPool.default().close())
     loop.close()
+    return success
@@ -16,6 +16,7 @@ import logging
 import pkg_resources
 import datetime
 from pyfaros.discover.discover import Discover
+from pyfaros.discover.cache import TopologyCache
 from pyfaros.report.report import do_report
 
 __discover_description = """\
@@ -60,6 +61,11 @@ general_options.add_argument(
 )
 
 advanced_options = parser.add_argument_group("Advanced Options")
+advanced_options.add_argument(
+    '--cache',
+    action='store_true',
+    help='Start from the topology cached by a recent run and only re-check devices that changed.',
+)
 advanced_options.add_argument(
     '--prefer-ipv6',
     action='store_true',
@@ -74,7 +80,11 @@ else:
     logging.basicConfig(level=logging.INFO)
     logging.getLogger("asyncssh").setLevel(level=logging.WARN)
 
-top = Discover(soapy_enumerate_iterations=1, ipv6=parsed.prefer_ipv6)
+# Recursive operations need everything connected to the targets, which only
+# a full scan finds.
+top = Discover(soapy_enumerate_iterations=1, ipv6=parsed.prefer_ipv6,
+               cache=TopologyCache() if parsed.cache else None,
+               serials=None if parsed.recursive else parsed.serial)
 for device in top:
     device.set_credentials(parsed.user, parsed.password)
 
@@ -13,6 +13,7 @@ import numbers
 import asyncio
 import tarfile
 import pyfaros.discover.discover as discover
+from pyfaros.ssh_pool import SshConnectionPool
 import json
 import typing
 import logging
@@ -101,6 +102,9 @@ async def do_hub_report(device : discover.Remote, filename : str, indent=None):
 
 async def async_do_report_for_a_device(device : discover.Remote, output_dir : str):
     if hasattr(device, "ssh_connect"):
+        if getattr(device, "cached", False):
+            # The topology cache only keeps part of the status, get all of it.
+            await device.afetch()
         async with discover.Remote.sshify([device, ]):
             filename = "{}/{}.txt".format(output_dir, device.serial)
             if isinstance(device, discover.HubRemote):
@@ -143,6 +147,7 @@ def do_report(top : discover.Discover, devices : [discover.Remote] or None, recu
     loop.run_until_complete(
         async_do_report(
             output_dir, devices if devices is not None else top, recursive=recursive))
+    loop.run_until_complete(SshConnectionPool.default().close())
     loop.close()
     write_device_tree(output_dir, top)
     filename = zip_report(output_dir)
@@ -7,57 +7,312 @@
 #	DEALINGS IN THE SOFTWARE.
 #
 # Copyright (c) 2020, 2021 Skylark Wireless.
+import asyncio
+import logging
+import select
+import uuid
+
+import asyncssh
 import paramiko
 import scp
 
+# Bytes read from a channel at a time.
+RECV_SIZE = 64 * 1024
+# Longest wait for a channel without data before checking on it again.
+POLL_INTERVAL_S = 1.0
+
+log = logging.getLogger(__name__)
+
+
 class RunCommandFailed(Exception):
     def __init__(self, cmd, errors):
         message = "Failed cmd: {0}\nstderr:{1}\n".format(cmd, errors)
         super(RunCommandFailed, self).__init__(message)
 
+
+def _strip_newline(text):
+    return text[:-1] if text.endswith("\n") else text
+
+
+def _receive(channel, stdout, stderr):
+    """
+    Appends whatever channel has to stdout and stderr, waiting for some if
+    there is none.  Both are read as they come so neither fills up and
+    stalls the other.
+    """
+    if not channel.recv_ready() and not channel.recv_stderr_ready():
+        select.select([channel], [], [], POLL_INTERVAL_S)
+    while channel.recv_ready():
+        stdout.extend(channel.recv(RECV_SIZE))
+    while channel.recv_stderr_ready():
+        stderr.extend(channel.recv_stderr(RECV_SIZE))
+
+
+class _SentinelShell(object):
+    """
+    A `sh` kept running on the remote, so any number of commands share a
+    single channel.  Every command's stdout and stderr end with a line
+    holding a sentinel, the stdout one followed by its exit status.
+
+    Commands must not read stdin, which carries the commands that follow,
+    nor exit the shell.  Sudo is authenticated once per shell, `sudo -n`
+    is used afterwards.  Subclasses do the reading and writing.
+    """
+
+    def __init__(self, password):
+        self.password = password
+        self.sentinel = "__easyssh_{}__".format(uuid.uuid4().hex)
+        self._stdout = bytearray()
+        self._stderr = bytearray()
+        # The current command's (stdout, stderr), each set once complete.
+        self._pending = [None, None]
+        self._sudo_ready = False
+
+    def _script(self, cmd, stop_on_error):
+        lines = []
+        if stop_on_error:
+            lines.append('if [ -z "$__easyssh_stop" ]; then')
+        lines.append(cmd)
+        lines.append("__easyssh_status=$?")
+        if stop_on_error:
+            lines.append('else __easyssh_status=255; fi')
+            lines.append('[ "$__easyssh_status" -eq 0 ] || __easyssh_stop=1')
+        lines.append("printf '\\n%s %s\\n' {0} \"$__easyssh_status\"".format(self.sentinel))
+        lines.append("printf '\\n%s\\n' {0} >&2".format(self.sentinel))
+        return "\n".join(lines) + "\n"
+
+    def _sudo_script(self):
+        """ The script authenticating sudo, None if there is no need. """
+        if self._sudo_ready or self.password is None:
+            return None
+        delimiter = "__easyssh_{}__".format(uuid.uuid4().hex)
+        return self._script(
+            "sudo -S -p '' -v <<'{0}'\n{1}\n{0}".format(delimiter, self.password), False)
+
+    def _batch(self, commands, sudo, check):
+        """ The commands to run and the script running them. """
+        if sudo:
+            commands = ["sudo -n " + cmd for cmd in commands]
+        return commands, "__easyssh_stop=\n" + "".join(self._script(cmd, check) for cmd in commands)
+
+    def _take(self, buffer, marker):
+        """ Output in buffer up to marker and what follows marker on its line, or None. """
+        index = buffer.find(marker)
+        if index < 0:
+            return None
+        end = buffer.find(b"\n", index + len(marker))
+        if end < 0:
+            return None
+        output = bytes(buffer[:index]).decode("utf-8", "replace")
+        rest = bytes(buffer[index + len(marker):end]).decode("utf-8", "replace")
+        del buffer[:end + 1]
+        return output, rest
+
+    def _pop_result(self):
+        """ The next command's (exit status, stdout, stderr) once it all arrived, or None. """
+        stdout, stderr = self._pending
+        if stdout is None:
+            stdout = self._take(self._stdout, "\n{} ".format(self.sentinel).encode())
+        if stderr is None:
+            stderr = self._take(self._stderr, "\n{}".format(self.sentinel).encode())
+        if stdout is None or stderr is None:
+            self._pending = [stdout, stderr]
+            return None
+        self._pending = [None, None]
+        return int(stdout[1]), stdout[0], stderr[0]
+
+    def _check_sudo(self, result):
+        if result is None:
+            raise RunCommandFailed("sudo -v", "the shell exited")
+        status, _, errors = result
+        if status != 0:
+            raise RunCommandFailed("sudo -v", _strip_newline(errors))
+        self._sudo_ready = True
+
+    def _finish(self, commands, results, check):
+        """
+        Commands the shell exited before finishing get a None exit status
+        and no output, with `check` they raise RunCommandFailed as failures
+        do.
+        """
+        results = [result if result is not None else (None, "", "") for result in results]
+        if check:
+            for cmd, (status, _, errors) in zip(commands, results):
+                if status is None:
+                    raise RunCommandFailed(cmd, "the shell exited")
+                if status != 0:
+                    raise RunCommandFailed(cmd, _strip_newline(errors))
+        return [(status, _strip_newline(out), _strip_newline(errors)) for status, out, errors in results]
+
+
+class EasySshShell(_SentinelShell):
+    """ A _SentinelShell over a paramiko client, see EasySsh.shell. """
+
+    def __init__(self, client, password):
+        super(EasySshShell, self).__init__(password)
+        self.channel = client.get_transport().open_session()
+        self.channel.exec_command("sh")
+
+    def close(self):
+        self.channel.close()
+
+    def _result(self):
+        while True:
+            result = self._pop_result()
+            if result is not None:
+                return result
+            if self.channel.exit_status_ready() and not (
+                    self.channel.recv_ready() or self.channel.recv_stderr_ready()):
+                return None
+            _receive(self.channel, self._stdout, self._stderr)
+
+    def run_many(self, commands, sudo=False, check=True):
+        """
+        Sends all the commands at once and returns a (exit status, stdout,
+        stderr) tuple for each.  With `check` the commands after one which
+        fails are skipped and RunCommandFailed is raised.
+        """
+        script = self._sudo_script() if sudo else None
+        if script is not None:
+            self.channel.sendall(script.encode())
+            self._check_sudo(self._result())
+        commands, script = self._batch(list(commands), sudo, check)
+        self.channel.sendall(script.encode())
+        return self._finish(commands, [self._result() for _ in commands], check)
+
+    def run(self, cmd, sudo=False):
+        return self.run_many([cmd], sudo=sudo)[0][1]
+
+
+class AsyncSshShell(_SentinelShell):
+    """
+    A _SentinelShell over an asyncssh connection, see Remote.run_many.
+    Commands run one batch at a time, in the order run_many is called.
+    """
+
+    def __init__(self, process, password):
+        super(AsyncSshShell, self).__init__(password)
+        self.process = process
+        self._lock = asyncio.Lock()
+        self._data = asyncio.Event()
+        self._readers = [asyncio.ensure_future(self._read(process.stdout, self._stdout)),
+                         asyncio.ensure_future(self._read(process.stderr, self._stderr))]
+
+    @classmethod
+    async def open(cls, connection, password):
+        process = await connection.create_process("sh", encoding=None)
+        return cls(process, password)
+
+    def close(self):
+        try:
+            self.process.close()
+        except (asyncssh.Error, OSError) as e:
+            log.debug("shell close failed: {}".format(e))
+        for reader in self._readers:
+            reader.cancel()
+
+    async def _read(self, stream, buffer):
+        try:
+            while True:
+                data = await stream.read(RECV_SIZE)
+                if not data:
+                    break
+                buffer.extend(data)
+                self._data.set()
+        except (asyncssh.Error, OSError) as e:
+            log.debug("shell read failed: {}".format(e))
+        finally:
+            self._data.set()
+
+    async def _result(self):
+        while True:
+            result = self._pop_result()
+            if result is not None or all(reader.done() for reader in self._readers):
+                return result
+            self._data.clear()
+            await self._data.wait()
+
+    async def run_many(self, commands, sudo=False, check=True):
+        """ See EasySshShell.run_many. """
+        async with self._lock:
+            script = self._sudo_script() if sudo else None
+            if script is not None:
+                self.process.stdin.write(script.encode())
+                self._check_sudo(await self._result())
+            commands, script = self._batch(list(commands), sudo, check)
+            self.process.stdin.write(script.encode())
+            return self._finish(commands, [await self._result() for _ in commands], check)
+
+    async def run(self, cmd, sudo=False):
+        return (await self.run_many([cmd], sudo=sudo))[0][1]
+
+
 class EasySsh(object):
-    def __init__(self, name, remote_ipaddr, user, password):
+    def __init__(self, name, remote_ipaddr, user, password, persistent=False):
+        """
+        With `persistent`, runCommand goes through one EasySshShell rather
+        than a new channel per command.
+        """
         self.name = name or remote_ipaddr
         self.remote_ipaddr = remote_ipaddr
         self.user = user
         self.password = password
+        self.persistent = persistent
         self.connect()
         self.scp_client = None
+        self._shell = None
 
     def connect(self):
         self.client = paramiko.SSHClient()
         self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.client.connect(self.remote_ipaddr, username=self.user, password=self.password)
 
+    def close(self):
+        if self._shell is not None:
+            self._shell.close()
+            self._shell = None
+        self.client.close()
+
+    def shell(self):
+        """ The EasySshShell of this connection, started on first use. """
+        if self._shell is None:
+            self._shell = EasySshShell(self.client, self.password)
+        return self._shell
+
     def getScpClient(self):
         if self.scp_client is None:
-            self.client_for_scp = paramiko.SSHClient()
-            self.client_for_scp.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.client_for_scp.connect(self.remote_ipaddr, username=self.user, password=self.password)
-            self.scp_client = scp.SCPClient(self.client_for_scp.get_transport())
+            # SSH multiplexes, scp needs no connection of its own.
+            self.scp_client = scp.SCPClient(self.client.get_transport())
         return self.scp_client
 
     def copyFile(self, filename, dst):
         self.getScpClient().put(filename, dst)
 
-    def runCommand(self, *args, sudo=False):
-        channel = self.client.get_transport().open_session()
+    def run_many(self, commands, sudo=False, check=True):
+        """ See EasySshShell.run_many. """
+        return self.shell().run_many(commands, sudo=sudo, check=check)
 
+    def runCommand(self, *args, sudo=False):
         cmd = ' '.join(args)
+        if self.persistent:
+            return self.shell().run(cmd, sudo=sudo)
+
+        channel = self.client.get_transport().open_session()
         if sudo:
             cmd = 'sudo --stdin ' + cmd
 
         channel.exec_command(cmd)
-        stdin = channel.makefile_stdin('w')
-        stderr = channel.makefile_stderr()
-        stdout = channel.makefile()
         if sudo:
-            stdin.write(self.password+'\n')
+            channel.sendall((self.password + '\n').encode())
 
-        errors = '\n'.join(line.strip('\n') for line in stderr)
+        stdout = bytearray()
+        stderr = bytearray()
+        while not channel.exit_status_ready() or channel.recv_ready() or channel.recv_stderr_ready():
+            _receive(channel, stdout, stderr)
+        errors = _strip_newline(stderr.decode("utf-8", "replace"))
         exit_status = channel.recv_exit_status()
         if exit_status:
             self.exit_status = exit_status
             raise RunCommandFailed(cmd, errors)
 
-        return '\n'.join(line.strip('\n') for line in stdout)
+        return _strip_newline(stdout.decode("utf-8", "replace"))
@@ -0,0 +1,199 @@
+#
+#	THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#	INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#	PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+#	FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#	OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#	DEALINGS IN THE SOFTWARE.
+#
+# Copyright (c) 2020, 2021 Skylark Wireless.
+import asyncio
+import logging
+
+import asyncssh
+
+log = logging.getLogger(__name__)
+
+
+class _PooledConnection:
+
+    def __init__(self, key, loop):
+        self.key = key
+        self.loop = loop
+        self.connection = None
+        self.users = 0
+        self.alive = True
+        self.last_used = loop.time()
+        self.idle_handle = None
+
+
+class _PoolClient(asyncssh.SSHClient):
+    """ Tells the pool when the server drops a connection. """
+
+    def __init__(self, pooled):
+        self._pooled = pooled
+
+    def connection_lost(self, exc):
+        self._pooled.alive = False
+
+
+class SshConnectionPool:
+    """
+      Lends out asyncssh connections, at most one per (address, username),
+      shared by everyone borrowing it at the same time since SSH multiplexes
+      channels over one connection.
+
+      A connection no one borrows is kept for `idle_timeout` seconds, then
+      closed.  Before a connection is lent, idle or already borrowed, it must
+      still be up, and if it wasn't borrowed or given back for more than
+      `health_check_after` seconds it must also answer a command within
+      `health_timeout` seconds, otherwise a new one is opened.  A borrowed
+      connection failing this is closed once the last borrower gives it back.
+
+      `max_connections` is a soft cap: above it the least recently used idle
+      connections are closed, and connections given back are closed rather
+      than kept, but a borrow never waits for a connection to be given back
+      (callers such as UpdateScheduler hold one per device for a whole
+      update), so while every connection is borrowed the pool grows past it.
+
+      Connections belong to the event loop they were opened on; a borrow
+      from another loop opens a new one.
+      """
+
+    def __init__(self, max_connections=512, idle_timeout=60.0, health_check_after=30.0,
+                 health_timeout=5.0):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.health_timeout = health_timeout
+        self._pooled = {}
+        self._by_connection = {}
+        self._opening = {}
+
+    @classmethod
+    def default(cls):
+        """ The pool shared by the whole process. """
+        global _default_pool
+        if _default_pool is None:
+            _default_pool = cls()
+        return _default_pool
+
+    def __len__(self):
+        return len(self._pooled)
+
+    async def _healthy(self, pooled):
+        if not pooled.alive:
+            return False
+        if pooled.loop.time() - pooled.last_used < self.health_check_after:
+            return True
+        try:
+            await asyncio.wait_for(pooled.connection.run("true", check=True), self.health_timeout)
+            return True
+        except Exception as e:
+            log.debug("{} - pooled connection failed its health check: {}".format(pooled.key[0], e))
+            return False
+
+    def _discard(self, pooled):
+        if self._pooled.get(pooled.key) is pooled:
+            del self._pooled[pooled.key]
+        self._by_connection.pop(id(pooled.connection), None)
+        if pooled.idle_handle is not None:
+            pooled.idle_handle.cancel()
+            pooled.idle_handle = None
+        if pooled.connection is not None and not pooled.loop.is_closed():
+            pooled.connection.close()
+
+    def _retire(self, pooled):
+        """ Stops lending pooled, closing it once no one borrows it. """
+        if pooled.users == 0:
+            self._discard(pooled)
+        elif self._pooled.get(pooled.key) is pooled:
+            del self._pooled[pooled.key]
+
+    def _make_room(self):
+        idle = sorted((p for p in self._pooled.values() if p.users == 0), key=lambda p: p.last_used)
+        while len(self._pooled) >= self.max_connections and idle:
+            self._discard(idle.pop(0))
+
+    async def _open(self, key, loop, connect_kwargs):
+        pooled = _PooledConnection(key, loop)
+        address, username = key
+        pooled.connection, _ = await asyncssh.create_connection(
+            lambda: _PoolClient(pooled), address, username=username, **connect_kwargs)
+        return pooled
+
+    async def acquire(self, address, username=None, password=None, **connect_kwargs):
+        """
+          Returns a connection to address for username, to give back with
+          release once done with it.
+          """
+        loop = asyncio.get_event_loop()
+        key = (address, username)
+        while True:
+            pooled = self._pooled.get(key)
+            if pooled is not None and pooled.loop is not loop:
+                # Left over from a loop which is gone by now.
+                self._discard(pooled)
+                pooled = None
+            if pooled is not None:
+                if pooled.idle_handle is not None:
+                    pooled.idle_handle.cancel()
+                    pooled.idle_handle = None
+                if not await self._healthy(pooled):
+                    self._retire(pooled)
+                    continue
+                break
+            opening = self._opening.get(key)
+            if opening is None or opening[0] is not loop:
+                self._make_room()
+                connect_kwargs.setdefault("known_hosts", None)
+                connect_kwargs.setdefault("client_keys", [])
+                future = asyncio.ensure_future(
+                    self._open(key, loop, dict(connect_kwargs, password=password)))
+                opening = (loop, future)
+                self._opening[key] = opening
+            try:
+                pooled = await asyncio.shield(opening[1])
+            finally:
+                if self._opening.get(key) is opening and opening[1].done():
+                    del self._opening[key]
+            if self._pooled.get(key) is None:
+                self._pooled[key] = pooled
+                self._by_connection[id(pooled.connection)] = pooled
+            break
+        pooled.users += 1
+        pooled.last_used = loop.time()
+        return pooled.connection
+
+    def release(self, connection):
+        pooled = self._by_connection.get(id(connection))
+        if pooled is None:
+            return
+        pooled.users -= 1
+        pooled.last_used = pooled.loop.time()
+        if pooled.users > 0:
+            return
+        if (not pooled.alive or self._pooled.get(pooled.key) is not pooled
+                or len(self._pooled) > self.max_connections or self.idle_timeout <= 0):
+            self._discard(pooled)
+        else:
+            pooled.idle_handle = pooled.loop.call_later(self.idle_timeout, self._evict, pooled)
+
+    def _evict(self, pooled):
+        pooled.idle_handle = None
+        if pooled.users == 0:
+            log.debug("{} - closing idle connection".format(pooled.key[0]))
+            self._discard(pooled)
+
+    async def close(self):
+        """ Closes the idle connections of the running loop. """
+        loop = asyncio.get_event_loop()
+        for pooled in list(self._pooled.values()):
+            if pooled.loop is loop and pooled.users == 0:
+                self._discard(pooled)
+                await pooled.connection.wait_closed()
+            elif pooled.loop.is_closed():
+                self._discard(pooled)
+
+
+_default_pool = None
@@ -15,19 +15,44 @@ import asyncio
 import logging
 from typing import Iterable
 
-from pyfaros.updater.updater import do_update, do_update_and_wait
+from pyfaros.updater.updater import (do_update, do_update_and_wait, prepare_devices, FailurePolicy,
+                                     UpdateScheduler)
 from pyfaros.updater.update_environment import UpdateEnvironment
+from pyfaros.updater.journal import UpdateJournal
 from pyfaros.discover.discover import Discover, CPERemote, IrisRemote, HubRemote, VgerRemote, Remote
+from pyfaros.discover.cache import TopologyCache
+from pyfaros.ssh_pool import SshConnectionPool
 import pkg_resources
 
 
 async def update_devices(environment: UpdateEnvironment, devices: Iterable[Remote], args) -> None:
     timeout = args.timeout
     store_ssh = not args.no_ssh
+    policy = FailurePolicy(args.on_failure)
+    scheduler = UpdateScheduler(
+        concurrency=args.max_parallel or None,
+        per_hub=args.max_per_hub or None,
+        per_chain=args.max_per_chain or None,
+        bandwidth=int(args.bandwidth * 1e6) if args.bandwidth else None)
+    resume = None
+    if args.resume is not None:
+        if args.resume == "latest":
+            resume = UpdateJournal.latest()
+        else:
+            resume = UpdateJournal(args.resume).load()
+        if resume is None or not resume.devices:
+            logging.error("No update journal to resume from")
+            return
+        logging.info("Resuming update {}".format(resume.timestamp))
     if timeout == 0:
-        await do_update(environment, devices, store_ssh=store_ssh)
+        await do_update(environment, devices, store_ssh=store_ssh, relay=args.relay,
+                        force=args.force_update, compress=args.compress, policy=policy,
+                        scheduler=scheduler, resume=resume)
     else:
-        if not await do_update_and_wait(environment, devices, 15, timeout, store_ssh=store_ssh):
+        if not await do_update_and_wait(environment, devices, args.poll_interval, timeout,
+                                        store_ssh=store_ssh, relay=args.relay, force=args.force_update,
+                                        compress=args.compress, policy=policy,
+                                        scheduler=scheduler, resume=resume):
             logging.error('Failed to reach devices within {} seconds after reboot'.format(timeout))
 
 
@@ -82,6 +107,12 @@ if __name__ == '__main__':
         help='The maximum duration (in seconds) to wait for the devices to come back online.',
     )
 
+    general_options.add_argument(
+        '--poll-interval',
+        type=float, default=15,
+        help='The longest interval (in seconds) between checks of a device that is not back yet.',
+    )
+
     advanced_options.add_argument(
         '--bootbit-only',
         help="Only update bootbit, no other files.",
@@ -117,6 +148,59 @@ if __name__ == '__main__':
         help="Do not store ssh keys in /boot/ when updating cards.",
         action='store_true',
         default=False)
+    advanced_options.add_argument(
+        '--cache',
+        help="Start from the topology cached by a recent run and only re-check devices that changed.",
+        action='store_true',
+        default=False)
+    advanced_options.add_argument(
+        '--resume',
+        help="Resume an interrupted update, the latest one or the one with this timestamp.",
+        nargs='?',
+        const="latest",
+        default=None,
+        metavar="TIMESTAMP")
+    advanced_options.add_argument(
+        '--force-update',
+        help="Copy and replace every file even if the device already has it.",
+        action='store_true',
+        default=False)
+    advanced_options.add_argument(
+        '--max-parallel',
+        help="Maximum number of devices receiving files at once, 0 for no limit.",
+        type=int,
+        default=16)
+    advanced_options.add_argument(
+        '--max-per-hub',
+        help="Maximum number of devices behind one hub receiving files at once, 0 for no limit.",
+        type=int,
+        default=4)
+    advanced_options.add_argument(
+        '--max-per-chain',
+        help="Maximum number of devices on one chain receiving files at once, 0 for no limit.",
+        type=int,
+        default=2)
+    advanced_options.add_argument(
+        '--bandwidth',
+        help="Cap the total transfer rate to this many MB/s.",
+        type=float,
+        default=None)
+    advanced_options.add_argument(
+        '--on-failure',
+        help="When a device fails, let the others continue, stop the devices of the same power "
+             "dependency wave, or stop all of them before they write /boot.",
+        choices=[policy.value for policy in FailurePolicy],
+        default=FailurePolicy.ABORT_ALL.value)
+    advanced_options.add_argument(
+        '--compress',
+        help="Send files gzip compressed and decompress them on the device.",
+        action='store_true',
+        default=False)
+    advanced_options.add_argument(
+        '--relay',
+        help="Copy each file once per hub and have the devices behind it fetch it from each other.",
+        action='store_true',
+        default=False)
     advanced_options.add_argument(
         '--enable-sudo',
         help="Force a password-less sudo.  Only used on firmware older than 2019-07.0.0",
@@ -192,7 +276,7 @@ if __name__ == '__main__':
                             logging.debug("Did remap for {} to {}".format(v1.value, v2.value))
                             update_environment.mapping[v1] = update_environment.mapping[v2]
 
-            top = Discover()
+            top = Discover(cache=TopologyCache() if args.cache else None)
             discovered = sorted(
                 filter(update_environment.availablefilter(),
                        list(top)),
@@ -215,21 +299,22 @@ if __name__ == '__main__':
                         filter(lambda x: isinstance(x, IrisRemote),
                                discovered)))
             logging.debug("Filtered discovered objects: {}".format(discovered))
-            logging.info("About to flash devices:")
             for device in discovered:
                 device.set_credentials(args.user, args.password)
-                if args.enable_sudo:
-                    device.enable_sudo()
-                device.set_variant()
+            loop = asyncio.get_event_loop()
+            loop.run_until_complete(prepare_devices(
+                discovered, enable_sudo=args.enable_sudo, concurrency=args.max_parallel or None))
+            logging.info("About to flash devices:")
+            for device in discovered:
                 logging.info("\t {} - {}\n\t\t{}\n\t\t{}\n\t\t{}".format(
                     device.serial, device.address,
                     update_environment.mapping[device.variant].bootbin,
                     update_environment.mapping[device.variant].bootbit,
                     update_environment.mapping[device.variant].imageub))
             if not args.dry_run:
-                loop = asyncio.get_event_loop()
                 loop.run_until_complete(update_devices(update_environment, discovered, args))
-                loop.close()
+            loop.run_until_complete(SshConnectionPool.default().close())
+            loop.close()
     except Exception as e:
         logging.debug(e)
         raise e
@@ -0,0 +1,123 @@
+#
+#	THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#	INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#	PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+#	FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#	OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#	DEALINGS IN THE SOFTWARE.
+#
+# Copyright (c) 2020, 2021 Skylark Wireless.
+import json
+import logging
+import os
+import time
+
+from pyfaros.discover.cache import default_cache_dir
+
+log = logging.getLogger(__name__)
+
+
+def default_journal_dir():
+    return os.path.join(default_cache_dir(), "updates")
+
+
+class UpdateJournal:
+    """
+      Records how far an update got on each device, so an interrupted update
+      can be resumed rather than started over.
+
+      The journal is a JSON lines file named after the update timestamp (the
+      /tmp/updater_<timestamp> directory on the devices). Each line is one
+      phase a device reached, written and synced before the update moves
+      on, so a crash loses at most the phase in progress. A torn last line is
+      ignored on load.
+      """
+    # In the order a device goes through them.
+    PLANNED = "planned"
+    TRANSFERRED = "transferred"
+    INSTALLING = "installing"
+    INSTALLED = "installed"
+    REBOOTED = "rebooted"
+    # How a device can end up other than rebooted.
+    UP_TO_DATE = "up_to_date"
+    FAILED = "failed"
+    ABORTED = "aborted"
+    # Phases after which a device is left alone by a resumed update.
+    DONE = (REBOOTED, UP_TO_DATE)
+
+    def __init__(self, timestamp, directory=None):
+        self.timestamp = str(timestamp)
+        self.directory = directory if directory is not None else default_journal_dir()
+        self.path = os.path.join(self.directory, "{}.jsonl".format(self.timestamp))
+        self.devices = {}
+
+    @classmethod
+    def latest(cls, directory=None):
+        """ Returns the journal of the most recent update, or None. """
+        directory = directory if directory is not None else default_journal_dir()
+        try:
+            timestamps = [name[:-len(".jsonl")] for name in os.listdir(directory)
+                          if name.endswith(".jsonl") and name[:-len(".jsonl")].isdigit()]
+        except (IOError, OSError):
+            return None
+        if not timestamps:
+            return None
+        return cls(max(timestamps, key=int), directory=directory).load()
+
+    def load(self):
+        self.devices = {}
+        try:
+            with open(self.path, "r") as fptr:
+                lines = fptr.readlines()
+        except (IOError, OSError) as e:
+            log.debug("No update journal {}: {}".format(self.path, e))
+            return self
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                log.debug("Skipping torn line in {}".format(self.path))
+                continue
+            serial = entry.get("serial")
+            if serial is None:
+                continue
+            previous = self.devices.get(serial, {})
+            # Later lines only carry what changed, keep the planned files.
+            self.devices[serial] = dict(previous, **entry)
+        return self
+
+    def record(self, device, phase, **fields):
+        entry = dict(fields, time=time.time(), serial=device.serial, phase=phase)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path, "a") as fptr:
+            fptr.write(json.dumps(entry) + "\n")
+            fptr.flush()
+            os.fsync(fptr.fileno())
+        self.devices[device.serial] = dict(self.devices.get(device.serial, {}), **entry)
+
+    def plan(self, device, file_list):
+        self.record(device, self.PLANNED, files=[
+            {"local_name": my_file.local_name, "remote_name": my_file.remote_name,
+             "sha256sum": my_file.sha256sum}
+            for my_file in file_list])
+
+    def phase(self, device):
+        return self.devices.get(device.serial, {}).get("phase")
+
+    def planned_files(self, device, file_list):
+        """
+          Returns the files of file_list the journal planned for device, or
+          None if it planned none or planned files file_list doesn't have
+          (a different update).
+          """
+        planned = self.devices.get(device.serial, {}).get("files")
+        if planned is None:
+            return None
+        by_name = dict((my_file.local_name, my_file) for my_file in file_list if my_file is not None)
+        files = []
+        for entry in planned:
+            my_file = by_name.get(entry.get("local_name"))
+            if my_file is None or my_file.sha256sum != entry.get("sha256sum"):
+                return None
+            files.append(my_file)
+        return files
@@ -21,19 +21,30 @@ from typing import Mapping, List
 from pyfaros.discover.discover import (CPERemote, HubRemote, IrisRemote,
                                              Remote, VgerRemote)
 from pyfaros.updater.update_file import (BootBin, BootBit, ImageUB, Ps7Init,
-                                                 Manifest, TarballFile, UpdateFile)
+                                                 Manifest, TarballFile, UpdateFile,
+                                                 analyze_files, note_unpacked)
 
 _getfirst = lambda x: x[0] if len(x) > 0 else None
 
 log = logging.getLogger(__name__)
 
+def _unpacked_files(nt):
+    return (_getfirst(glob(nt.unpackdir + "/BOOT.BIN")),
+            _getfirst(glob(nt.unpackdir + "/image.ub")),
+            _getfirst(glob(nt.unpackdir + "/*_top.bin")),
+            _getfirst(glob(nt.unpackdir + "/ps7_init.tcl")))
+
+
+def _analyze_unpacked(mapping, variants):
+    """ Analyzes the files unpacked for all variants at once, see analyze_files. """
+    analyze_files([path for variant in variants
+                   for path in _unpacked_files(mapping[variant]) if path is not None])
+
+
 def _fill_namedtup(mapping, variant, manifest=None, imageub=None, bootbin=None):
     nt = mapping[variant]
     m_file = _getfirst(glob(nt.unpackdir + "/manifest.txt"))
-    b_file = _getfirst(glob(nt.unpackdir + "/BOOT.BIN"))
-    i_file = _getfirst(glob(nt.unpackdir + "/image.ub"))
-    bit_file = _getfirst(glob(nt.unpackdir + "/*_top.bin"))
-    ps7_init = _getfirst(glob(nt.unpackdir + "/ps7_init.tcl"))
+    b_file, i_file, bit_file, ps7_init = _unpacked_files(nt)
 
     if m_file is not None:
         nt.manifest = Manifest(m_file)
@@ -126,6 +137,7 @@ class UpdateEnvironment:
             logging.debug("self.mode was universal tarball")
             shutil.unpack_archive(self.universal_tarball_path,
                                   self.root_tmpdir + "/.unpack")
+            note_unpacked(self.universal_tarball_path, self.root_tmpdir + "/.unpack")
             outer_manifest = None
             try:
                 if len(glob(self.root_tmpdir + "/.unpack/manifest.txt")) == 1:
@@ -136,7 +148,10 @@ class UpdateEnvironment:
                 outer_manifest = None
                 logging.debug("Didn't have outer manifest.")
             logging.debug("about to deal with tarballs")
-            for tarball in glob(self.root_tmpdir + "/.unpack/" + "*.tar.gz"):
+            tarballs = glob(self.root_tmpdir + "/.unpack/" + "*.tar.gz")
+            analyze_files(tarballs, strings=False)
+            variants = []
+            for tarball in tarballs:
                 logging.debug("dealing with tarball {}".format(tarball))
                 as_obj = TarballFile(tarball, manifest=outer_manifest)
                 if as_obj.variant_specific_detected is None or as_obj.variant_specific_detected not in self.mapping:
@@ -147,7 +162,10 @@ class UpdateEnvironment:
                     as_obj.set_unpackdir(
                         self.mapping[as_obj.variant_specific_detected].unpackdir)
                 as_obj.unpack()
-                _fill_namedtup(self.mapping, as_obj.variant_specific_detected)
+                variants.append(as_obj.variant_specific_detected)
+            _analyze_unpacked(self.mapping, variants)
+            for variant in variants:
+                _fill_namedtup(self.mapping, variant)
 
         elif self.mode == UpdateEnvironment.Mode.INDIVIDUAL_TARBALLS:
             outer_manifest = None
@@ -156,6 +174,8 @@ class UpdateEnvironment:
                     outer_manifest = Manifest(
                         _getfirst(glob(self.root_tmpdir + "/.unpack/manifest.txt")))
                     logging.debug(outer_manifest)
+            analyze_files(self.individual_tarball_paths, strings=False)
+            variants = []
             for tarball in self.individual_tarball_paths:
                 log.debug(tarball)
                 as_obj = TarballFile(
@@ -174,7 +194,10 @@ class UpdateEnvironment:
                     as_obj.set_unpackdir(
                         self.mapping[as_obj.variant_specific_detected].unpackdir)
                 as_obj.unpack()
-                _fill_namedtup(self.mapping, as_obj.variant_specific_detected)
+                variants.append(as_obj.variant_specific_detected)
+            _analyze_unpacked(self.mapping, variants)
+            for variant in variants:
+                _fill_namedtup(self.mapping, variant)
 
         elif self.mode == UpdateEnvironment.Mode.FILES_DIRECTLY:
             if self.variant is not None:
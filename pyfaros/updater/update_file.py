@@ -8,28 +8,234 @@
 #
 # Copyright (c) 2020, 2021 Skylark Wireless.
 import hashlib
+import json
 import logging
+import mmap
 import os
+import re
 import shutil
-import subprocess
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import partial
 
+from pyfaros.discover.cache import default_cache_dir
 from pyfaros.discover.discover import CPERemote, HubRemote, IrisRemote, VgerRemote
 
 log = logging.getLogger(__name__)
 
 def sha256sum(filename):
+    return scan_file(filename, strings=False)["sha256"]
+
+
+# strings(1) prints runs of at least 4 of these, only the runs holding a
+# keyword matter.
+_PRINTABLE = bytes(range(0x20, 0x7f)) + b'\t'
+_UNPRINTABLE = re.compile(rb'[^\x20-\x7e\t]')
+SCAN_CHUNK = 4 * 1024 * 1024
+
+
+def scan_file(path, strings=True):
+    """
+    Reads path once, returning its sha256 and, if `strings` is set, the
+    printable strings mentioning PetaLinux or preboot, which is all the
+    variant checks look at.
+    """
+    sha = hashlib.sha256()
+    petalinux = []
+    preboot = []
+
+    def find_all(data, keyword, end):
+        found = data.find(keyword, 0, end)
+        while found >= 0:
+            yield found, found + len(keyword)
+            found = data.find(keyword, found + 1, end)
+
+    def collect(data, end):
+        done = 0
+        # bytes.find is far quicker than a regex over the whole image.
+        hits = sorted(list(find_all(data, b"PetaLinux", end)) +
+                      list(find_all(data.lower(), b"preboot", end)))
+        for hit_start, hit_end in hits:
+            if hit_start < done:
+                continue
+            # Widen the keyword to the run of printable characters around it.
+            start = hit_start
+            while start > 0 and data[start - 1] in _PRINTABLE:
+                start -= 1
+            stop = _UNPRINTABLE.search(data, hit_end, end)
+            done = stop.start() if stop is not None else end
+            text = data[start:done]
+            if b"PetaLinux" in text:
+                petalinux.append(text.decode("ascii"))
+            if b"preboot" in text.lower():
+                preboot.append(text.decode("ascii"))
+
+    with open(path, mode='rb') as file_handle:
+        size = os.fstat(file_handle.fileno()).st_size
+        if size and not strings:
+            with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # Hashed straight from the mapping, hashlib drops the GIL meanwhile.
+                with memoryview(mapped) as view:
+                    for offset in range(0, size, SCAN_CHUNK):
+                        sha.update(view[offset:offset + SCAN_CHUNK])
+        elif size:
+            with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                carry = b""
+                for offset in range(0, size, SCAN_CHUNK):
+                    chunk = mapped[offset:offset + SCAN_CHUNK]
+                    sha.update(chunk)
+                    data = carry + chunk
+                    # A run reaching the end of the chunk may go on in the next one.
+                    end = len(data.rstrip(_PRINTABLE))
+                    collect(data, end)
+                    carry = data[end:]
+                collect(carry, len(carry))
+    return {
+        "path": os.path.abspath(path),
+        "sha256": sha.hexdigest(),
+        "petalinux": petalinux if strings else None,
+        "preboot": preboot if strings else None,
+    }
+
+
+# scan_file results by _analysis_key, also kept on disk between runs.
+_analyses = {}
+_disk_analyses = None
+# (key, origin) of the files unpacked from an archive by path, see note_unpacked.
+_unpacked = {}
+
+
+def analysis_cache_path():
+    return os.path.join(default_cache_dir(), "image_analysis.json")
+
+
+def _stat_key(path):
+    # Rewriting a file changes its ctime even when the size and mtime are
+    # put back, and replacing it changes the inode, so the key only goes
+    # stale if a file changes within a timestamp tick of being analyzed.
+    stat = os.stat(path)
+    return "{}:{}:{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                                   stat.st_ctime_ns, stat.st_ino)
+
+
+def _analysis_key(path):
+    """
+    The key of path in the cache and its origin, the stat key of the file
+    on disk it comes from.  Unpacked files land in a new temporary
+    directory every run, so they're known by the key of their archive and
+    their name in it instead.
+    """
+    unpacked = _unpacked.get(os.path.abspath(path))
+    if unpacked is not None:
+        return unpacked
+    key = _stat_key(path)
+    return key, key
+
+
+def note_unpacked(archive, unpackdir):
+    """ Records the files in unpackdir as unpacked from archive, see _analysis_key. """
+    key, origin = _analysis_key(archive)
+    for root, _, names in os.walk(unpackdir):
+        for name in names:
+            path = os.path.abspath(os.path.join(root, name))
+            _unpacked[path] = ("{}!{}".format(key, os.path.relpath(path, unpackdir)), origin)
+
+
+def _is_current(origin):
+    path = origin.rsplit(":", 4)[0]
     try:
-        with open(filename, mode='rb') as file_handle:
-            hashguy = hashlib.sha256()
-            for buf in iter(partial(file_handle.read, 128), b''):
-                hashguy.update(buf)
-        return hashguy.hexdigest()
-    except:
-        raise
+        return _stat_key(path) == origin
+    except OSError:
+        return False
+
+
+def _load_analyses():
+    global _disk_analyses
+    if _disk_analyses is None:
+        try:
+            with open(analysis_cache_path(), "r") as fptr:
+                _disk_analyses = json.load(fptr)
+        except (IOError, OSError, ValueError) as e:
+            log.debug("Not using image analysis cache: {}".format(e))
+            _disk_analyses = {}
+    return _disk_analyses
+
+
+def _cached_analysis(key, strings):
+    entry = _analyses.get(key, _load_analyses().get(key))
+    if entry is None or (strings and entry.get("petalinux") is None):
+        return None
+    _analyses[key] = entry
+    return entry
+
+
+def _store_analyses(entries):
+    _analyses.update(entries)
+    disk = _load_analyses()
+    disk.update(entries)
+    # Drops what was analyzed from files since changed or removed.
+    for key in [key for key, entry in disk.items() if not _is_current(entry.get("origin", ""))]:
+        del disk[key]
+    path = analysis_cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".image_analysis-")
+        with os.fdopen(fd, "w") as fptr:
+            json.dump(disk, fptr)
+        os.replace(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.debug("Couldn't save image analysis cache: {}".format(e))
+
+
+def analyze_file(path, strings=True):
+    """ scan_file, cached by the identity of the file, see _analysis_key. """
+    key, origin = _analysis_key(path)
+    entry = _cached_analysis(key, strings)
+    if entry is None:
+        entry = dict(scan_file(path, strings=strings), origin=origin)
+        _store_analyses({key: entry})
+    return entry
+
+
+def analyze_files(paths, strings=True, max_workers=None):
+    """
+    Analyzes the files not cached yet in parallel, so the UpdateFiles later
+    made for them find their analysis in the cache.  Looking for strings
+    holds the GIL and runs in a process pool, hashing alone runs in threads.
+    """
+    pending = OrderedDict()
+    origins = {}
+    for path in paths:
+        key, origins[key] = _analysis_key(path)
+        if _cached_analysis(key, strings) is None:
+            pending[key] = path
+    if len(pending) > 1:
+        executor = ProcessPoolExecutor if strings else ThreadPoolExecutor
+        with executor(max_workers=max_workers) as pool:
+            results = list(pool.map(partial(scan_file, strings=strings), pending.values()))
+    else:
+        results = [scan_file(path, strings=strings) for path in pending.values()]
+    if results:
+        _store_analyses({key: dict(result, origin=origins[key])
+                         for key, result in zip(pending.keys(), results)})
+
+
+def _cut_fields(line, delimiter, first, last=0):
+    """
+    Fields `first` to `last` (1-based, None for the rest) of line, like
+    cut(1) which passes lines without the delimiter through whole.
+    """
+    if delimiter not in line:
+        return line
+    fields = line.split(delimiter)
+    return delimiter.join(fields[first - 1:None if last is None else (last or first)])
 
 
 class UpdateFile:
+    # Whether the variant checks need the strings of the file.
+    scan_strings = True
+
 
     def __init__(self,
                  path,
@@ -39,11 +245,13 @@ class UpdateFile:
         self.path = path
         self.local_name = os.path.basename(self.path)
         self.remote_name = None
-        self.sha256sum = sha256sum(path)
-        self.manifest = manifest
-        self.manifest_match = False
         self.family_given = family_given
         self.variant_given = variant_given
+        self.analysis = analyze_file(path, strings=self.scan_strings and (
+            family_given is None or variant_given is None))
+        self.sha256sum = self.analysis["sha256"]
+        self.manifest = manifest
+        self.manifest_match = False
         self.variant_family_detected, self.variant_specific_detected = self._test_for_variant(
         )
         if self.manifest is not None:
@@ -59,10 +267,12 @@ class UpdateFile:
                                                     self.sha256sum,
                                                     self.manifest_match)
 
-    def variant_specific_check_command(self):
+    def variant_specific_text(self):
+        """ Text the specific variant is recognized in, None if there's none. """
         raise NotImplementedError
 
-    def variant_family_check_command(self):
+    def variant_family_text(self):
+        """ Text the variant family is recognized in, None if there's none. """
         raise NotImplementedError
 
     def _test_for_variant(self):
@@ -70,45 +280,27 @@ class UpdateFile:
             return (self.family_given, self.variant_given)
         v_family = None
         v_specific = None
-        if self.variant_family_check_command() is not None:
-            run = subprocess.run(
-                str(self.variant_family_check_command()).format(self.path),
-                shell=True,
-                check=True,
-                encoding="utf-8",
-                stdout=subprocess.PIPE)
-            if run.returncode != 0:
-                raise ValueError(
-                    "{0} created for path {1}, but that file does not seem to be a {0} or does not exist"
-                    .format(self.__class__.__name__, self.path))
-            v_family = IrisRemote.Variant if "iris030" in run.stdout else HubRemote.Variant if "faroshub04" in run.stdout else \
-                        CPERemote.Variant if "cpe" in run.stdout else VgerRemote.Variant if "vger" in run.stdout else None
+        family_text = self.variant_family_text()
+        if family_text is not None:
+            v_family = IrisRemote.Variant if "iris030" in family_text else HubRemote.Variant if "faroshub04" in family_text else \
+                        CPERemote.Variant if "cpe" in family_text else VgerRemote.Variant if "vger" in family_text else None
         # Specific
-        if v_family is not None and self.variant_specific_check_command(
-        ) is not None:
-            if self.variant_specific_check_command() is not None:
-                run2 = subprocess.run(
-                    str(self.variant_specific_check_command()).format(self.path),
-                    shell=True,
-                    check=True,
-                    encoding="utf-8",
-                    stdout=subprocess.PIPE)
-                if run2.returncode != 0:
-                    raise ValueError("command failed? {}".format(str(run2.args)))
-                else:
-                    if v_family is IrisRemote.Variant:
-                        v_specific = IrisRemote.Variant.UE if "ue" in run2.stdout else IrisRemote.Variant.RRH if "rrh" in run2.stdout else IrisRemote.Variant.STANDARD if "iris030" in run2.stdout else None
-                    elif v_family is HubRemote.Variant:
-                        if "-faroshub04b-" in run2.stdout or "-faroshub04_somzu9eg-" in run2.stdout or "-faroshub04_somzu9eg_sdr-" in run2.stdout or "-faroshub04_somzu9eg_rrh-" in run2.stdout:
-                            v_specific = HubRemote.Variant.SOM9
-                        elif "-faroshub04-" in run2.stdout or "-faroshub04_somzu6eg-" in run2.stdout or "-faroshub04_somzu6eg_sdr-" in run2.stdout or "-faroshub04_somzu6eg_rrh-" in run2.stdout:
-                            v_specific = HubRemote.Variant.SOM6
-                        else:
-                            v_specific = None
-                    elif v_family is CPERemote.Variant:
-                        v_specific = CPERemote.Variant.STANDARD
-                    elif v_family is VgerRemote.Variant:
-                        v_specific = VgerRemote.Variant.VGER
+        if v_family is not None:
+            specific_text = self.variant_specific_text()
+            if specific_text is not None:
+                if v_family is IrisRemote.Variant:
+                    v_specific = IrisRemote.Variant.UE if "ue" in specific_text else IrisRemote.Variant.RRH if "rrh" in specific_text else IrisRemote.Variant.STANDARD if "iris030" in specific_text else None
+                elif v_family is HubRemote.Variant:
+                    if "-faroshub04b-" in specific_text or "-faroshub04_somzu9eg-" in specific_text or "-faroshub04_somzu9eg_sdr-" in specific_text or "-faroshub04_somzu9eg_rrh-" in specific_text:
+                        v_specific = HubRemote.Variant.SOM9
+                    elif "-faroshub04-" in specific_text or "-faroshub04_somzu6eg-" in specific_text or "-faroshub04_somzu6eg_sdr-" in specific_text or "-faroshub04_somzu6eg_rrh-" in specific_text:
+                        v_specific = HubRemote.Variant.SOM6
+                    else:
+                        v_specific = None
+                elif v_family is CPERemote.Variant:
+                    v_specific = CPERemote.Variant.STANDARD
+                elif v_family is VgerRemote.Variant:
+                    v_specific = VgerRemote.Variant.VGER
         return (v_family, v_specific)
 
 
@@ -121,23 +313,25 @@ class ImageUB(UpdateFile):
         else:
             self.remote_name = "image.ub"
 
-    def variant_family_check_command(self):
-        return "strings {} | grep PetaLinux | cut -d'/' -f3"
+    def variant_family_text(self):
+        # What `strings | grep PetaLinux | cut -d'/' -f3` prints.
+        return "".join(_cut_fields(line, "/", 3) + "\n" for line in self.analysis["petalinux"])
 
-    def variant_specific_check_command(self):
+    def variant_specific_text(self):
         return None
 
 class Ps7Init(UpdateFile):
+    scan_strings = False
 
     def __init__(self, path, manifest=None, variant_given=None):
         super().__init__(path, manifest=None, variant_given=variant_given) # Not in manifest, always set to None
 
         self.remote_name = "ps7_init.tcl" # Should never need to copy this file
 
-    def variant_family_check_command(self):
+    def variant_family_text(self):
         return None
 
-    def variant_specific_check_command(self):
+    def variant_specific_text(self):
         return None
 
 class BootBin(UpdateFile):
@@ -146,28 +340,33 @@ class BootBin(UpdateFile):
         super().__init__(path, manifest=manifest, variant_given=variant_given)
         self.remote_name = "BOOT.BIN"
 
-    def variant_family_check_command(self):
-        return "strings {} | grep -i preboot | cut -d' ' -f4- | xargs | cut -d';' -f1"
+    def variant_family_text(self):
+        # What `strings | grep -i preboot | cut -d' ' -f4- | xargs | cut -d';' -f1` prints.
+        words = " ".join(_cut_fields(line, " ", 4, None) for line in self.analysis["preboot"]).split()
+        return " ".join(words).split(";")[0] + "\n"
 
-    def variant_specific_check_command(self):
+    def variant_specific_text(self):
         return None
 
 
 class BootBit(UpdateFile):
+    scan_strings = False
 
     def __init__(self, path, manifest=None, variant_given=None):
         super().__init__(path, manifest=manifest, variant_given=variant_given)
         #assert (issubclass(variant_given, CPERemote.Variant)) Sometimes detected.
         self.remote_name = "sklk_cpe_top.bin"
 
-    def variant_family_check_command(self):
+    def variant_family_text(self):
         return None
 
-    def variant_specific_check_command(self):
+    def variant_specific_text(self):
         return None
 
 
 class TarballFile(UpdateFile):
+    # The variant is in the name of the tarball.
+    scan_strings = False
 
     def __init__(self,
                  path,
@@ -183,11 +382,11 @@ class TarballFile(UpdateFile):
         log.debug("tarballfile made")
         self.unpackpath = unpackpath
 
-    def variant_family_check_command(self):
-        return "ls {}"
+    def variant_family_text(self):
+        return self.path
 
-    def variant_specific_check_command(self):
-        return "ls {}"
+    def variant_specific_text(self):
+        return self.path
 
     def unpack(self):
         if self.unpackpath is None:
@@ -208,6 +407,7 @@ class TarballFile(UpdateFile):
             if os.path.isfile(auto_path_hdf):
                 logging.debug("Found vger_auto.hdf")
                 shutil.unpack_archive(auto_path_hdf, self.unpackpath, format="zip")
+            note_unpacked(self.path, self.unpackpath)
 
     def set_unpackdir(self, unpackdir):
         if self.unpackpath is not None:
@@ -13,17 +13,27 @@
 import argparse
 import asyncio
 import logging
+import os
 import pprint
+import random
+import secrets
+import shlex
 import sys
 import time
-from functools import reduce
+import zlib
+from collections import OrderedDict
+from enum import Enum
+from functools import partial, reduce
 
 import SoapySDR
+import aiohttp
 import asyncssh
 from typing import Iterable
 
-from pyfaros.discover.discover import Discover, Remote, IrisRemote, HubRemote
+from pyfaros.discover.discover import Discover, Remote, IrisRemote, HubRemote, is_ipv4
+from pyfaros.discover.discover import AsyncExitStack, asynccontextmanager
 from pyfaros.updater.update_environment import UpdateEnvironment
+from pyfaros.updater.journal import UpdateJournal
 
 log = logging.getLogger(__name__)
 
@@ -32,98 +42,518 @@ class UpdateError(Exception):
     pass
 
 
-async def transfer_files(device, file_list, tmpdir):
-    mkdir_cmd = "mkdir /tmp/updater_{}".format(tmpdir)
+class FailurePolicy(Enum):
+    """
+    What a failed device means for the others, see UpdatePipeline.  Devices
+    that already started writing /boot always finish.
+    """
+    CONTINUE = "continue"
+    ABORT_WAVE = "abort-wave"
+    ABORT_ALL = "abort-all"
+
+
+class UpdateResult:
+    """ How far the update of one device got. """
+
+    def __init__(self, device):
+        self.device = device
+        self.phase = None
+        self.error = None
+        self.aborted = False
+        self.up_to_date = False
+        self.rebooted = False
+
+    def __str__(self):
+        if self.up_to_date:
+            state = "already up to date"
+        elif self.error is not None:
+            state = "failed during {}: {}".format(self.phase, self.error)
+        elif self.aborted:
+            state = "aborted before {}".format(self.phase)
+        elif self.rebooted:
+            state = "updated"
+        else:
+            state = "stopped during {}".format(self.phase)
+        return "{}: {}".format(self.device.serial, state)
+
+    def __repr__(self):
+        return str(self)
+
+
+async def make_tmpdir(device, tmpdir):
+    mkdir_cmd = "mkdir -p /tmp/updater_{}".format(tmpdir)
     try:
-        await device.ssh_connection.run(mkdir_cmd, check=True, term_type='xterm')
+        await device.run_many([mkdir_cmd, ])
     except Exception as e:
         logging.debug("{} - {} - {}".format(device, mkdir_cmd, e))
         raise e
+
+
+COMPRESS_CHUNK = 256 * 1024
+
+
+class TokenBucket:
+    """ Caps the aggregate rate of everything passing through consume(). """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._tokens = self.burst
+        self._last = None
+
+    async def consume(self, amount):
+        now = asyncio.get_event_loop().time()
+        if self._last is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        # Going into debt and sleeping it off keeps concurrent callers fair.
+        self._tokens -= amount
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+def _gzip_file(path):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    chunks = []
+    with open(path, mode='rb') as file_handle:
+        for buf in iter(partial(file_handle.read, COMPRESS_CHUNK), b''):
+            chunks.append(compressor.compress(buf))
+    chunks.append(compressor.flush())
+    return b''.join(chunks)
+
+
+def _read_file(path):
+    with open(path, mode='rb') as file_handle:
+        return file_handle.read()
+
+
+async def file_payload(my_file, compress=False, payloads=None):
+    """
+    Returns the content of my_file, gzip compressed if `compress` is set.
+    Given `payloads`, a dict owned by the caller (see UpdateScheduler), each
+    file is read and compressed once however many devices it is sent to.
+    """
+    read = partial(asyncio.get_event_loop().run_in_executor,
+                   None, _gzip_file if compress else _read_file, my_file.path)
+    if payloads is None:
+        return await read()
+    key = (my_file.path, compress)
+    if key not in payloads:
+        payloads[key] = asyncio.ensure_future(read())
+    return await payloads[key]
+
+
+async def copy_file(device, my_file, tmpdir, compress=False, bucket=None, payloads=None):
+    """
+    Copies my_file to the device, as a gzip stream decompressed on the fly
+    by the device if `compress` is set.  Given a TokenBucket the file is
+    streamed at the rate it allows.  Callers verify the result.
+    """
+    try:
+        if compress or bucket is not None:
+            payload = await file_payload(my_file, compress=compress, payloads=payloads)
+            stream_cmd = "{} > /tmp/updater_{}/{}".format(
+                "gunzip -c" if compress else "cat", tmpdir, my_file.local_name)
+            process = await device.ssh_connection.create_process(stream_cmd, encoding=None)
+            for offset in range(0, len(payload), COMPRESS_CHUNK):
+                chunk = payload[offset:offset + COMPRESS_CHUNK]
+                if bucket is not None:
+                    await bucket.consume(len(chunk))
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+            process.stdin.write_eof()
+            await process.wait(check=True)
+            logging.debug("{} - sent {} as {} bytes".format(
+                device.serial, my_file.local_name, len(payload)))
+        else:
+            await asyncssh.scp(
+                my_file.path,
+                (device.ssh_connection, "/tmp/updater_{}/".format(tmpdir)))
+    except Exception as e:
+        logging.debug("{} - {} - {}".format(device, "stream" if compress or bucket else "scp", e))
+        raise e
+
+
+def _sha256sum_command(file_list, tmpdir):
+    return "sha256sum {}".format(" ".join(
+        "/tmp/updater_{}/{}".format(tmpdir, my_file.local_name) for my_file in file_list))
+
+
+async def verify_files(device, file_list, tmpdir):
+    """ Checks the copies of file_list on the device with one sha256sum. """
+    file_list = [my_file for my_file in file_list if my_file is not None]
+    if not file_list:
+        return True
+    sha_cmd = _sha256sum_command(file_list, tmpdir)
+    try:
+        output = (await device.run_many([sha_cmd, ]))[0][1]
+    except Exception as e:
+        logging.debug("{} - {} - {}".format(device, sha_cmd, e))
+        raise e
+    return _check_copies(device, file_list, output)
+
+
+def _check_copies(device, file_list, output):
+    """ Raises ValueError unless the sha256sum output matches file_list. """
+    checksums = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            checksums[os.path.basename(fields[1])] = fields[0]
     for my_file in file_list:
-        if my_file is not None:
-            try:
-                await asyncssh.scp(
-                    my_file.path,
-                    (device.ssh_connection, "/tmp/updater_{}/".format(tmpdir)))
-            except Exception as e:
-                logging.debug("{} - {} - {}".format(device, "scp", e))
-                raise e
-    for my_file in file_list:
-        if my_file is not None:
-            try:
-                sha_cmd = "sha256sum /tmp/updater_{}/{}".format(tmpdir,
-                                                                my_file.local_name)
-                res = await device.ssh_connection.run(
-                    sha_cmd, term_type='xterm', check=True)
-            except Exception as e:
-                logging.debug("{} - {} - {}".format(device, sha_cmd, e))
-                raise e
-            if not res.stdout.split()[0] == my_file.sha256sum:
-                raise ValueError("Remote checksum didn't match after copy!")
+        if checksums.get(my_file.local_name) != my_file.sha256sum:
+            raise ValueError("Remote checksum didn't match after copy!")
         logging.debug(
             "file ({}):{} is on {} with proper checksum -\n\t\t{} == {}".format(
                 my_file.path, my_file.local_name, device.serial,
-                res.stdout.split()[0], my_file.sha256sum))
+                checksums[my_file.local_name], my_file.sha256sum))
     return True
 
 
-async def mount_boot(device):
+async def verify_file(device, my_file, tmpdir):
+    return await verify_files(device, [my_file], tmpdir)
+
+
+async def transfer_files(device, file_list, tmpdir, compress=False, bucket=None, payloads=None):
+    await make_tmpdir(device, tmpdir)
+    for my_file in file_list:
+        if my_file is not None:
+            await copy_file(device, my_file, tmpdir, compress=compress, bucket=bucket,
+                            payloads=payloads)
+    return await verify_files(device, file_list, tmpdir)
+
+
+# Relay seeds listen on a port of this range picked for each run, see
+# distribute_files.
+RELAY_PORTS = (20000, 60000)
+
+
+class Relay:
+    """
+    A busybox httpd a relay seed runs for one update.  It listens on the
+    seed's own address only, and on a port picked at random for the run.
+    The files are served only under a random token path, from a home
+    directory holding nothing but a link to /tmp/updater_<timestamp>.
+    """
+
+    def __init__(self, address, tmpdir):
+        self.address = address
+        self.tmpdir = tmpdir
+        self.port = random.SystemRandom().randint(*RELAY_PORTS)
+        self.token = secrets.token_hex(16)
+        self.home = "/tmp/updater_relay_{}".format(self.token)
+        self.pid = None
+
+    def url(self, my_file):
+        return "http://{}:{}/{}/{}".format(self.address, self.port, self.token, my_file.local_name)
+
+    def start_command(self):
+        # In the foreground of a nohup'd background job so its pid is known.
+        return ("mkdir -m 700 {home} && ln -s /tmp/updater_{tmpdir} {home}/{token} && "
+                "(nohup busybox httpd -f -p {address}:{port} -h {home} "
+                "> /dev/null 2>&1 < /dev/null & echo $!)").format(
+                    home=self.home, tmpdir=self.tmpdir, token=self.token,
+                    address=self.address, port=self.port)
+
+    def stop_command(self):
+        return "kill {}; rm -rf {}".format(self.pid, self.home)
+
+
+async def open_relay(seed, tmpdir):
+    """
+    Serves the seed's update directory over HTTP so the rest of its group can
+    fetch the files locally.  Returns the Relay the others should fetch from,
+    or None if the seed can't serve them.
+    """
     try:
-        current_mounts = await device.ssh_connection.run(
-            "cat /proc/mounts", term_type='xterm', check=True)
-        if "/boot" in current_mounts.stdout:
-            await device.ssh_connection.run(
-                "sudo -n /bin/umount /boot", term_type='xterm', check=True)
-        # await device.ssh_connection.run("sudo -n /sbin/fsck -a -w /dev/mmcblk0p1", term_type='xterm', check=True)
-        await device.ssh_connection.run(
-            "sudo -n /bin/mount /boot -o rw", term_type='xterm', check=True)
-        logging.debug("{} - fsck'd and boot mounted".format(device.serial))
-        return True
+        if is_ipv4(seed.ip_address):
+            address = seed.ip_address
+        else:
+            # Link-local IPv6 addresses are scoped to our interface, the
+            # other devices need one of the seed's own addresses.
+            address = (await seed.run_many([
+                "ip -4 -o addr show scope global | awk '{print $4}' | cut -d/ -f1 | head -n 1", ]))[0][1]
+            address = address.strip() or None
+        if address is None:
+            logging.info("{} has no address to relay files from".format(seed.serial))
+            return None
+        relay = Relay(address, tmpdir)
+        relay.pid = int((await seed.run_many([relay.start_command(), ]))[0][1].strip())
+        return relay
     except Exception as e:
-        logging.debug("{} - {} - {}: Dump".format(device, "checking boot", e))
-        raise e
+        logging.info("Unable to relay files from {}: {}".format(seed.serial, e))
+        return None
 
 
-async def replace_files(device, file_list, tmpdir, store_ssh=False):
-    for my_file in file_list:
-        logging.debug(my_file)
-        copy_command = "sudo -n cp /tmp/updater_{}/{} /boot/{}".format(
-            tmpdir, my_file.local_name, my_file.remote_name)
+async def close_relay(seed, relay):
+    """ Stops a relay, only logging a seed which can't be reached anymore. """
+    try:
+        status, _, errors = (await seed.run_many([relay.stop_command(), ], check=False))[0]
+    except (asyncssh.Error, OSError) as e:
+        status, errors = None, e
+    if status != 0:
+        logging.warning("{} - unable to stop its relay: {}".format(seed.serial, errors))
+
+
+async def relay_file(device, my_file, tmpdir, relay, compress=False, bucket=None, payloads=None):
+    """ Fetches my_file from a relay seed, falling back to a direct copy. """
+    if relay is not None:
+        wget_cmd = "wget -q -O /tmp/updater_{}/{} {}".format(
+            tmpdir, my_file.local_name, relay.url(my_file))
         try:
-            await device.ssh_connection.run(
-                copy_command, check=True, term_type='xterm')
+            # Fetched and checked in one batch, see Remote.run_many.
+            results = await device.run_many([wget_cmd, _sha256sum_command([my_file, ], tmpdir)])
+            return _check_copies(device, [my_file, ], results[1][1])
         except Exception as e:
-            logging.debug("FAILED: {} - {}".format(device, copy_command))
-            logging.debug(e)
-            logging.debug("Copy of {} -> {} failed on remote target {}".format(
-                my_file.local_name, my_file.remote_name, device.serial))
-            raise e
-    if store_ssh:
+            logging.info("{} - relay of {} from {} failed, copying directly: {}".format(
+                device.serial, my_file.local_name, relay.address, e))
+    await copy_file(device, my_file, tmpdir, compress=compress, bucket=bucket, payloads=payloads)
+    await verify_file(device, my_file, tmpdir)
+    return True
+
+
+def schedule_distribution(devices, files_for, tmpdir, compress=False, scheduler=None):
+    """
+    Starts copying the files of every device the way transfer_files would,
+    but each file crosses the link to the management host once per hub.
+    Devices behind the same hub that need the same file form a group: the
+    file is copied to the first of them (the seed), which then serves it to
+    the others over HTTP.  Devices without a hub, or whose relay fails, get a
+    direct copy.  Every copy is verified.
+
+    Returns an OrderedDict of device to a future completing once that device
+    holds all of its files, a dict of seed to a future completing once the
+    fetches its relay serves are done and the relay is stopped (the seed
+    must not reboot before), and a future to await once done with the files
+    which stops the relays left.  Copies respect the limits of `scheduler`.
+    """
+    scheduler = scheduler if scheduler is not None else UpdateScheduler.unlimited()
+
+    async def prepare(device):
+        await scheduler.connect(device)
+        await make_tmpdir(device, tmpdir)
+
+    mkdirs = dict((d, asyncio.ensure_future(prepare(d))) for d in devices)
+
+    groups = OrderedDict()
+    for device in devices:
+        hub = getattr(device, "hub", None)
+        group = hub.serial if hub is not None else device.serial
+        for my_file in files_for(device):
+            if my_file is not None:
+                groups.setdefault((group, my_file.path), (my_file, []))[1].append(device)
+
+    relays = {}
+
+    def relay_for(seed):
+        if seed not in relays:
+            relays[seed] = asyncio.ensure_future(open_relay(seed, tmpdir))
+        return relays[seed]
+
+    async def seed_copy(seed, my_file):
+        await mkdirs[seed]
+        async with scheduler.slot(seed):
+            await copy_file(seed, my_file, tmpdir, compress=compress, bucket=scheduler.bucket,
+                            payloads=scheduler.payloads)
+        await verify_file(seed, my_file, tmpdir)
+
+    async def member_copy(device, my_file, seed, seeded):
+        await mkdirs[device]
         try:
-            store_ssh_command = "[ -d /etc/iris/ssh/] || [ -d /boot/ssh ] || sudo -n cp -r /var/run/ssh /boot"
-            result = await device.ssh_connection.run(
-                store_ssh_command, check=False, term_type='xterm')
-
-            if result.exit_status == 0:
-                logging.info("SSH keys for device {} are present".format(device))
-            else:
-                logging.warn("Failed to store SSH keys for device {}".format(device))
-        except Exception as e:
-            logging.debug("FAILED: {} - {}".format(device, copy_command))
-            logging.debug(e)
-            logging.debug("Store SSH Keysfailed on remote target {}".format(
-                device.serial))            
+            await seeded
+            relay = await relay_for(seed)
+        except Exception:
+            # The seed failed on its own, the copy falls back to scp.
+            relay = None
+        async with scheduler.slot(device):
+            return await relay_file(
+                device, my_file, tmpdir, relay, compress=compress, bucket=scheduler.bucket,
+                payloads=scheduler.payloads)
 
-    try:
-        await device.ssh_connection.run(
-            "sudo -n /bin/sync", check=True, term_type='xterm')
-        await device.ssh_connection.run(
-            "sudo -n /bin/umount /boot", check=True, term_type='xterm')
-        # await device.ssh_connection.run("sudo -n /sbin/fsck -a -w /dev/mmcblk0p1", check=True, term_type='xterm')
+    stopped = {}
+
+    def stop_relay(seed):
+        if seed not in stopped:
+            stopped[seed] = asyncio.ensure_future(_stop_relay(seed))
+        return stopped[seed]
+
+    async def _stop_relay(seed):
+        relay = await relays[seed] if seed in relays else None
+        if relay is not None:
+            await close_relay(seed, relay)
+
+    async def serve(seed, fetches):
+        await asyncio.wait(fetches)
+        await stop_relay(seed)
+
+    steps = OrderedDict((d, [mkdirs[d], ]) for d in devices)
+    fetches = OrderedDict()
+    for my_file, members in groups.values():
+        seed = members[0]
+        seeded = asyncio.ensure_future(seed_copy(seed, my_file))
+        steps[seed].append(seeded)
+        for device in members[1:]:
+            fetch = asyncio.ensure_future(member_copy(device, my_file, seed, seeded))
+            steps[device].append(fetch)
+            fetches.setdefault(seed, []).append(fetch)
+    served = OrderedDict(
+        (seed, asyncio.ensure_future(serve(seed, seed_fetches))) for seed, seed_fetches in fetches.items())
+
+    async def device_done(device):
+        results = await asyncio.gather(*steps[device], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
         return True
-    except Exception as e:
-        logging.debug("{} - {} - {}".format(device, "sudo -n /bin/sync", e))
-        raise e
+
+    transfers = OrderedDict((d, asyncio.ensure_future(device_done(d))) for d in devices)
+
+    async def cleanup():
+        if transfers:
+            await asyncio.wait(list(transfers.values()))
+        await asyncio.gather(*[stop_relay(seed) for seed in list(relays)])
+
+    return transfers, served, asyncio.ensure_future(cleanup())
+
+
+async def distribute_files(devices, files_for, tmpdir, compress=False, scheduler=None):
+    """ Waits for schedule_distribution, raising UpdateError on any failure. """
+    transfers, _, cleanup = schedule_distribution(
+        devices, files_for, tmpdir, compress=compress, scheduler=scheduler)
+    results = await asyncio.gather(*transfers.values(), return_exceptions=True)
+    await cleanup
+    exceptions = [e for e in results if isinstance(e, Exception)]
+    if exceptions:
+        raise UpdateError(exceptions)
+    return True
+
+
+# Marks the end of each step's output in install_script, followed by the
+# step name and its exit status.
+STEP_MARKER = "@@updater-step"
+
+
+def install_script(file_list, tmpdir, store_ssh=False):
+    """
+    Returns a shell script which mounts /boot read-write, copies file_list
+    into it from /tmp/updater_<tmpdir>, optionally stores the SSH keys, then
+    syncs and unmounts /boot, so a device is updated in one exec rather
+    than one per command.  It stops at the first step which fails, storing
+    SSH keys is allowed to fail.
+    """
+    steps = [("mount", "if grep -qs /boot /proc/mounts; then sudo -n /bin/umount /boot || exit; fi; "
+                       "sudo -n /bin/mount /boot -o rw", True)]
+    for my_file in file_list:
+        steps.append(("copy:{}".format(my_file.remote_name), "sudo -n cp {} {}".format(
+            shlex.quote("/tmp/updater_{}/{}".format(tmpdir, my_file.local_name)),
+            shlex.quote("/boot/{}".format(my_file.remote_name))), True))
+    if store_ssh:
+        steps.append(("store_ssh",
+                      "[ -d /etc/iris/ssh/ ] || [ -d /boot/ssh ] || sudo -n cp -r /var/run/ssh /boot", False))
+    steps.append(("sync", "sudo -n /bin/sync", True))
+    steps.append(("umount", "sudo -n /bin/umount /boot", True))
+
+    lines = []
+    for name, command, required in steps:
+        lines.append('( {} ) 2>&1; s=$?; echo "{} {} $s"'.format(
+            command, STEP_MARKER, name))
+        if required:
+            lines.append('[ $s -eq 0 ] || exit $s')
+    return "\n".join(lines) + "\n"
+
+
+def parse_install_output(output):
+    """
+    Splits the output of install_script into an OrderedDict of step name to
+    (exit status, output of the step).
+    """
+    steps = OrderedDict()
+    pending = []
+    for line in output.splitlines():
+        line = line.rstrip("\r")
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == STEP_MARKER and fields[2].isdigit():
+            steps[fields[1]] = (int(fields[2]), "\n".join(pending))
+            pending = []
+        else:
+            pending.append(line)
+    return steps
+
+
+async def install_files(device, file_list, tmpdir, store_ssh=False):
+    """
+    Mounts /boot, copies file_list from /tmp/updater_<tmpdir> into it, and
+    syncs and unmounts it, all in one exec.  Returns the steps as parsed by
+    parse_install_output, raising UpdateError naming the step which failed.
+    """
+    script = install_script(file_list, tmpdir, store_ssh=store_ssh)
+    res = await device.ssh_connection.run(
+        "sh -c {}".format(shlex.quote(script)), check=False, term_type='xterm')
+    steps = parse_install_output(res.stdout)
+    for name, (status, output) in steps.items():
+        logging.debug("{} - {} exited {}{}".format(
+            device.serial, name, status, ":\n" + output if output else ""))
+    if "store_ssh" in steps:
+        if steps["store_ssh"][0] == 0:
+            logging.info("SSH keys for device {} are present".format(device))
+        else:
+            logging.warn("Failed to store SSH keys for device {}".format(device))
+    if res.exit_status != 0 or "umount" not in steps:
+        failed = next((name for name, (status, _) in steps.items() if status != 0), None)
+        if failed is None:
+            raise UpdateError("{} - install exited {}: {}".format(
+                device.serial, res.exit_status, res.stdout.strip()))
+        raise UpdateError("{} - {} failed: {}".format(device.serial, failed, steps[failed][1].strip()))
+    return steps
+
+
+async def current_checksums(device, file_list):
+    """
+    Returns the sha256 of the files in /boot that file_list would replace,
+    keyed by remote name.  /boot is mounted read-only for the check if it
+    isn't mounted already.
+    """
+    paths = " ".join("/boot/{}".format(my_file.remote_name) for my_file in file_list)
+    sha_cmd = ("if grep -qs ' /boot ' /proc/mounts; then sha256sum {0}; "
+               "else sudo -n /bin/mount /boot -o ro && sha256sum {0}; sudo -n /bin/umount /boot; fi").format(paths)
+    res = await device.ssh_connection.run(sha_cmd, check=False, term_type='xterm')
+    checksums = {}
+    for line in res.stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            checksums[os.path.basename(fields[1])] = fields[0]
+    return checksums
+
+
+async def plan_update(devices, files_for, scheduler=None):
+    """
+    Checks every device at once and returns an OrderedDict of device to the
+    files it actually needs, leaving out the ones /boot already has.  A
+    device which can't be checked gets all of its files.
+    """
+    scheduler = scheduler if scheduler is not None else UpdateScheduler.unlimited()
+    wanted = OrderedDict(
+        (d, [my_file for my_file in files_for(d) if my_file is not None]) for d in devices)
+
+    async def check(device, file_list):
+        await scheduler.connect(device)
+        return await current_checksums(device, file_list)
+
+    results = await asyncio.gather(
+        *[check(d, file_list) for d, file_list in wanted.items()],
+        return_exceptions=True)
+    plan = OrderedDict()
+    for (device, file_list), checksums in zip(wanted.items(), results):
+        if isinstance(checksums, Exception):
+            logging.debug("{} - unable to check /boot, updating everything - {}".format(device, checksums))
+            checksums = {}
+        plan[device] = [
+            my_file for my_file in file_list
+            if checksums.get(my_file.remote_name) != my_file.sha256sum
+        ]
+        if not plan[device]:
+            logging.info("{} is already up to date".format(device.serial))
+    return plan
 
 
 async def do_reboot(device):
@@ -132,9 +562,258 @@ async def do_reboot(device):
     return True
 
 
-async def do_update(context, devices, store_ssh=False):
-    this_update_timestamp = str(time.time()).split('.')[0]
-    async with Remote.sshify(devices):
+class UpdateScheduler:
+    """
+    Limits how much of an update happens at once.  SSH connections are
+    opened at most `connect_concurrency` at a time (sshd drops handshakes
+    beyond MaxStartups), and at most `concurrency` devices copy files at
+    once, no more than `per_hub` of them behind any one hub and `per_chain`
+    on any one chain.  `bandwidth`, in bytes per second, caps the sum of all
+    copies.  None lifts a limit.
+
+    The files streamed to the devices are kept in `payloads` so each is read
+    once.  Used as an async context manager, connections opened through
+    connect() are closed and `payloads` is emptied on exit.
+    """
+
+    def __init__(self, concurrency=16, per_hub=4, per_chain=2, connect_concurrency=8, bandwidth=None):
+        self.concurrency = concurrency
+        self.per_hub = per_hub
+        self.per_chain = per_chain
+        self.connect_concurrency = connect_concurrency
+        self.bandwidth = bandwidth
+        self.bucket = TokenBucket(bandwidth) if bandwidth else None
+        self._semaphores = {}
+        self._connections = {}
+        self._stack = None
+        self.payloads = {}
+
+    @classmethod
+    def unlimited(cls):
+        return cls(concurrency=None, per_hub=None, per_chain=None, connect_concurrency=None)
+
+    async def __aenter__(self):
+        self._stack = AsyncExitStack()
+        await self._stack.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        stack, self._stack = self._stack, None
+        self._connections = {}
+        self.payloads = {}
+        return await stack.__aexit__(*exc_info)
+
+    def _semaphore(self, key, limit):
+        if limit is None:
+            return None
+        if key not in self._semaphores:
+            self._semaphores[key] = asyncio.Semaphore(limit)
+        return self._semaphores[key]
+
+    def _limits(self, device):
+        # Most specific first, so no one holds a global slot while waiting
+        # on a busy hub or chain.
+        hub = device if isinstance(device, HubRemote) else getattr(device, "hub", None)
+        limits = []
+        if hub is not None and isinstance(device, IrisRemote):
+            limits.append(self._semaphore(("chain", hub.serial, device.chain_index), self.per_chain))
+        if hub is not None:
+            limits.append(self._semaphore(("hub", hub.serial), self.per_hub))
+        limits.append(self._semaphore("all", self.concurrency))
+        return [limit for limit in limits if limit is not None]
+
+    @asynccontextmanager
+    async def slot(self, device):
+        """ Held while copying files to device. """
+        acquired = []
+        try:
+            for semaphore in self._limits(device):
+                await semaphore.acquire()
+                acquired.append(semaphore)
+            yield
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+    def connect(self, device):
+        """
+        Returns a future completing once device has an SSH connection, opened
+        once and kept until the scheduler exits.  Devices connected by the
+        caller are left alone.
+        """
+        if device not in self._connections:
+            self._connections[device] = asyncio.ensure_future(self._connect(device))
+        return self._connections[device]
+
+    async def _connect(self, device):
+        if device.ssh_connection is not None:
+            return device.ssh_connection
+        if self._stack is None:
+            raise UpdateError("{} is not connected".format(device.serial))
+        semaphore = self._semaphore("connect", self.connect_concurrency)
+        if semaphore is None:
+            return await self._stack.enter_async_context(device.ssh_connect())
+        async with semaphore:
+            return await self._stack.enter_async_context(device.ssh_connect())
+
+    async def transfer(self, device, file_list, tmpdir, compress=False):
+        await self.connect(device)
+        async with self.slot(device):
+            return await transfer_files(device, file_list, tmpdir, compress=compress, bucket=self.bucket,
+                                        payloads=self.payloads)
+
+
+class _Aborted(Exception):
+    pass
+
+
+class UpdatePipeline:
+    """
+    Takes each device through transfer (and verify), install (see
+    install_files) and reboot on its own, so a slow device holds up no one
+    but the devices it powers.  A device reboots once every device it powers has rebooted or
+    given up, because rebooting a hub (or an Iris earlier in a chain) cuts
+    their power.
+
+    When a device fails, `policy` decides whether the others carry on
+    (CONTINUE), whether the devices of the same power wave stop
+    (ABORT_WAVE, a wave being a Discover.Sortings.POWER_DEPENDENCY key), or
+    whether all of them stop (ABORT_ALL).  Stopping happens before /boot is
+    mounted, installing is never interrupted.
+
+    A device serving files to others (a relay seed, see
+    schedule_distribution) also waits for those transfers, and for its relay
+    to stop, before rebooting.
+
+    Every phase a device completes is recorded in `journal` if given.
+    """
+
+    def __init__(self, devices, policy=FailurePolicy.ABORT_ALL, journal=None):
+        self.devices = list(devices)
+        self.policy = policy
+        self.journal = journal
+        self.results = OrderedDict((d, UpdateResult(d)) for d in self.devices)
+        self._aborted_waves = set()
+        self._aborted_all = False
+        self._finished = None
+        self._served = {}
+
+    @staticmethod
+    def wave(device):
+        return tuple(Discover.Sortings.POWER_DEPENDENCY(device))
+
+    @staticmethod
+    def powers(device, other):
+        """ True if rebooting device cuts the power of other. """
+        if isinstance(device, HubRemote):
+            return getattr(other, "hub", None) is device
+        if isinstance(device, IrisRemote) and isinstance(other, IrisRemote):
+            return (device.hub is not None and device.hub is other.hub and
+                    device.chain_index == other.chain_index and
+                    (other.rrh_index or 0) > (device.rrh_index or 0))
+        return False
+
+    def _check(self, device, phase):
+        self.results[device].phase = phase
+        if self._aborted_all or self.wave(device) in self._aborted_waves:
+            raise _Aborted()
+
+    def _record(self, device, phase, **fields):
+        if self.journal is not None:
+            self.journal.record(device, phase, **fields)
+
+    def _fail(self, device, error):
+        result = self.results[device]
+        result.error = error
+        self._record(device, UpdateJournal.FAILED, during=result.phase, error=str(error))
+        logging.error("{} - update failed during {}: {}".format(device.serial, result.phase, error))
+        if self.policy is FailurePolicy.ABORT_WAVE:
+            self._aborted_waves.add(self.wave(device))
+        elif self.policy is FailurePolicy.ABORT_ALL:
+            self._aborted_all = True
+
+    async def _update(self, device, transfer, file_list, tmpdir, store_ssh, installed=False):
+        result = self.results[device]
+        try:
+            result.phase = "transfer"
+            await transfer
+            if not installed:
+                self._record(device, UpdateJournal.TRANSFERRED)
+                self._check(device, "install")
+                self._record(device, UpdateJournal.INSTALLING)
+                await install_files(device, file_list, tmpdir, store_ssh=store_ssh)
+                self._record(device, UpdateJournal.INSTALLED)
+            result.phase = "reboot"
+            await asyncio.gather(
+                *[self._finished[d].wait() for d in self.devices if self.powers(device, d)])
+            if device in self._served:
+                await self._served[device]
+            await do_reboot(device)
+            result.rebooted = True
+            self._record(device, UpdateJournal.REBOOTED)
+        except _Aborted:
+            result.aborted = True
+            self._record(device, UpdateJournal.ABORTED)
+        except Exception as e:
+            self._fail(device, e)
+        finally:
+            self._finished[device].set()
+
+    async def run(self, transfers, files_for, tmpdir, store_ssh=False, installed=(), served=None):
+        """
+        transfers maps each device to an awaitable copying its files there,
+        `served` maps a device to an awaitable completing once it is done
+        serving files to others.  Devices
+        in `installed` already have their files in /boot and are only
+        rebooted.  Returns the UpdateResults, in the order of the devices.
+        """
+        self._finished = dict((d, asyncio.Event()) for d in self.devices)
+        self._served = dict(served or {})
+        await asyncio.gather(*[
+            self._update(d, transfers[d], files_for(d), tmpdir, store_ssh, installed=d in installed)
+            for d in self.devices
+        ])
+        return list(self.results.values())
+
+
+async def resumable_files(device, file_list, tmpdir, scheduler):
+    """ True if the copies in /tmp/updater_<tmpdir> left by an earlier run still verify. """
+    try:
+        await scheduler.connect(device)
+        return await verify_files(device, file_list, tmpdir)
+    except Exception as e:
+        logging.debug("{} - not reusing files of update {}: {}".format(device.serial, tmpdir, e))
+        return False
+
+
+async def do_update(context, devices, store_ssh=False, relay=False, force=False, compress=False,
+                    policy=FailurePolicy.ABORT_ALL, scheduler=None, resume=None):
+    """
+    Updates devices and reboots them, each device on its own, see
+    UpdatePipeline.  Unless `force` is set, files the device already has in
+    /boot are skipped, and so are devices which need nothing.  Devices
+    start in Discover.Sortings.POWER_DEPENDENCY order within the limits of
+    `scheduler` (an UpdateScheduler with its default limits if None).
+
+    Progress is recorded in an UpdateJournal.  Given the journal of an
+    interrupted update as `resume`, devices pick up from the last phase
+    they completed in it: rebooted devices are left alone, installed ones
+    are only rebooted, and files the devices still have from it are reused
+    if they verify.
+
+    Returns an UpdateResult for every device.  Failures raise UpdateError
+    with the results of the failed devices once every device is done,
+    unless `policy` is FailurePolicy.CONTINUE.
+    """
+    if resume is not None:
+        journal = resume
+        this_update_timestamp = journal.timestamp
+    else:
+        this_update_timestamp = str(time.time()).split('.')[0]
+        journal = UpdateJournal(this_update_timestamp)
+    scheduler = scheduler if scheduler is not None else UpdateScheduler()
+    devices = sorted(devices, key=Discover.Sortings.POWER_DEPENDENCY)
+    async with scheduler:
         cmap_list = lambda d: [
             context.mapping[d.variant].bootbin,
             context.mapping[d.variant].imageub
@@ -144,88 +823,228 @@ async def do_update(context, devices, store_ssh=False):
             context.mapping[d.variant].imageub
         ]
 
-        copy_exceptions = await asyncio.gather(
-            *[
-                transfer_files(d, cmap_list(d), this_update_timestamp)
-                for d in devices
-            ],
-            return_exceptions=True)
+        resumed = OrderedDict()
+        finished = []
+        if resume is not None:
+            for d in devices:
+                if journal.phase(d) in UpdateJournal.DONE:
+                    finished.append(d)
+                    continue
+                files = journal.planned_files(d, cmap_list(d))
+                if files is not None:
+                    resumed[d] = files
+        fresh = [d for d in devices if d not in resumed and d not in finished]
 
-        copy_exceptions = [e for e in copy_exceptions if isinstance(e, Exception)]
-        logging.debug(copy_exceptions)
+        if force:
+            plan = OrderedDict(
+                (d, [my_file for my_file in cmap_list(d) if my_file is not None]) for d in fresh)
+        else:
+            plan = await plan_update(fresh, cmap_list, scheduler=scheduler)
+        for d in fresh:
+            journal.plan(d, plan[d])
+            if not plan[d]:
+                journal.record(d, UpdateJournal.UP_TO_DATE)
+        plan.update(resumed)
+        up_to_date = finished + [d for d in fresh if not plan[d]]
+        devices = [d for d in devices if plan.get(d)]
+        cmap_list = lambda d: plan[d]
 
-        if len(copy_exceptions) > 0:
-            raise UpdateError(copy_exceptions)
+        installed = [d for d in resumed if journal.phase(d) == UpdateJournal.INSTALLED]
+        # Whatever the device got to, files left from the update are reused
+        # if they verify.
+        candidates = [d for d in resumed if d not in installed]
+        reusable = await asyncio.gather(*[
+            resumable_files(d, plan[d], this_update_timestamp, scheduler) for d in candidates])
+        staged = installed + [d for d, ok in zip(candidates, reusable) if ok]
+        pending = [d for d in devices if d not in staged]
 
-        mount_exceptions = await asyncio.gather(
-            *[mount_boot(d) for d in devices], return_exceptions=True)
+        served = {}
+        if relay:
+            transfers, served, relay_cleanup = schedule_distribution(
+                pending, cmap_list, this_update_timestamp, compress=compress, scheduler=scheduler)
+        else:
+            transfers = OrderedDict(
+                (d, asyncio.ensure_future(
+                    scheduler.transfer(d, cmap_list(d), this_update_timestamp, compress=compress)))
+                for d in pending)
+            relay_cleanup = None
+        for d in staged:
+            logging.info("{} - resuming update {} from {}".format(
+                d.serial, this_update_timestamp, journal.phase(d)))
+            transfers[d] = scheduler.connect(d)
 
-        mount_exceptions = [e for e in mount_exceptions if isinstance(e, Exception)]
-        logging.debug(mount_exceptions)
+        pipeline = UpdatePipeline(devices, policy=policy, journal=journal)
+        try:
+            results = await pipeline.run(transfers, cmap_list, this_update_timestamp,
+                                         store_ssh=store_ssh, installed=installed, served=served)
+        finally:
+            if relay_cleanup is not None:
+                await relay_cleanup
 
-        if len(mount_exceptions) > 0:
-            raise UpdateError(mount_exceptions)
+    for device in up_to_date:
+        result = UpdateResult(device)
+        result.up_to_date = True
+        results.append(result)
+    for result in results:
+        logging.info(str(result))
+    failed = [result for result in results if result.error is not None]
+    if failed and policy is not FailurePolicy.CONTINUE:
+        raise UpdateError(failed)
+    return results
 
-        replace_exceptions = await asyncio.gather(
-            *[
-                replace_files(d, cmap_list(d), this_update_timestamp, store_ssh=store_ssh)
-                for d in devices
-            ],
-            return_exceptions=True)
-        
-        replace_exceptions = [e for e in replace_exceptions if isinstance(e, Exception)]
-        logging.debug(replace_exceptions)
 
-        if len(replace_exceptions) > 0:
-            raise UpdateError(replace_exceptions)
+async def prepare_devices(devices, enable_sudo=False, concurrency=16):
+    """
+    Enables sudo on (if `enable_sudo`) and detects the variant of devices,
+    `concurrency` devices at a time (None for all of them).
+    """
+    semaphore = asyncio.Semaphore(concurrency) if concurrency else None
 
-        for device in devices:
-            await do_reboot(device)
+    async def prepare(device):
+        if semaphore is not None:
+            await semaphore.acquire()
+        try:
+            if enable_sudo:
+                await device.async_enable_sudo()
+            await device.async_set_variant()
+        finally:
+            if semaphore is not None:
+                semaphore.release()
 
+    await asyncio.gather(*[prepare(device) for device in devices])
 
-async def find_devices(devices: Iterable[Remote]) -> bool:
-    found_devices = await asyncio.get_event_loop().run_in_executor(None, SoapySDR.Device.enumerate)
 
-    def find(device: Remote):
-        for found_dict in found_devices:
-            if 'serial' in found_dict and found_dict['serial'] == device.serial:
-                log.info('Found device {}'.format(device.serial))
-                return True
-        return False
+def _enumerated_serials(found_devices):
+    return set(found['serial'] for found in found_devices if 'serial' in found)
+
 
-    return all(find(device) for device in devices)
+class RebootTracker:
+    """
+    Waits for rebooted devices to come back, each one probed on its own
+    address: an HTTP GET of its status if it serves one, a TCP connect to
+    SSH otherwise, a SoapySDR enumeration if it has no address.  A device is
+    back once it answers after having been seen down, or after
+    `down_grace_s` if it was never seen down.  While a device is down its
+    probes back off from `min_interval` to `max_interval` seconds.
 
+    `returned` maps each device back to the seconds it took to return.
+    """
+    SSH_PORT = 22
 
-async def wait_for_devices(devices: Iterable[Remote], interval: int, timeout: int) -> bool:
-    start = time.time()
+    def __init__(self, devices, min_interval=1.0, max_interval=15.0, probe_timeout=3.0,
+                 down_grace_s=60.0, backoff=1.5):
+        self.devices = list(devices)
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.probe_timeout = probe_timeout
+        self.down_grace_s = down_grace_s
+        self.backoff = backoff
+        self.returned = OrderedDict()
+        self._pending = set(device.serial for device in self.devices)
+        self._enumeration = None
+        self._enumerated_at = None
 
-    while time.time() - start <= timeout:
-        if await find_devices(devices):
-            log.info('Found all devices after the update!')
-            return True
+    @property
+    def pending(self):
+        """ Serials of the devices not back yet. """
+        return set(self._pending)
 
-        # Only cause for concern if it starts taking more than a minute
-        if time.time() - start >= 60:
-            log.info('Unable to find all devices, retrying after {} seconds...'.format(interval))
+    async def _probe_http(self, device, session):
+        timeout = aiohttp.ClientTimeout(total=self.probe_timeout)
+        async with session.get(device._json_url, timeout=timeout) as response:
+            return response.status == 200
+
+    async def _probe_ssh(self, device):
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(device.ip_address, self.SSH_PORT), self.probe_timeout)
+        writer.close()
+        return True
+
+    async def _probe_enumeration(self, device):
+        loop = asyncio.get_event_loop()
+        # One enumeration answers for every device without an address.
+        if self._enumeration is None or loop.time() - self._enumerated_at >= self.min_interval:
+            self._enumerated_at = loop.time()
+            self._enumeration = asyncio.ensure_future(
+                loop.run_in_executor(None, SoapySDR.Device.enumerate))
+        return device.serial in _enumerated_serials(await self._enumeration)
+
+    async def probe(self, device, session):
+        """ True if device answers right now. """
+        try:
+            if getattr(device, "_json_url", None) is not None:
+                return await self._probe_http(device, session)
+            if getattr(device, "address", None) is not None:
+                return await self._probe_ssh(device)
+            return await self._probe_enumeration(device)
+        except (OSError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+            log.debug("{} - not answering: {}".format(device.serial, e))
+            return False
+
+    async def _track(self, device, session, start):
+        loop = asyncio.get_event_loop()
+        interval = self.min_interval
+        seen_down = False
+        while True:
+            up = await self.probe(device, session)
+            elapsed = loop.time() - start
+            if up and (seen_down or elapsed >= self.down_grace_s):
+                self.returned[device] = elapsed
+                self._pending.discard(device.serial)
+                log.info('Found device {} after {:.1f} seconds'.format(device.serial, elapsed))
+                return elapsed
+            if not up:
+                if seen_down:
+                    interval = min(self.max_interval, interval * self.backoff)
+                seen_down = True
+            await asyncio.sleep(interval)
+
+    async def wait(self, timeout):
+        """ Returns True once every device is back, False after `timeout` seconds. """
+        start = asyncio.get_event_loop().time()
+        async with aiohttp.ClientSession() as session:
+            tasks = [asyncio.ensure_future(self._track(d, session, start)) for d in self.devices]
+            if not tasks:
+                return True
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        if self._pending:
+            log.info('Devices not back after {} seconds: {}'.format(
+                timeout, ", ".join(sorted(self._pending))))
+        return not self._pending
 
-        await asyncio.sleep(interval)
 
+async def wait_for_devices(devices: Iterable[Remote], interval: int, timeout: int) -> bool:
+    """
+    Waits for each device to come back after a reboot, see RebootTracker,
+    polling a device that is down at most every `interval` seconds.
+    """
+    tracker = RebootTracker(devices, max_interval=interval)
+    if await tracker.wait(timeout):
+        log.info('Found all devices after the update!')
+        return True
     return False
 
 
 async def do_update_and_wait(context: UpdateEnvironment, devices: Iterable[Remote],
-                             interval: int, timeout: int, store_ssh=False) -> bool:
+                             interval: int, timeout: int, store_ssh=False, relay=False, force=False,
+                             compress=False, policy=FailurePolicy.ABORT_ALL, scheduler=None,
+                             resume=None) -> bool:
     """
     Returns True if the devices are found within `timeout` seconds after the update, False otherwise.
-    Devices are polled at an interval of `interval` seconds.
+    Devices still down are polled at most every `interval` seconds.
     """
-    await do_update(context, devices, store_ssh=store_ssh)
+    results = await do_update(context, devices, store_ssh=store_ssh, relay=relay, force=force,
+                              compress=compress, policy=policy, scheduler=scheduler, resume=resume)
+    devices = [result.device for result in results if result.rebooted]
 
     if not any(devices):
         log.info('No devices updated.')
         return True
 
-    await asyncio.sleep(interval)
     log.info('Devices updated. Waiting for them to reappear on the network...')
 
     return await wait_for_devices(devices, interval, timeout)
@@ -8,20 +8,24 @@
 #	DEALINGS IN THE SOFTWARE.
 #
 # Copyright (c) 2020, 2021 Skylark Wireless.
+import asyncio
 import copy
 import unittest.mock
 import os
 import site
 import json
+import tempfile
 import yaml
 
 filepath = os.path.dirname(os.path.abspath(__file__))
 site.addsitedir(os.path.join(filepath, '..', '..'))
 
-from test.utils import mock_imports
+from test.utils import mock_imports, LocalConnection
 
 with unittest.mock.patch('builtins.__import__', side_effect=mock_imports(["SoapySDR", ])):
     from pyfaros.discover import discover
+    from pyfaros.discover.cache import TopologyCache
+    from pyfaros.ssh import AsyncSshShell
 
 @unittest.mock.patch("time.sleep", autospec=True)
 class TestDiscover(unittest.TestCase):
@@ -93,16 +97,26 @@ class TestDiscover(unittest.TestCase):
         def enumerate(self, _):
             return self._devices
 
-    def run_with_config(self, test_config):
+    class CountingDevice(Device):
+        def __init__(self, passes):
+            self._passes = passes
+            self.calls = 0
+        def enumerate(self, _):
+            self.calls += 1
+            return self._passes[min(self.calls, len(self._passes)) - 1]
+
+    def run_with_config(self, test_config, device=None, fetched=None, **kwargs):
         async def mock_afetch(dev):
+            if fetched is not None:
+                fetched.append(dev.serial)
             dev._json = test_config["status"].get(dev.serial, {})
             return dev
 
         with unittest.mock.patch.object(discover.SoapySDR, "Device",
-                                        self.Device(test_config["enumerate"])) as SoapyDevice, \
+                                        device or self.Device(test_config["enumerate"])) as SoapyDevice, \
              unittest.mock.patch.object(discover.Remote, "afetch", mock_afetch), \
              unittest.mock.patch.object(discover.HubRemote, "_update_irises", autospec=True, return_value=None):
-            devices = discover.Discover()
+            devices = discover.Discover(**kwargs)
         print()
         print(devices)
         output = self.convert_discover_to_dict(devices)
@@ -190,3 +204,287 @@ class TestDiscover(unittest.TestCase):
         with open(os.path.join(filepath, "discover_daisy_chain.json"), "r") as fptr:
             test_config = json.load(fptr)
         self.run_with_config(test_config)
+
+    def test_enumerate_stops_when_stable(self, _):
+        with open(os.path.join(filepath, "test_discover.json"), "r") as fptr:
+            test_config = json.load(fptr)
+        device = self.CountingDevice([test_config["enumerate"], ])
+        with unittest.mock.patch.object(discover.SoapySDR, "Device", device):
+            enumerator = discover.SoapyEnumerator({}, passes=5, quiet_ms=0)
+            found = asyncio.new_event_loop().run_until_complete(enumerator.run())
+        # The second pass finds nothing new, so the third is never started.
+        self.assertEqual(2, device.calls)
+        self.assertEqual(len(test_config["enumerate"]), len(found))
+
+    def test_enumerate_runs_every_pass_by_default(self, _):
+        with open(os.path.join(filepath, "test_discover.json"), "r") as fptr:
+            test_config = json.load(fptr)
+        device = self.CountingDevice([test_config["enumerate"], ])
+        with unittest.mock.patch.object(discover.SoapySDR, "Device", device):
+            enumerator = discover.SoapyEnumerator({}, passes=3)
+            found = asyncio.new_event_loop().run_until_complete(enumerator.run())
+        # Without a quiet period a stable pass doesn't end the scan.
+        self.assertEqual(3, device.calls)
+        self.assertEqual(len(test_config["enumerate"]), len(found))
+
+    def test_enumerate_merges_late_devices(self, _):
+        with open(os.path.join(filepath, "test_discover.json"), "r") as fptr:
+            test_config = json.load(fptr)
+        everything = test_config["enumerate"]
+        device = self.CountingDevice([everything[:2], everything[:2], everything])
+        with unittest.mock.patch.object(discover.SoapySDR, "Device", device):
+            enumerator = discover.SoapyEnumerator({}, passes=3, quiet_ms=60000)
+            found = asyncio.new_event_loop().run_until_complete(enumerator.run())
+        self.assertEqual(3, device.calls)
+        self.assertEqual([x["serial"] for x in everything], [x["serial"] for x in found])
+
+    class FlakyRemote(object):
+        def __init__(self, serial, failures, hang=False, error=ConnectionRefusedError):
+            self.serial = serial
+            self.failures = failures
+            self.hang = hang
+            self.error = error
+            self.calls = 0
+            self.fetch_error = None
+        async def afetch(self):
+            self.calls += 1
+            if self.calls <= self.failures:
+                if self.hang:
+                    await asyncio.sleep(60)
+                raise self.error("no status")
+            return self
+
+    def test_fetch_scheduler_retries_and_reports_failures(self, _):
+        healthy = self.FlakyRemote("healthy", 1)
+        broken = self.FlakyRemote("broken", 10)
+        hung = self.FlakyRemote("hung", 10, hang=True)
+        incompatible = self.FlakyRemote("incompatible", 10, error=ValueError)
+        scheduler = discover.FetchScheduler(concurrency=2, timeout_ms=10, retries=2, backoff_ms=1)
+        results = asyncio.new_event_loop().run_until_complete(
+            scheduler.gather([healthy, broken, hung, incompatible]))
+        self.assertEqual([healthy, None, None, None], results)
+        self.assertEqual(2, healthy.calls)
+        self.assertEqual(3, broken.calls)
+        self.assertEqual(3, hung.calls)
+        # An unusable status isn't retried.
+        self.assertEqual(1, incompatible.calls)
+        self.assertEqual([broken, hung, incompatible], sorted(scheduler.failed, key=lambda x: x.serial))
+        self.assertIsInstance(broken.fetch_error, ConnectionRefusedError)
+        self.assertIsInstance(hung.fetch_error, asyncio.TimeoutError)
+        self.assertIsInstance(incompatible.fetch_error, ValueError)
+        self.assertIsNone(healthy.fetch_error)
+
+    class NoSsh(object):
+        async def __aenter__(self):
+            return []
+
+        async def __aexit__(self, *args):
+            return False
+
+    def test_chain_power(self, _):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        connection = LocalConnection()
+        hub = discover.HubRemote({"serial": "hub", "remote": "tcp://10.0.0.1:55132"})
+        hub.set_credentials("user", "secret")
+        hub._shell = asyncio.ensure_future(AsyncSshShell.open(connection, "secret"))
+        # chain_power takes 1-based chains, fails on chain 3 and takes the
+        # hub down on chain 4.
+        loop.run_until_complete(hub.run_many([
+            'sudo() { if [ "$1" = -n ]; then shift; "$@"; else read password; fi; }',
+            'chain_power() { echo "$1 chain $2"; [ "$2" != 3 ] || return 1; [ "$2" != 4 ] || exit; }',
+        ]))
+        with unittest.mock.patch.object(discover.Remote, "sshify", lambda remotes: self.NoSsh()):
+            results = loop.run_until_complete(hub.async_chain_power("reboot", [0, 2, 0, 3, 4]))
+        hub._close_shell()
+        loop.run_until_complete(connection.close())
+        loop.close()
+        asyncio.set_event_loop(None)
+        self.assertEqual([0, 2, 3, 4], list(results))
+        self.assertEqual((0, "reboot chain 1"), results[0])
+        self.assertEqual((1, "reboot chain 3"), results[2])
+        # Chains the shell never finished have no status.
+        self.assertEqual((None, ""), results[3])
+        self.assertEqual((None, ""), results[4])
+
+    def test_discover_with_cache(self, _):
+        with open(os.path.join(filepath, "test_discover.json"), "r") as fptr:
+            test_config = json.load(fptr)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "topology.json")
+            serials = [x["serial"] for x in test_config["enumerate"]]
+
+            # Nothing cached yet, everything is enumerated and fetched.
+            device, fetched = self.CountingDevice([test_config["enumerate"], ]), []
+            self.run_with_config(test_config, device=device, fetched=fetched, cache=TopologyCache(path))
+            self.assertEqual(3, device.calls)
+            self.assertEqual(sorted(serials), sorted(set(fetched)))
+
+            # A fresh cache replaces both the enumeration and the fetches.
+            device, fetched = self.CountingDevice([test_config["enumerate"], ]), []
+            self.run_with_config(test_config, device=device, fetched=fetched, cache=TopologyCache(path))
+            self.assertEqual(0, device.calls)
+            self.assertEqual([], fetched)
+
+            # With an expired enumeration only the changed device, and the
+            # irises its hub updates, are fetched again.
+            changed = copy.deepcopy(test_config)
+            changed["enumerate"][0]["firmware"] = "newer"
+            device, fetched = self.CountingDevice([changed["enumerate"], ]), []
+            self.run_with_config(changed, device=device, fetched=fetched,
+                                 cache=TopologyCache(path, enumerate_ttl_s=0))
+            self.assertEqual(3, device.calls)
+            self.assertEqual(serials[0], fetched[0])
+            self.assertLess(len(set(fetched)), len(serials))
+            hubs = [hub["serial"] for hub in test_config["expected_devices"]["hubs"]]
+            self.assertEqual([], [serial for serial in fetched if serial in hubs])
+
+            # And with expired statuses everything is fetched again.
+            device, fetched = self.CountingDevice([test_config["enumerate"], ]), []
+            self.run_with_config(test_config, device=device, fetched=fetched,
+                                 cache=TopologyCache(path, enumerate_ttl_s=0, status_ttl_s=0))
+            self.assertEqual(sorted(serials), sorted(set(fetched)))
+
+    def test_discover_refresh(self, _):
+        with open(os.path.join(filepath, "test_discover.json"), "r") as fptr:
+            test_config = json.load(fptr)
+        fetched = []
+
+        async def mock_afetch(dev):
+            fetched.append(dev.serial)
+            dev._json = test_config["status"].get(dev.serial, {})
+            return dev
+
+        changed = [dict(x) for x in test_config["enumerate"] if x["serial"] != "FH4A000003"]
+        changed[[x["serial"] for x in changed].index("0338")]["firmware"] = "newer"
+        device = self.CountingDevice([test_config["enumerate"], ] * 4 + [changed, ])
+        with unittest.mock.patch.object(discover.SoapySDR, "Device", device), \
+             unittest.mock.patch.object(discover.Remote, "afetch", mock_afetch), \
+             unittest.mock.patch.object(discover.HubRemote, "_update_irises", autospec=True, return_value=None):
+            devices = discover.Discover()
+            self.assertIn(("rrh", "RH4B000032"), devices.snapshot())
+
+            # Nothing changed, so nothing is fetched and nothing is reported.
+            del fetched[:]
+            self.assertEqual([], devices.refresh())
+            self.assertEqual([], fetched)
+
+            del fetched[:]
+            events = devices.refresh()
+        self.assertEqual("0338", fetched[0])
+        self.assertNotIn("FH4A000003", fetched)
+        self.assertEqual(
+            [("changed", "rrh", "RH4B000032"), ("removed", "hub", "FH4A000003")],
+            [(e["event"], e["kind"], e["id"]) for e in events])
+        self.assertEqual("mismatch", events[0]["value"]["firmware"])
+        self.assertDictEqual(test_config["expected_devices"]["hubs"][2],
+                             self.convert_discover_to_dict(devices)["hubs"][1])
+
+    def test_discover_create(self, _):
+        with open(os.path.join(filepath, "test_discover.json"), "r") as fptr:
+            test_config = json.load(fptr)
+
+        async def mock_afetch(dev):
+            dev._json = test_config["status"].get(dev.serial, {})
+            return dev
+
+        async def discover_and_refresh():
+            devices = await discover.Discover.create(cache=None)
+            return devices, await devices.arefresh()
+
+        loop = asyncio.new_event_loop()
+        try:
+            with unittest.mock.patch.object(discover.SoapySDR, "Device", self.Device(test_config["enumerate"])), \
+                 unittest.mock.patch.object(discover.Remote, "afetch", mock_afetch), \
+                 unittest.mock.patch.object(discover.HubRemote, "_update_irises", autospec=True, return_value=None):
+                devices, events = loop.run_until_complete(discover_and_refresh())
+            self.assertFalse(loop.is_closed())
+        finally:
+            loop.close()
+        self.assertEqual([], events)
+        self.assertDictEqual(test_config["expected_devices"], self.convert_discover_to_dict(devices))
+        self.assertTrue(all(dev._ssh_lock is None for dev in devices._irises + devices._hubs))
+
+    class FilteringDevice(Device):
+        def __init__(self, devices):
+            super().__init__(devices)
+            self.queries = []
+        def enumerate(self, args):
+            self.queries.append(dict(args))
+            for key in ("serial", "remote"):
+                if key in args:
+                    return [x for x in self._devices if x.get(key) == args[key]]
+            return self._devices
+
+    def run_targeted(self, test_config, **kwargs):
+        fetched = []
+
+        async def mock_afetch(dev):
+            fetched.append(dev.serial)
+            dev._json = test_config["status"].get(dev.serial, {})
+            return dev
+
+        device = self.FilteringDevice(test_config["enumerate"])
+        with unittest.mock.patch.object(discover.SoapySDR, "Device", device), \
+             unittest.mock.patch.object(discover.SoapySDR, "SoapySDRKwargs", dict), \
+             unittest.mock.patch.object(discover.Remote, "afetch", mock_afetch), \
+             unittest.mock.patch.object(discover.HubRemote, "_update_irises", autospec=True, return_value=None):
+            devices = discover.Discover(**kwargs)
+        return devices, device.queries, fetched
+
+    def test_discover_targeted(self, _):
+        with open(os.path.join(filepath, "test_discover.json"), "r") as fptr:
+            test_config = json.load(fptr)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "topology.json")
+
+            # Without a cache only the target itself is enumerated and fetched.
+            devices, queries, fetched = self.run_targeted(test_config, serials=["0338"])
+            self.assertEqual(["0338"], [query.get("serial") for query in queries])
+            self.assertEqual(["0338"], fetched)
+            self.assertEqual(["0338"], [dev.serial for dev in devices])
+
+            # An RRH can't be enumerated by serial, the whole network is scanned.
+            devices, queries, fetched = self.run_targeted(
+                test_config, serials=["RH4B000032"], cache=TopologyCache(path))
+            self.assertNotIn("serial", queries[-1])
+            self.assertIn("RH4B000032", [dev.serial for dev in devices])
+
+            # Once cached, the RRH brings its hub and chain, which are contacted
+            # directly and not fetched again.
+            devices, queries, fetched = self.run_targeted(
+                test_config, serials=["RH4B000032"], cache=TopologyCache(path, enumerate_ttl_s=0))
+            expected = test_config["expected_devices"]["hubs"][2]
+            chain = list(expected["chains"]["5"]["nodes"].values())
+            self.assertEqual(sorted(["FH4A000005"] + chain), sorted(dev.serial for dev in devices._irises + devices._hubs))
+            self.assertTrue(all("remote" in query for query in queries))
+            self.assertEqual([], fetched)
+            self.assertEqual(chain, [dev.serial for dev in devices._rrhs[0]])
+
+    def test_discover_targeted_keeps_cached_enumeration(self, _):
+        with open(os.path.join(filepath, "test_discover.json"), "r") as fptr:
+            test_config = json.load(fptr)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "topology.json")
+            self.run_with_config(test_config, cache=TopologyCache(path))
+            enumerated_at = TopologyCache(path).load().enumerated_at
+
+            # A targeted run with an expired enumeration only enumerates
+            # its targets and their hub and chain...
+            devices, queries, fetched = self.run_targeted(
+                test_config, serials=["0338"], cache=TopologyCache(path, enumerate_ttl_s=0))
+            self.assertTrue(all("remote" in query for query in queries))
+            self.assertLess(len(queries), len(test_config["enumerate"]))
+
+            # ...which must not replace the cached enumeration of the network.
+            cache = TopologyCache(path).load()
+            self.assertEqual(enumerated_at, cache.enumerated_at)
+            self.assertEqual(sorted(x["serial"] for x in test_config["enumerate"]),
+                             sorted(x["serial"] for x in cache.enumeration))
+            self.assertEqual(sorted(x["serial"] for x in test_config["enumerate"]),
+                             sorted(cache.devices))
+
+            device, fetched = self.CountingDevice([test_config["enumerate"], ]), []
+            self.run_with_config(test_config, device=device, fetched=fetched, cache=TopologyCache(path))
+            self.assertEqual(0, device.calls)
+            self.assertEqual([], fetched)
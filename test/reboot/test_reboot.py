@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+#	THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#	INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#	PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+#	FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#	OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#	DEALINGS IN THE SOFTWARE.
+#
+# Copyright (c) 2020, 2021 Skylark Wireless.
+import asyncio
+import os
+import site
+import unittest.mock
+from collections import OrderedDict
+
+filepath = os.path.dirname(os.path.abspath(__file__))
+site.addsitedir(os.path.join(filepath, '..', '..'))
+
+from test.utils import mock_imports
+
+with unittest.mock.patch('builtins.__import__', side_effect=mock_imports(["SoapySDR", ])):
+    from pyfaros.discover import discover
+    from pyfaros.reboot import reboot
+
+
+def make_iris(serial, chain_idx, rrh_index, rrh_serial=None, chain=()):
+    iris = discover.IrisRemote({
+        "serial": serial, "remote": "tcp://10.0.0.{}:55132".format(len(serial)), "fpga": "rrh"})
+    iris.chain_index = chain_idx
+    iris.rrh_index = rrh_index
+    iris.rrh_head = rrh_serial is not None
+    if iris.rrh_head:
+        iris._json = {"sfp": {"config": {"rrh": {"serial": rrh_serial, "chain": list(chain)}}}}
+    return iris
+
+
+class NoSsh:
+    async def __aenter__(self):
+        return []
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class TestRebootEngine(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # Chain 1 is an RRH, chain 2 a plain chain of nodes without an RRH
+        # config and chain 7 the reference node's.
+        self.hub = discover.HubRemote({"serial": "hub", "remote": "tcp://10.0.0.1:55132"})
+        self.hub.create_chain(0, [make_iris("rrh-1", 0, 0, "RH1", ["rrh-1", "rrh-2"]),
+                                  make_iris("rrh-2", 0, 1)], False)
+        self.hub.create_chain(1, [make_iris("plain-1", 1, 0), make_iris("plain-2", 1, 1)], False)
+        self.hub.create_chain(6, [make_iris("ref", 6, 0)], False)
+        self.standalone = make_iris("standalone", None, None)
+        self.power_status = {}
+        self.failing = set()
+
+        async def systemctl_reboot(device):
+            self.events.append(("reboot", device.serial))
+            if device.serial in self.failing:
+                raise OSError("no route to {}".format(device.serial))
+
+        async def chain_power(hub, action, chains):
+            self.events.append(("chain_power", hub.serial, list(chains)))
+            return OrderedDict((idx, self.power_status.get(idx, (0, ""))) for idx in chains)
+
+        patches = [
+            unittest.mock.patch.object(reboot, "_systemctl_reboot", systemctl_reboot),
+            unittest.mock.patch.object(discover.HubRemote, "async_chain_power", chain_power),
+            unittest.mock.patch.object(discover.Remote, "sshify", lambda remotes: NoSsh()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def complete(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_levels_run_in_order(self):
+        engine = reboot.RebootEngine([self.hub, self.standalone], recursive=True, concurrency=None)
+        self.assertTrue(self.complete(engine.run()))
+        # Nodes, then the hub's RRH chains in one exec, then the hub.
+        self.assertEqual([
+            ("reboot", "plain-1"),
+            ("reboot", "plain-2"),
+            ("reboot", "ref"),
+            ("reboot", "standalone"),
+            ("chain_power", "hub", [0]),
+            ("reboot", "hub"),
+        ], self.events)
+        self.assertEqual({}, engine.failures)
+
+    def test_force_power_cycles_every_chain(self):
+        engine = reboot.RebootEngine([self.hub, ], force=True)
+        self.complete(engine.run())
+        self.assertEqual([
+            ("reboot", "ref"),
+            ("chain_power", "hub", [0, 1, 2, 3, 4, 5]),
+            ("reboot", "hub"),
+        ], self.events)
+
+    def test_power_cycled_nodes_are_not_rebooted_on_their_own(self):
+        nodes = [node for node in self.hub.walk() if isinstance(node, discover.IrisRemote)]
+        engine = reboot.RebootEngine(nodes + [self.hub.chains[0], ])
+        self.assertEqual(["plain-1", "plain-2", "ref"], list(engine.nodes))
+        self.assertEqual(["plain-1", "plain-2", "ref", "rrh-1", "rrh-2"],
+                         [device.serial for device in engine.rebooted()])
+
+        # Forced, the plain chain is power cycled too and waited for.
+        engine = reboot.RebootEngine(nodes + [self.hub, ], force=True)
+        self.assertEqual(["ref"], list(engine.nodes))
+        self.assertEqual(["ref", "rrh-1", "rrh-2", "plain-1", "plain-2", "hub"],
+                         [device.serial for device in engine.rebooted()])
+
+    def test_failures(self):
+        self.failing.add("standalone")
+        self.power_status[1] = (1, "chain_power: no such chain")
+        self.power_status[2] = (None, "")
+        engine = reboot.RebootEngine([self.hub, self.standalone], force=True)
+        self.assertFalse(self.complete(engine.run()))
+        # A failure doesn't stop the next levels.
+        self.assertEqual(("reboot", "hub"), self.events[-1])
+        self.assertEqual(["standalone", "hub chain 2", "hub chain 3"], list(engine.failures))
+        self.assertIsInstance(engine.failures["standalone"], OSError)
+        self.assertIsInstance(engine.failures["hub chain 3"], discover.ChainPowerError)
+        # What failed to reboot isn't waited for.
+        async def back(timeout):
+            return True
+        with unittest.mock.patch.object(reboot, "RebootTracker") as tracker:
+            tracker.return_value.wait = back
+            self.assertTrue(self.complete(engine.wait(1)))
+        waited = [device.serial for device in tracker.call_args[0][0]]
+        self.assertIn("hub", waited)
+        self.assertNotIn("standalone", waited)
+
+        with self.assertRaises(OSError):
+            self.complete(reboot.RebootEngine([self.standalone, ]).run(check=True))
+
+    def test_do_reboot_reports_failures(self):
+        self.assertTrue(self.complete(reboot.async_do_reboot([self.standalone, ])))
+        self.failing.add("standalone")
+        self.assertFalse(self.complete(reboot.async_do_reboot([self.standalone, ])))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+#
+#	THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#	INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#	PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+#	FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#	OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#	DEALINGS IN THE SOFTWARE.
+#
+# Copyright (c) 2020, 2021 Skylark Wireless.
+import asyncio
+import os
+import site
+import unittest.mock
+
+filepath = os.path.dirname(os.path.abspath(__file__))
+site.addsitedir(os.path.join(filepath, '..'))
+
+from pyfaros import ssh
+from test.utils import LocalChannel, LocalConnection
+
+# Counts sudo authentications, which take the password "secret".
+FAKE_SUDO = ('sudo() { case "$1" in '
+             '-S) read password; [ "$password" = secret ] || return 1; auths=$((auths+1));; '
+             '-n) shift; "$@";; esac; }')
+
+
+class FakeChannel(object):
+    """
+    Plays back a command's output in order.  Like a real channel the remote
+    side stalls once `window` chunks of stdout are unread, so a reader which
+    waits for stderr to end first never gets anywhere.
+    """
+
+    def __init__(self, output, exit_status=0, window=2):
+        self.pending = list(output)
+        self.exit_status = exit_status
+        self.window = window
+        self.stdout = []
+        self.stderr = []
+        self.command = None
+        self.sent = b""
+
+    def _produce(self):
+        while self.pending:
+            stream, data = self.pending[0]
+            if stream == "stdout" and len(self.stdout) >= self.window:
+                break
+            self.pending.pop(0)
+            getattr(self, stream).append(data)
+
+    def exec_command(self, command):
+        self.command = command
+
+    def sendall(self, data):
+        self.sent += data
+
+    def recv_ready(self):
+        self._produce()
+        return bool(self.stdout)
+
+    def recv_stderr_ready(self):
+        self._produce()
+        return bool(self.stderr)
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+    def exit_status_ready(self):
+        self._produce()
+        return not self.pending
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+
+class TestEasySsh(unittest.TestCase):
+    def easy_ssh(self, channel, persistent=False):
+        easy_ssh = ssh.EasySsh.__new__(ssh.EasySsh)
+        easy_ssh.password = "secret"
+        easy_ssh.persistent = persistent
+        easy_ssh._shell = None
+        easy_ssh.client = unittest.mock.Mock()
+        easy_ssh.client.get_transport.return_value.open_session.return_value = channel
+        return easy_ssh
+
+    def run_command(self, channel, *args, **kwargs):
+        with unittest.mock.patch.object(ssh.select, "select"):
+            return self.easy_ssh(channel).runCommand(*args, **kwargs)
+
+    def test_reads_stdout_and_stderr_together(self):
+        lines = [("stdout", "line {}\n".format(index).encode()) for index in range(100)]
+        lines.insert(50, ("stderr", b"warning\n"))
+        channel = FakeChannel(lines)
+        output = self.run_command(channel, "cat", "big")
+        self.assertEqual("cat big", channel.command)
+        self.assertEqual("\n".join("line {}".format(index) for index in range(100)), output)
+
+    def test_failure_raises_with_stderr(self):
+        channel = FakeChannel([("stdout", b"partial\n"), ("stderr", b"no such file\n")], exit_status=2)
+        easy_ssh = self.easy_ssh(channel)
+        with unittest.mock.patch.object(ssh.select, "select"):
+            with self.assertRaises(ssh.RunCommandFailed) as raised:
+                easy_ssh.runCommand("ls", "/missing")
+        self.assertIn("ls /missing", str(raised.exception))
+        self.assertIn("no such file", str(raised.exception))
+        self.assertEqual(2, easy_ssh.exit_status)
+
+    def test_sudo_sends_the_password(self):
+        channel = FakeChannel([("stdout", b"0\n")])
+        self.assertEqual("0", self.run_command(channel, "id", "-u", sudo=True))
+        self.assertEqual("sudo --stdin id -u", channel.command)
+        self.assertEqual(b"secret\n", channel.sent)
+
+
+@unittest.mock.patch.object(ssh.select, "select")
+class TestEasySshShell(unittest.TestCase):
+    def setUp(self):
+        self.channel = LocalChannel()
+        client = unittest.mock.Mock()
+        client.get_transport.return_value.open_session.return_value = self.channel
+        self.shell = ssh.EasySshShell(client, "secret")
+        self.addCleanup(self.shell.close)
+
+    def test_splits_output_by_sentinel(self, _):
+        results = self.shell.run_many([
+            "printf 'no newline'",
+            "echo out; echo err >&2",
+            "true",
+            "seq 1 20000",
+            "echo {} >&2".format(self.shell.sentinel),
+        ])
+        self.assertEqual((0, "no newline", ""), results[0])
+        self.assertEqual((0, "out", "err"), results[1])
+        self.assertEqual((0, "", ""), results[2])
+        self.assertEqual("\n".join(str(index) for index in range(1, 20001)), results[3][1])
+        # Only a sentinel at the start of a line after a newline ends a command.
+        self.assertEqual((0, "", self.shell.sentinel), results[4])
+
+    def test_exit_status(self, _):
+        self.assertEqual([1, 3, 0], [status for status, _, _ in self.shell.run_many(
+            ["false", "(exit 3)", "true"], check=False)])
+
+        # With check the commands after a failure are skipped...
+        with self.assertRaises(ssh.RunCommandFailed) as raised:
+            self.shell.run_many(["step=1", "echo broken >&2; (exit 3)", "step=2"])
+        self.assertIn("broken", str(raised.exception))
+        # ...and the shell carries on with the next batch.
+        self.assertEqual("1", self.shell.run("echo $step"))
+
+    def test_shell_exiting(self, _):
+        results = self.shell.run_many(["echo done", "exit 4", "echo never"], check=False)
+        self.assertEqual([(0, "done", ""), (None, "", ""), (None, "", "")], results)
+
+    def test_sudo_authenticates_once(self, _):
+        self.shell.run(FAKE_SUDO)
+        self.assertEqual("root", self.shell.run("echo root", sudo=True))
+        self.shell.run_many(["true", "true"], sudo=True)
+        self.assertEqual("1", self.shell.run("echo $auths"))
+
+        self.shell.password = "wrong"
+        self.shell._sudo_ready = False
+        with self.assertRaises(ssh.RunCommandFailed):
+            self.shell.run("true", sudo=True)
+
+    def test_persistent_run_command(self, _):
+        easy_ssh = TestEasySsh.easy_ssh(None, self.channel, persistent=True)
+        self.assertEqual("1", easy_ssh.runCommand("echo", "1"))
+        self.assertEqual("2", easy_ssh.runCommand("echo", "2"))
+        easy_ssh.client.get_transport.return_value.open_session.assert_called_once_with()
+
+
+class TestAsyncSshShell(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.connection = LocalConnection()
+        self.shell = self.complete(ssh.AsyncSshShell.open(self.connection, "secret"))
+
+    def tearDown(self):
+        self.shell.close()
+        self.complete(self.connection.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def complete(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_splits_output_and_statuses(self):
+        results = self.complete(self.shell.run_many(
+            ["printf 'no newline'", "echo out; echo err >&2; (exit 2)", "seq 1 20000"], check=False))
+        self.assertEqual((0, "no newline", ""), results[0])
+        self.assertEqual((2, "out", "err"), results[1])
+        self.assertEqual("\n".join(str(index) for index in range(1, 20001)), results[2][1])
+
+        with self.assertRaises(ssh.RunCommandFailed):
+            self.complete(self.shell.run_many(["true", "false", "true"]))
+
+    def test_batches_run_one_at_a_time(self):
+        first, second = self.complete(asyncio.gather(
+            self.shell.run_many(["sleep 0.1; echo a", "echo b"]),
+            self.shell.run_many(["echo c"])))
+        self.assertEqual(["a", "b"], [output for _, output, _ in first])
+        self.assertEqual(["c"], [output for _, output, _ in second])
+
+    def test_sudo_authenticates_once(self):
+        self.complete(self.shell.run(FAKE_SUDO))
+        self.complete(self.shell.run_many(["true", "true"], sudo=True))
+        self.complete(self.shell.run("true", sudo=True))
+        self.assertEqual("1", self.complete(self.shell.run("echo $auths")))
+
+    def test_shell_exiting(self):
+        results = self.complete(self.shell.run_many(["echo done", "exit 4", "echo never"], check=False))
+        self.assertEqual([(0, "done", ""), (None, "", ""), (None, "", "")], results)
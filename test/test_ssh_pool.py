@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#
+#	THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#	INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#	PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+#	FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#	OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#	DEALINGS IN THE SOFTWARE.
+#
+# Copyright (c) 2020, 2021 Skylark Wireless.
+import asyncio
+import os
+import site
+import unittest.mock
+
+filepath = os.path.dirname(os.path.abspath(__file__))
+site.addsitedir(os.path.join(filepath, '..'))
+
+from pyfaros import ssh_pool
+
+
+class FakeConnection(object):
+    def __init__(self, client):
+        self.client = client
+        self.healthy = True
+        self.closed = False
+
+    async def run(self, command, check=False):
+        if not self.healthy:
+            raise OSError("no answer")
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+
+class TestSshConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    async def create_connection(self, factory, address, **kwargs):
+        client = factory()
+        connection = FakeConnection(client)
+        self.opened.append((address, connection))
+        return connection, client
+
+    def complete(self, coro):
+        with unittest.mock.patch.object(ssh_pool.asyncssh, "create_connection", self.create_connection):
+            return self.loop.run_until_complete(coro)
+
+    def test_borrowers_share_a_connection(self):
+        pool = ssh_pool.SshConnectionPool()
+        first = self.complete(pool.acquire("10.0.0.1", "user"))
+        second = self.complete(pool.acquire("10.0.0.1", "user"))
+        self.assertIs(first, second)
+        self.assertEqual(1, len(self.opened))
+        pool.release(first)
+        pool.release(second)
+        self.assertFalse(first.closed)
+        self.complete(pool.close())
+        self.assertTrue(first.closed)
+
+    def test_dropped_connection_is_not_lent_while_borrowed(self):
+        pool = ssh_pool.SshConnectionPool()
+        first = self.complete(pool.acquire("10.0.0.1", "user"))
+        first.client.connection_lost(None)
+        second = self.complete(pool.acquire("10.0.0.1", "user"))
+        self.assertIsNot(first, second)
+        pool.release(first)
+        self.assertTrue(first.closed)
+        pool.release(second)
+        self.assertFalse(second.closed)
+
+    def test_borrowed_connection_is_health_checked(self):
+        pool = ssh_pool.SshConnectionPool(health_check_after=0)
+        first = self.complete(pool.acquire("10.0.0.1", "user"))
+        self.assertIs(first, self.complete(pool.acquire("10.0.0.1", "user")))
+        first.healthy = False
+        third = self.complete(pool.acquire("10.0.0.1", "user"))
+        self.assertIsNot(first, third)
+        pool.release(first)
+        self.assertFalse(first.closed)
+        pool.release(first)
+        self.assertTrue(first.closed)
+
+    def test_max_connections_is_a_soft_cap(self):
+        pool = ssh_pool.SshConnectionPool(max_connections=1)
+        first = self.complete(pool.acquire("10.0.0.1", "user"))
+        second = self.complete(pool.acquire("10.0.0.2", "user"))
+        # Both borrowed, so the pool grows past the cap instead of waiting.
+        self.assertEqual(2, len(pool))
+        pool.release(first)
+        self.assertTrue(first.closed)
+        self.assertEqual(1, len(pool))
+        pool.release(second)
+        self.assertFalse(second.closed)
+        # Idle ones make room for the next connection.
+        third = self.complete(pool.acquire("10.0.0.3", "user"))
+        self.assertTrue(second.closed)
+        self.assertEqual(1, len(pool))
+        pool.release(third)
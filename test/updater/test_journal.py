@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+#
+#	THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#	INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#	PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+#	FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#	OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#	DEALINGS IN THE SOFTWARE.
+#
+# Copyright (c) 2020, 2021 Skylark Wireless.
+import os
+import site
+import tempfile
+import types
+import unittest
+
+filepath = os.path.dirname(os.path.abspath(__file__))
+site.addsitedir(os.path.join(filepath, '..', '..'))
+
+from pyfaros.updater.journal import UpdateJournal
+
+
+def make_file(name, sha256sum=None):
+    return types.SimpleNamespace(
+        path="/images/{}".format(name), local_name=name, remote_name=name,
+        sha256sum=sha256sum or name + "-sha")
+
+
+class TestUpdateJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = self.tmpdir.name
+        self.node = types.SimpleNamespace(serial="node")
+        self.hub = types.SimpleNamespace(serial="hub")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_phases_survive_a_reload(self):
+        files = [make_file("BOOT.BIN"), make_file("image.ub")]
+        journal = UpdateJournal(123, directory=self.directory)
+        journal.plan(self.node, files)
+        journal.record(self.node, UpdateJournal.TRANSFERRED)
+        journal.record(self.node, UpdateJournal.INSTALLING)
+        journal.plan(self.hub, [])
+        journal.record(self.hub, UpdateJournal.UP_TO_DATE)
+
+        loaded = UpdateJournal(123, directory=self.directory).load()
+        self.assertEqual(UpdateJournal.INSTALLING, loaded.phase(self.node))
+        self.assertIn(loaded.phase(self.hub), UpdateJournal.DONE)
+        self.assertIsNone(loaded.phase(types.SimpleNamespace(serial="other")))
+        # Later phases keep the files planned first.
+        self.assertEqual(files, loaded.planned_files(self.node, files + [None]))
+
+    def test_torn_line_is_ignored(self):
+        journal = UpdateJournal(123, directory=self.directory)
+        journal.record(self.node, UpdateJournal.INSTALLED)
+        journal.record(self.hub, UpdateJournal.TRANSFERRED)
+        with open(journal.path, "a") as fptr:
+            fptr.write('{"serial": "node", "pha')
+        loaded = UpdateJournal(123, directory=self.directory).load()
+        self.assertEqual(UpdateJournal.INSTALLED, loaded.phase(self.node))
+        self.assertEqual(UpdateJournal.TRANSFERRED, loaded.phase(self.hub))
+
+    def test_latest(self):
+        self.assertIsNone(UpdateJournal.latest(directory=self.directory))
+        for timestamp in (99, 1000, 123):
+            UpdateJournal(timestamp, directory=self.directory).record(self.node, UpdateJournal.PLANNED)
+        open(os.path.join(self.directory, "notes.jsonl"), "w").close()
+        latest = UpdateJournal.latest(directory=self.directory)
+        self.assertEqual("1000", latest.timestamp)
+        self.assertEqual(UpdateJournal.PLANNED, latest.phase(self.node))
+
+    def test_planned_files_of_another_update(self):
+        journal = UpdateJournal(123, directory=self.directory)
+        self.assertIsNone(journal.planned_files(self.node, [make_file("BOOT.BIN")]))
+        journal.plan(self.node, [make_file("BOOT.BIN")])
+        # The image changed since, or isn't part of this update.
+        self.assertIsNone(journal.planned_files(self.node, [make_file("BOOT.BIN", "newer")]))
+        self.assertIsNone(journal.planned_files(self.node, [make_file("image.ub")]))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+#
+#	THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#	INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#	PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+#	FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#	OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#	DEALINGS IN THE SOFTWARE.
+#
+# Copyright (c) 2020, 2021 Skylark Wireless.
+import json
+import os
+import shutil
+import site
+import tempfile
+import time
+import unittest.mock
+
+filepath = os.path.dirname(os.path.abspath(__file__))
+site.addsitedir(os.path.join(filepath, '..', '..'))
+
+from test.utils import mock_imports
+
+with unittest.mock.patch('builtins.__import__', side_effect=mock_imports(["SoapySDR", ])):
+    from pyfaros.updater import update_file
+
+
+class TestAnalysisCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = self.tmpdir.name
+        patches = [
+            unittest.mock.patch.dict(os.environ, {"XDG_CACHE_HOME": os.path.join(self.directory, "cache")}),
+            unittest.mock.patch.object(update_file, "_analyses", {}),
+            unittest.mock.patch.object(update_file, "_disk_analyses", None),
+            unittest.mock.patch.object(update_file, "_unpacked", {}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        os.mkdir(os.path.join(self.directory, "images"))
+        with open(os.path.join(self.directory, "images", "BOOT.BIN"), "wb") as fptr:
+            fptr.write(b"\x00preboot 1 2 iris030;x\x00")
+        self.tarball = shutil.make_archive(
+            os.path.join(self.directory, "images"), "gztar", os.path.join(self.directory, "images"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def unpack(self):
+        unpackdir = tempfile.mkdtemp(dir=self.directory)
+        shutil.unpack_archive(self.tarball, unpackdir)
+        update_file.note_unpacked(self.tarball, unpackdir)
+        return os.path.join(unpackdir, "BOOT.BIN")
+
+    def forget(self):
+        """ Starts over from the cache on disk, like the next run would. """
+        update_file._analyses.clear()
+        update_file._disk_analyses = None
+        update_file._unpacked.clear()
+
+    def disk_cache(self):
+        with open(update_file.analysis_cache_path()) as fptr:
+            return json.load(fptr)
+
+    def test_unpacked_files_hit_the_cache_on_the_next_run(self):
+        with unittest.mock.patch.object(update_file, "scan_file", wraps=update_file.scan_file) as scan:
+            first = update_file.analyze_file(self.unpack())
+            shutil.rmtree(os.path.dirname(first["path"]))
+            self.forget()
+            second = update_file.analyze_file(self.unpack())
+        self.assertEqual(1, scan.call_count)
+        self.assertEqual(first["sha256"], second["sha256"])
+        self.assertEqual(1, len(self.disk_cache()))
+
+    def test_entries_of_a_changed_archive_are_dropped(self):
+        update_file.analyze_file(self.unpack())
+        time.sleep(0.05)
+        with open(os.path.join(self.directory, "images", "BOOT.BIN"), "wb") as fptr:
+            fptr.write(b"\x00preboot 1 2 faroshub04;x\x00")
+        shutil.make_archive(
+            os.path.join(self.directory, "images"), "gztar", os.path.join(self.directory, "images"))
+        self.forget()
+        entry = update_file.analyze_file(self.unpack())
+        self.assertEqual({entry["sha256"]}, {e["sha256"] for e in self.disk_cache().values()})
+
+    def test_a_rewritten_file_with_the_same_size_and_mtime_is_scanned_again(self):
+        path = os.path.join(self.directory, "images", "BOOT.BIN")
+        before = os.stat(path)
+        first = update_file.analyze_file(path)
+        # Past the granularity of the file system timestamps.
+        time.sleep(0.05)
+        with open(path, "r+b") as fptr:
+            fptr.write(b"\x01")
+        os.utime(path, ns=(before.st_atime_ns, before.st_mtime_ns))
+        self.assertEqual((before.st_size, before.st_mtime_ns), (os.stat(path).st_size, os.stat(path).st_mtime_ns))
+        self.assertNotEqual(first["sha256"], update_file.analyze_file(path)["sha256"])
+
+
+if __name__ == "__main__":
+    unittest.main()
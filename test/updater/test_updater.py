@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+#
+#	THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+#	INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#	PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+#	FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#	OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#	DEALINGS IN THE SOFTWARE.
+#
+# Copyright (c) 2020, 2021 Skylark Wireless.
+import asyncio
+import os
+import site
+import subprocess
+import tempfile
+import time
+import types
+import unittest.mock
+
+import asyncssh
+
+filepath = os.path.dirname(os.path.abspath(__file__))
+site.addsitedir(os.path.join(filepath, '..', '..'))
+
+from test.utils import mock_imports
+
+with unittest.mock.patch('builtins.__import__', side_effect=mock_imports(["SoapySDR", ])):
+    from pyfaros.discover import discover
+    from pyfaros.updater import update_file, updater
+
+
+def make_file(name):
+    return types.SimpleNamespace(
+        path="/images/{}".format(name), local_name=name, remote_name=name, sha256sum=name + "-sha")
+
+
+class TestUpdater(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.hub = discover.HubRemote.__new__(discover.HubRemote)
+        self.hub.serial = "hub"
+        self.hub.ssh_connection = object()
+        self.hub.variant = "hub"
+        self.images = types.SimpleNamespace(
+            bootbin=make_file("BOOT.BIN"), imageub=make_file("image.ub"), bootbit=None)
+        self.context = types.SimpleNamespace(mapping={"iris": self.images, "hub": self.images})
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def iris(self, serial, rrh_index, chain_index=0):
+        iris = discover.IrisRemote.__new__(discover.IrisRemote)
+        iris.serial = serial
+        iris.hub = self.hub
+        iris.chain_index = chain_index
+        iris.rrh_index = rrh_index
+        iris.variant = "iris"
+        iris.ssh_connection = object()
+        return iris
+
+    def record(self, name, delay=0):
+        async def fake(device, *args, **kwargs):
+            await asyncio.sleep(delay)
+            self.events.append((name, device.serial))
+            return True
+        return fake
+
+    @staticmethod
+    def returning(value):
+        async def fake(*args, **kwargs):
+            return value
+        return fake
+
+    def do_update(self, devices, **kwargs):
+        with tempfile.TemporaryDirectory() as tmpdir, \
+             unittest.mock.patch.dict(os.environ, {"XDG_CACHE_HOME": tmpdir}):
+            return self.loop.run_until_complete(
+                updater.do_update(self.context, devices, force=True, **kwargs))
+
+    def test_relay_seed_reboots_after_its_members_fetched(self):
+        # Sorted by power dependency the tail of the chain comes first, so it
+        # seeds the relay while powering no one.
+        chain = [self.iris("node{}".format(index), index) for index in range(3)]
+        relay = types.SimpleNamespace(address="10.0.0.3")
+        with unittest.mock.patch.object(updater, "make_tmpdir", self.record("mkdir")), \
+             unittest.mock.patch.object(updater, "copy_file", self.record("copy")), \
+             unittest.mock.patch.object(updater, "verify_file", self.record("verify")), \
+             unittest.mock.patch.object(updater, "open_relay", self.returning(relay)), \
+             unittest.mock.patch.object(updater, "close_relay", self.record("close_relay")), \
+             unittest.mock.patch.object(updater, "relay_file", self.record("fetch", delay=0.05)), \
+             unittest.mock.patch.object(updater, "install_files", self.record("install")), \
+             unittest.mock.patch.object(updater, "do_reboot", self.record("reboot")):
+            results = self.do_update(chain, relay=True)
+        self.assertTrue(all(result.rebooted for result in results))
+        seed_reboot = self.events.index(("reboot", "node2"))
+        fetches = [index for index, event in enumerate(self.events) if event[0] == "fetch"]
+        self.assertEqual(4, len(fetches))
+        self.assertLess(max(fetches), seed_reboot)
+        # The relay is stopped while the seed is still up.
+        self.assertEqual(1, self.events.count(("close_relay", "node2")))
+        self.assertLess(self.events.index(("close_relay", "node2")), seed_reboot)
+        self.assertEqual(["node2", "node1", "node0"],
+                         [serial for name, serial in self.events if name == "reboot"])
+
+    def test_close_relay_survives_an_unreachable_seed(self):
+        seed = self.iris("node0", 0)
+        relay = updater.Relay("10.0.0.3", "123")
+        relay.pid = 42
+
+        async def unreachable(commands, **kwargs):
+            raise asyncssh.ConnectionLost("rebooting")
+        seed.run_many = unreachable
+        with self.assertLogs(level="WARNING"):
+            self.loop.run_until_complete(updater.close_relay(seed, relay))
+
+    class FakeConnection(object):
+        def __init__(self, stdout="", exit_status=0):
+            self.stdout = stdout
+            self.exit_status = exit_status
+            self.commands = []
+
+        async def run(self, command, **kwargs):
+            self.commands.append(command)
+            return types.SimpleNamespace(stdout=self.stdout, exit_status=self.exit_status)
+
+    def test_install_script_stops_at_the_first_failed_step(self):
+        files = [make_file("BOOT.BIN"), make_file("image.ub")]
+        script = updater.install_script(files, "123", store_ssh=True)
+        # Every sudo succeeds but the copy of image.ub and storing the keys.
+        fake_sudo = 'sudo() { echo "$*"; case "$*" in *image.ub*|*ssh*) return 3;; esac; }\n'
+        output = subprocess.run(["sh", "-c", fake_sudo + script], stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        steps = updater.parse_install_output(output)
+        self.assertEqual(["mount", "copy:BOOT.BIN", "copy:image.ub"], list(steps))
+        self.assertEqual(0, steps["copy:BOOT.BIN"][0])
+        self.assertEqual("-n cp /tmp/updater_123/BOOT.BIN /boot/BOOT.BIN", steps["copy:BOOT.BIN"][1])
+        self.assertEqual(3, steps["copy:image.ub"][0])
+
+        # Storing the keys may fail, the rest goes on.
+        files = [make_file("BOOT.BIN")]
+        output = subprocess.run(["sh", "-c", fake_sudo + updater.install_script(files, "123", store_ssh=True)],
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        steps = updater.parse_install_output(output)
+        self.assertEqual(["mount", "copy:BOOT.BIN", "store_ssh", "sync", "umount"], list(steps))
+        self.assertEqual([0, 0, 3, 0, 0], [status for status, _ in steps.values()])
+
+    def test_parse_install_output(self):
+        output = "\r\n".join([
+            "mounted",
+            "@@updater-step mount 0",
+            "cp: can't stat",
+            "really",
+            "@@updater-step copy:BOOT.BIN 1",
+            "@@updater-step not-a-status x",
+            "",
+        ])
+        steps = updater.parse_install_output(output)
+        self.assertEqual(["mount", "copy:BOOT.BIN"], list(steps))
+        self.assertEqual((0, "mounted"), steps["mount"])
+        self.assertEqual((1, "cp: can't stat\nreally"), steps["copy:BOOT.BIN"])
+
+    def test_install_files_names_the_failed_step(self):
+        iris = self.iris("node0", 0)
+        iris.ssh_connection = self.FakeConnection(
+            "@@updater-step mount 0\nno space\n@@updater-step copy:BOOT.BIN 1\n", exit_status=1)
+        with self.assertRaises(updater.UpdateError) as raised:
+            self.loop.run_until_complete(updater.install_files(iris, [make_file("BOOT.BIN")], "123"))
+        self.assertIn("copy:BOOT.BIN failed: no space", str(raised.exception))
+
+    def test_plan_update_skips_identical_files(self):
+        current = self.iris("current", 0)
+        current.ssh_connection = self.FakeConnection(
+            "BOOT.BIN-sha  /boot/BOOT.BIN\nimage.ub-sha  /boot/image.ub\n")
+        partial = self.iris("partial", 1)
+        partial.ssh_connection = self.FakeConnection(
+            "BOOT.BIN-sha  /boot/BOOT.BIN\nolder  /boot/image.ub\n")
+        unknown = self.iris("unknown", 2)
+        unknown.ssh_connection = self.FakeConnection("", exit_status=1)
+        files = [self.images.bootbin, self.images.imageub, None]
+        plan = self.loop.run_until_complete(
+            updater.plan_update([current, partial, unknown], lambda device: files))
+        self.assertEqual([], plan[current])
+        self.assertEqual([self.images.imageub], plan[partial])
+        self.assertEqual([self.images.bootbin, self.images.imageub], plan[unknown])
+
+    def test_plan_update_sees_a_rewritten_file_with_the_same_size_and_mtime(self):
+        with tempfile.TemporaryDirectory() as tmpdir, \
+             unittest.mock.patch.dict(os.environ, {"XDG_CACHE_HOME": tmpdir}):
+            path = os.path.join(tmpdir, "sklk_cpe_top.bin")
+            with open(path, "wb") as fptr:
+                fptr.write(b"old bitstream")
+            before = os.stat(path)
+            installed = update_file.BootBit(path)
+            cpe = self.iris("cpe", 0)
+            cpe.ssh_connection = self.FakeConnection(
+                "{}  /boot/sklk_cpe_top.bin\n".format(installed.sha256sum))
+            plan = self.loop.run_until_complete(updater.plan_update([cpe], lambda device: [installed]))
+            self.assertEqual([], plan[cpe])
+            # Past the granularity of the file system timestamps.
+            time.sleep(0.05)
+            with open(path, "wb") as fptr:
+                fptr.write(b"new bitstream")
+            os.utime(path, ns=(before.st_atime_ns, before.st_mtime_ns))
+            rebuilt = update_file.BootBit(path)
+            plan = self.loop.run_until_complete(updater.plan_update([cpe], lambda device: [rebuilt]))
+            self.assertEqual([rebuilt], plan[cpe])
+
+    def test_token_bucket_caps_the_rate(self):
+        bucket = updater.TokenBucket(10000)
+
+        async def consume():
+            start = self.loop.time()
+            # The burst goes through at once, the rest at 10000 per second.
+            await bucket.consume(10000)
+            burst = self.loop.time() - start
+            await asyncio.gather(*[bucket.consume(500) for _ in range(4)])
+            return burst, self.loop.time() - start
+
+        burst, total = self.loop.run_until_complete(consume())
+        self.assertLess(burst, 0.05)
+        self.assertGreaterEqual(total, 0.19)
+        self.assertLess(total, 0.5)
+
+    def test_scheduler_limits(self):
+        hub2 = discover.HubRemote.__new__(discover.HubRemote)
+        hub2.serial = "hub2"
+        devices = [self.iris("a{}".format(index), index, chain_index=index % 2) for index in range(6)]
+        for index in range(4):
+            other = self.iris("b{}".format(index), index)
+            other.hub = hub2
+            devices.append(other)
+        scheduler = updater.UpdateScheduler(concurrency=3, per_hub=2, per_chain=1)
+        active = []
+        peaks = {}
+
+        async def copy(device):
+            async with scheduler.slot(device):
+                active.append(device)
+                for key, members in [
+                        ("all", active),
+                        (device.hub.serial, [d for d in active if d.hub is device.hub]),
+                        ((device.hub.serial, device.chain_index),
+                         [d for d in active if d.hub is device.hub and d.chain_index == device.chain_index])]:
+                    peaks[key] = max(peaks.get(key, 0), len(members))
+                await asyncio.sleep(0.01)
+                active.remove(device)
+
+        self.loop.run_until_complete(asyncio.gather(*[copy(device) for device in devices]))
+        self.assertEqual(3, peaks["all"])
+        self.assertEqual(2, peaks["hub"])
+        self.assertEqual(1, peaks[("hub", 0)])
+        self.assertEqual(1, peaks[("hub", 1)])
+
+    def run_pipeline(self, devices, policy, failing=()):
+        self.events = []
+
+        async def transfer(device):
+            if device.serial in failing:
+                raise updater.UpdateError("copy of {} failed".format(device.serial))
+            await asyncio.sleep(0.02)
+            return True
+
+        async def run():
+            transfers = dict((device, asyncio.ensure_future(transfer(device))) for device in devices)
+            pipeline = updater.UpdatePipeline(devices, policy=policy)
+            return await pipeline.run(transfers, lambda device: [self.images.bootbin], "123")
+
+        with unittest.mock.patch.object(updater, "install_files", self.record("install")), \
+             unittest.mock.patch.object(updater, "do_reboot", self.record("reboot", delay=0.01)):
+            return dict((result.device.serial, result) for result in self.loop.run_until_complete(run()))
+
+    def test_pipeline_reboots_in_power_order(self):
+        chain = [self.iris("node{}".format(index), index) for index in range(3)]
+        results = self.run_pipeline([self.hub] + chain, updater.FailurePolicy.ABORT_ALL)
+        self.assertTrue(all(result.rebooted for result in results.values()))
+        # Whatever powers a device reboots after it.
+        self.assertEqual(["node2", "node1", "node0", "hub"],
+                         [serial for name, serial in self.events if name == "reboot"])
+
+    def test_pipeline_failure_policies(self):
+        def devices():
+            hub2 = discover.HubRemote.__new__(discover.HubRemote)
+            hub2.serial = "hub2"
+            # a0 and b0 are in the same power wave, a1 is not.
+            b0 = self.iris("b0", 0)
+            b0.hub = hub2
+            return [self.iris("a0", 0), self.iris("a1", 1), b0]
+
+        results = self.run_pipeline(devices(), updater.FailurePolicy.CONTINUE, failing=["a0"])
+        self.assertIsInstance(results["a0"].error, updater.UpdateError)
+        self.assertTrue(results["a1"].rebooted and results["b0"].rebooted)
+
+        results = self.run_pipeline(devices(), updater.FailurePolicy.ABORT_WAVE, failing=["a0"])
+        self.assertTrue(results["b0"].aborted)
+        self.assertTrue(results["a1"].rebooted)
+
+        results = self.run_pipeline(devices(), updater.FailurePolicy.ABORT_ALL, failing=["a0"])
+        self.assertTrue(results["a1"].aborted and results["b0"].aborted)
+        # Stopped before writing /boot.
+        self.assertEqual([], self.events)
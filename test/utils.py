@@ -7,6 +7,10 @@
 #	DEALINGS IN THE SOFTWARE.
 #
 # Copyright (c) 2020, 2021 Skylark Wireless.
+import asyncio
+import os
+import select
+import subprocess
 import unittest
 import unittest.mock
 
@@ -18,3 +22,85 @@ def mock_imports(import_names):
         else:
             return real_import(name, *args)
     return mock_import
+
+
+# Tests of EasySsh patch select.select.
+_select = select.select
+
+
+class LocalChannel(object):
+    """
+    A paramiko channel running its command in a local process, so a shell
+    over it behaves as a remote one would.
+    """
+
+    def __init__(self):
+        self.process = None
+        self._buffers = {}
+        self._eof = set()
+
+    def exec_command(self, command):
+        self.process = subprocess.Popen(
+            command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def _ready(self, stream):
+        if stream not in self._eof and _select([stream], [], [], 0.01)[0]:
+            data = os.read(stream.fileno(), 64 * 1024)
+            if data:
+                self._buffers.setdefault(stream, bytearray()).extend(data)
+            else:
+                self._eof.add(stream)
+        return bool(self._buffers.get(stream))
+
+    def _recv(self, stream):
+        data = bytes(self._buffers[stream])
+        self._buffers[stream].clear()
+        return data
+
+    def recv_ready(self):
+        return self._ready(self.process.stdout)
+
+    def recv_stderr_ready(self):
+        return self._ready(self.process.stderr)
+
+    def recv(self, size):
+        return self._recv(self.process.stdout)
+
+    def recv_stderr(self, size):
+        return self._recv(self.process.stderr)
+
+    def exit_status_ready(self):
+        return self.process.poll() is not None
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+
+class LocalConnection(object):
+    """ An asyncssh connection whose processes run locally. """
+
+    def __init__(self):
+        self.processes = []
+
+    async def create_process(self, command, encoding=None):
+        process = await asyncio.create_subprocess_shell(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.close = process.stdin.close
+        self.processes.append(process)
+        return process
+
+    async def close(self):
+        """ Waits for the processes, which end once their stdin is closed. """
+        for process in self.processes:
+            await process.wait()